@@ -16,6 +16,7 @@ import os.path
 import datetime
 import re
 import sys
+import hashlib
 from collections import Sequence
 import nplab.utils.version
 import numpy as np
@@ -23,11 +24,47 @@ from nplab.utils.show_gui_mixin import ShowGUIMixin
 from nplab.utils.array_with_attrs import DummyHDF5Group
 
 
-def attributes_from_dict(group_or_dataset, dict_of_attributes):
-    """Update the metadata of an HDF5 object with a dictionary."""
+SHARED_ATTRIBUTES_GROUP = "nplab_shared_attributes"
+"""Name of the top-level group that holds attribute values shared between
+many datasets (see `attributes_from_dict`)."""
+
+
+def shared_attribute_reference(group_or_dataset, value):
+    """Store an array once in the file, returning a reference to it.
+
+    The array is saved as a dataset in `SHARED_ATTRIBUTES_GROUP`, named by a
+    hash of its contents, so identical values (e.g. the wavelengths of a
+    spectrometer) are only ever written once per file.
+    """
+    value = np.ascontiguousarray(value)
+    digest = hashlib.sha1(value.dtype.str + str(value.shape) + value.tostring()).hexdigest()
+    shared = group_or_dataset.file.require_group(SHARED_ATTRIBUTES_GROUP)
+    if digest not in shared:
+        shared.create_dataset(digest, data=value)
+    return shared[digest].ref
+
+
+def resolve_attribute(group_or_dataset, value):
+    """If an attribute value is a reference to a shared value, return the value."""
+    if isinstance(value, h5py.Reference) and value:
+        return group_or_dataset.file[value][()]
+    return value
+
+
+def attributes_from_dict(group_or_dataset, dict_of_attributes, shared_attrs_min_size=None):
+    """Update the metadata of an HDF5 object with a dictionary.
+
+    If `shared_attrs_min_size` is specified, numerical arrays with at least
+    that many elements are stored only once per file, and the attribute holds
+    a reference to them.  `nplab.datafile` objects resolve these references
+    when the attributes are read, so this is transparent in most cases.
+    """
     attrs = group_or_dataset.attrs
     for key, value in dict_of_attributes.iteritems():
         if value is not None:
+            if (shared_attrs_min_size is not None and isinstance(value, np.ndarray)
+                    and value.size >= shared_attrs_min_size and value.dtype.kind in 'biufc'):
+                value = shared_attribute_reference(group_or_dataset, value)
             try:
                 attrs[key] = value
             except TypeError:
@@ -36,6 +73,16 @@ def attributes_from_dict(group_or_dataset, dict_of_attributes):
     #group_or_dataset.attrs.update(dict_of_attributes) #We can't do this - we'd lose the error handling.
 
 
+class AttributeManager(h5py.AttributeManager):
+    """HDF5 attributes, resolving references to shared values as they're read."""
+    def __init__(self, parent):
+        super(AttributeManager, self).__init__(parent)
+        self._parent = parent
+
+    def __getitem__(self, name):
+        return resolve_attribute(self._parent, super(AttributeManager, self).__getitem__(name))
+
+
 def h5_item_number(group_or_dataset):
     """Returns the number at the end of a group/dataset name, or None."""
     m = re.search(r"(\d+)$", group_or_dataset.name)  # match numbers at the end of the name
@@ -105,12 +152,14 @@ def transpose_datafile(data_set):
     parent.create_dataset(file_name,data = transposed_datafile)
 
 def wrap_h5py_item(item):
-    """Wrap an h5py object: groups are returned as Group objects, datasets are unchanged."""
+    """Wrap an h5py object: groups are returned as Group objects, datasets as Dataset objects."""
     if isinstance(item, h5py.Group):
         # wrap groups before returning them (this makes our group objects rather than h5py.Group)
         return Group(item.id)
+    elif isinstance(item, h5py.Dataset):
+        return Dataset(item.id)  # this resolves shared attributes
     else:
-        return item  # for now, don't bother wrapping datasets
+        return item
         
 def sort_by_timestamp(hdf5_group):
     """a quick function for sorting hdf5 groups (or files or dictionarys...) by timestamp """
@@ -130,12 +179,25 @@ def sort_by_timestamp(hdf5_group):
         keys.sort(key=split_number_from_name)
     items_lists = [[key,hdf5_group[key]] for key in keys]
     return items_lists
+class Dataset(h5py.Dataset):
+    """HDF5 Dataset, with shared attribute values resolved transparently."""
+    @property
+    def attrs(self):
+        """Attributes attached to this dataset (see `attributes_from_dict`)"""
+        return AttributeManager(self)
+
+
 class Group(h5py.Group, ShowGUIMixin):
     """HDF5 Group, a collection of datasets and subgroups.
 
     NPLab "wraps" h5py's Group objects to provide extra functions.
     """
 
+    @property
+    def attrs(self):
+        """Attributes attached to this group (see `attributes_from_dict`)"""
+        return AttributeManager(self)
+
     def __getitem__(self, key):
         item = super(Group, self).__getitem__(key)  # get the dataset or group
         return wrap_h5py_item(item) #wrap as a Group if necessary
@@ -213,7 +275,8 @@ class Group(h5py.Group, ShowGUIMixin):
         return Group(super(Group, self).require_group(name).id)  # wrap the returned group
 
     def create_dataset(self, name, auto_increment=True, shape=None, dtype=None,
-                       data=None, attrs=None, timestamp=True,autoflush = True, *args, **kwargs):
+                       data=None, attrs=None, timestamp=True,autoflush = True,
+                       shared_attrs_min_size=None, *args, **kwargs):
         """Create a new dataset, optionally with an auto-incrementing name.
 
         :param name: the name of the new dataset
@@ -224,6 +287,8 @@ class Group(h5py.Group, ShowGUIMixin):
         :param data: a numpy array or equivalent, to be saved - this specifies dtype and shape.
         :param attrs: a dictionary of metadata to be saved with the data
         :param timestamp: if True (default), we save a "creation_timestamp" attribute with the current time.
+        :param shared_attrs_min_size: if specified, arrays in the metadata with at least this many
+            elements are stored once per file and referenced (see `attributes_from_dict`).
 
         Further arguments are passed to h5py.Group.create_dataset.
         """
@@ -233,12 +298,12 @@ class Group(h5py.Group, ShowGUIMixin):
         if timestamp:
             dset.attrs.create('creation_timestamp', datetime.datetime.now().isoformat())
         if hasattr(data, "attrs"): #if we have an ArrayWithAttrs, use the attrs!
-            attributes_from_dict(dset, data.attrs)
+            attributes_from_dict(dset, data.attrs, shared_attrs_min_size)
         if attrs is not None:
-            attributes_from_dict(dset, attrs)  # quickly set the attributes
+            attributes_from_dict(dset, attrs, shared_attrs_min_size)  # quickly set the attributes
         if autoflush==True:
             dset.file.flush()
-        return dset
+        return Dataset(dset.id)
 
     create_dataset.__doc__ += '\n\n'+h5py.Group.create_dataset.__doc__
 
@@ -8,72 +8,44 @@ def diff(voltage):
 	return d_voltage
 
 
-def signal_diff(voltages):
+def signal_diff(voltages, out=None, overwrite_input=False):
+	"""Digitise a voltage trace and return the difference between consecutive samples (-1, 0 or 1)
+
+	out: optional float array of length len(voltages)-1 to write the result into
+	overwrite_input: if True, voltages is used as scratch space (and is destroyed), to avoid allocating a copy
+	"""
+	voltages = np.asarray(voltages)
 	#Work with normalized voltages:
 	vmin = np.min(voltages)
-	rounded_voltages = (voltages-vmin) #subtract min
+	if overwrite_input:
+		rounded_voltages = np.subtract(voltages, vmin, out=voltages) #subtract min
+	else:
+		rounded_voltages = voltages - vmin
 	vmax = np.max(rounded_voltages)
-	rounded_voltages = rounded_voltages/vmax #divide by max
+	rounded_voltages /= vmax #divide by max
 
 	#NOW: voltages are on scale: [0,1]
 	#Round to nearest integer - lift/lower intermediate values
 	#	We want digital values, not intermediates for edges
-	rounded_voltages = np.rint(rounded_voltages)
+	np.rint(rounded_voltages, out=rounded_voltages)
 	#compute differences and return:
-	d_voltage = rounded_voltages[0:-1] - rounded_voltages[1:]
-	return d_voltage
+	return np.subtract(rounded_voltages[0:-1], rounded_voltages[1:], out=out)
 
 def threshold(voltages, count_threshold = 0.5):
-	raise ValueError("Deactivated")
-	count_threshold = 0.4
+	"""Return 1 where there is an edge (rising or falling) in a voltage trace, and 0 elsewhere
+
+	Voltages are normalised to the range [0,1] and digitised at count_threshold, a fraction of the peak-to-peak
+	voltage, before looking for edges, so with count_threshold = 0.5 this matches np.absolute(signal_diff(voltages)).
+	"""
+	voltages = np.asarray(voltages)
 	vmin = np.min(voltages)
-	vmax = np.max(voltages)
-	vspan = abs(vmax-vmin)
-	#Piecewise difference between voltage measurements
+	vpp = np.max(voltages) - vmin
+	#digitise relative to the fraction of the Vpp value
+	digital = ((voltages - vmin) / vpp >= count_threshold).astype(np.int8)
+	#Piecewise difference between digitised measurements
 	#	+ve if rise edge
 	#	-ve if falling edge
-	#Assertions:
-	#	No consequtive +ve,+ve or -ve,-ve edges
-	#	+ve followed by -ve and -ve followed by +ve
-
-
-	
-	diff = signal_diff(voltages)
-
-	#threshold the absolute values of the pulses, relative to the fraction of the Vpp value
-	
-	#Get signs of the pulses
-	#Expected outputs
-	# +1 - rising edge
-	# -1 - falling edge
-	#  0 - no edge
-	pulses = np.sign(diff)
-
-	# assert(pulses.shape==diff.shape)
-	# for i in xrange(len(pulses)): #DELETE LOOP
-	# 	assert(pulses[i] in [-1,0,1])
-
-	#Get indices of the pulse positions
-	nonzero_indices = np.flatnonzero(pulses)
- 
-	assert(len(nonzero_indices) == int(np.sum(np.absolute(pulses)))),"NONZERO LENGTH:{0},ABS SUM PULSES:{1}".format(len(nonzero_indices),np.sum(np.absolute(pulses)))
-	for i in xrange(len(nonzero_indices)): #DELETE LOOP
-		assert(pulses[nonzero_indices[i]] != 0)
-
-	#Clean up consecutive pulses that are +ve,+ve or -ve,-ve:
-	# Example:
-	# 0 1 -1 1 1 1 -1 1 -1 -1 
-	#          | |  	    |
-	# 0 1 -1 1 0 0 -1 1 -1  0
-
-
-	# assert()
-	# for i in xrange(1,len(nonzero_indices)):
-		# if pulses[nonzero_indices[i]]== pulses[nonzero_indices[i-1]]:
-			# pulses[nonzero_indices[i]] == 0
-
-	#return absolute values of the pulses
-	return np.absolute(pulses)
+	return np.absolute(np.subtract(digital[0:-1], digital[1:])).astype(int)
 
 def binwidth_time_to_index(time_bin_width, dt):
 	return int(math.ceil((float(time_bin_width)/float(dt))))
@@ -81,21 +53,43 @@ def binned_data_len(input_length, bin_width):
 	#return length of binned array of original length: input_length and bin_width (as array index)
 	return int(math.ceil(float(input_length)/float(bin_width)))
 
-def binning(thresholded, index_bin_width):
-	#length of input thresholded array of 0s and 1s
-
-	thresholded_len = len(thresholded)
-
-	# for i in xrange(thresholded_len): #DELETE LOOP
-	# 	assert(thresholded[i] in [0,1]), "Threasholded:" thresholded[i]
-
-	#length of output [int]
-	outp_len = binned_data_len(thresholded_len, index_bin_width)
-	output = np.zeros(outp_len)
-	for i in xrange(outp_len):
-		output[i] = np.sum(np.absolute(thresholded[i*index_bin_width:min(thresholded_len,(i+1)*index_bin_width)]))
-
-	return output
+def binning(thresholded, index_bin_width, out=None):
+	"""Sum the absolute values of thresholded in bins of index_bin_width samples (the last bin may be shorter)
+
+	out: optional array of length binned_data_len(len(thresholded), index_bin_width) for the result
+	"""
+	thresholded = np.asarray(thresholded)
+	outp_len = binned_data_len(len(thresholded), index_bin_width)
+	if out is None:
+		out = np.zeros(outp_len)
+	if outp_len == 0:
+		return out
+	out[:] = np.add.reduceat(np.absolute(thresholded), np.arange(0, len(thresholded), index_bin_width))
+	return out
+
+def postprocess(voltages, index_bin_width, chunk_size=2**22):
+	"""Convert a voltage trace to photon counts, binned in bins of index_bin_width samples
+
+	This is equivalent to binning(np.absolute(signal_diff(voltages)), index_bin_width), but works through the
+	trace in chunks of about chunk_size samples, so voltages can be an HDF5 dataset or memory-mapped array larger
+	than the available memory.
+	"""
+	n = len(voltages)
+	#the normalisation needs the range of the whole trace first
+	chunk_size = max(1, chunk_size // index_bin_width) * index_bin_width #make chunks line up with bins
+	vmin = min(np.min(voltages[i:i+chunk_size]) for i in range(0, n, chunk_size))
+	vmax = max(np.max(voltages[i:i+chunk_size]) for i in range(0, n, chunk_size)) - vmin
+	binned_counts = np.zeros(binned_data_len(n - 1, index_bin_width))
+	for i in range(0, n - 1, chunk_size):
+		#each chunk of differences needs one extra voltage, from the start of the next chunk
+		chunk = np.array(voltages[i:min(i + chunk_size + 1, n)], dtype=np.float64)
+		chunk -= vmin
+		chunk /= vmax
+		np.rint(chunk, out=chunk)
+		diff = np.subtract(chunk[:-1], chunk[1:], out=chunk[:-1])
+		start = i // index_bin_width
+		binning(diff, index_bin_width, out=binned_counts[start:start + binned_data_len(len(diff), index_bin_width)])
+	return binned_counts
 
 def autocorrelation(x,mode="fft"):
 	x=np.asarray(x)
@@ -113,12 +107,12 @@ def autocorrelation(x,mode="fft"):
 
 if __name__ == "__main__":
 
-	#test count_photons - general pulse
+	#test threshold - general pulse
 	voltage = np.zeros(10000)
 	voltage[3000:6000] = 1
 	#add gaussian random noise to corrupt data - we want to make it tolerant to noise too!
 	voltage = voltage + np.random.normal(0,0.1,voltage.shape)
-	counts = count_photons(voltage,count_threshold=0.5)
+	counts = np.sum(threshold(voltage,count_threshold=0.5))
 	plt.plot(voltage)
 	plt.xlabel("Simulated Time")
 	plt.ylabel("Simulated Voltage")
@@ -0,0 +1,128 @@
+"""
+Multi-tau correlator
+====================
+
+`dls_signal_postprocessing.autocorrelation` needs the whole binned signal, so the correlation function isn't
+available until a run has finished, and memory grows with the length of the run.  A `MultiTauCorrelator` instead
+takes blocks of photon counts as they arrive (e.g. from `Adlink9812.stream`), and keeps a running estimate of the
+intensity autocorrelation g2 at logarithmically spaced lags:
+
+	level 0:  lags 0, 1, ..., m-1                      (bin width 1)
+	level k:  lags m/2 * 2**k, ..., (m-1) * 2**k       (bin width 2**k)
+
+Level k correlates the counts summed into bins of 2**k samples, and only the last m-1 bins of each level are kept
+between blocks, so memory does not grow with the length of the run.  Products are accumulated exactly, so adding
+the data in blocks gives the same answer as adding it all at once, and at level 0 the result is identical to the
+batch calculation.
+"""
+import numpy as np
+
+
+class MultiTauCorrelator(object):
+	"""Calculate the autocorrelation of a stream of counts, at logarithmically spaced lags.
+
+	Arguments:
+	channels_per_level : int (even, default 16)
+		The number of lags at the first level (m above).  Each subsequent level adds m/2 lags.
+	n_levels : int (default 24)
+		The number of levels: the longest lag is (m-1) * 2**(n_levels-1) samples.
+	dt : float (default 1.0)
+		The time between samples, used to calculate `lag_times`.
+	"""
+	def __init__(self, channels_per_level=16, n_levels=24, dt=1.0):
+		assert channels_per_level % 2 == 0, "channels_per_level must be even"
+		self.channels_per_level = channels_per_level
+		self.n_levels = n_levels
+		self.dt = dt
+		m = channels_per_level
+		self.level_lags = [np.arange(m)] + [np.arange(m // 2, m) for k in range(1, n_levels)]
+		self.reset()
+
+	def reset(self):
+		"""Discard all the data."""
+		self._products = [np.zeros(len(lags)) for lags in self.level_lags]
+		self._pairs = [np.zeros(len(lags), dtype=np.int64) for lags in self.level_lags]
+		self._sums = np.zeros(self.n_levels)
+		self._samples = np.zeros(self.n_levels, dtype=np.int64)
+		self._history = [np.zeros(0) for k in range(self.n_levels)]  # the end of the previous block, at each level
+		self._carry = [np.zeros(0) for k in range(self.n_levels)]  # an unpaired sample, waiting to be binned
+
+	@property
+	def sample_count(self):
+		"""The number of samples that have been added."""
+		return self._samples[0]
+
+	def add(self, counts):
+		"""Add a block of counts (a 1D array) to the correlation."""
+		x = np.asarray(counts, dtype=np.float64)
+		for level in range(self.n_levels):
+			if len(x) == 0:
+				break
+			self._correlate(level, x)
+			# sum pairs of samples to make the next level, keeping any odd sample for next time
+			x = np.concatenate((self._carry[level], x))
+			n = len(x) // 2 * 2
+			self._carry[level] = x[n:]
+			x = x[:n].reshape(-1, 2).sum(axis=1)
+
+	def _correlate(self, level, x):
+		"""Accumulate the products of each new sample at this level with the ones `lag` samples before it."""
+		lags = self.level_lags[level]
+		history = self._history[level]
+		data = np.concatenate((history, x))
+		n = len(data)
+		for j, lag in enumerate(lags):
+			start = max(len(history), lag)  # only count pairs whose later sample is new
+			if start < n:
+				self._products[level][j] += np.dot(data[start:], data[start - lag:n - lag])
+				self._pairs[level][j] += n - start
+		self._sums[level] += np.sum(x)
+		self._samples[level] += len(x)
+		self._history[level] = data[max(n - lags[-1], 0):]
+
+	@property
+	def lags(self):
+		"""The lags, in samples, at which the correlation is calculated."""
+		return np.concatenate([lags * 2 ** k for k, lags in enumerate(self.level_lags)])
+
+	@property
+	def lag_times(self):
+		"""The lags, in units of time (see `dt`)."""
+		return self.lags * self.dt
+
+	@property
+	def g2(self):
+		"""The normalised intensity autocorrelation at each lag (NaN where there is not enough data yet).
+
+		This is <I(t) I(t+tau)> / <I>^2, normalised in the same way as `dls_signal_postprocessing.autocorrelation`.
+		"""
+		g2 = []
+		for k in range(self.n_levels):
+			with np.errstate(divide='ignore', invalid='ignore'):
+				mean = self._sums[k] / self._samples[k]
+				g2.append(self._products[k] / self._pairs[k] / mean ** 2)
+		return np.concatenate(g2)
+
+	def correlation(self, include_zero_lag=False):
+		"""Return the lag times and g2 where it's been calculated, as a 2xN array (like the saved autocorrelation)."""
+		g2 = self.g2
+		valid = np.isfinite(g2)
+		if not include_zero_lag:
+			valid[0] = False
+		return np.vstack((self.lag_times[valid], g2[valid]))
+
+	def write_to(self, group, name="autocorrelation", attrs=None):
+		"""Save the current correlation in a dataset in `group`, replacing it if it's already there.
+
+		Calling this repeatedly during a run lets the `AutocorrelationRenderer` show the correlation as it builds
+		up."""
+		data = self.correlation()
+		if name in group:
+			del group[name]
+		metadata = {"device": "adlink9812", "datatype": "autocorrelation", "sample_count": self.sample_count,
+					"X label": "Time [s]", "Y label": "Intensity Autocorrelation g2 [no units]"}
+		if attrs is not None:
+			metadata.update(attrs)
+		dataset = group.create_dataset(name, data=data, attrs=metadata, auto_increment=False)
+		group.file.flush()
+		return dataset
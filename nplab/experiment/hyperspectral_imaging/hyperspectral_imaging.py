@@ -106,7 +106,8 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
                                      dtype=np.float64,
                                      attrs=spectrometer.metadata)
         if isinstance(self.spectrometer, Spectrometer):
-            self.read_spectra = self.spectrometer.read_spectrum
+            raw_buffer = np.empty(self.spectrometer.wavelengths.size, dtype=np.float64) # reused for every pixel
+            self.read_spectra = lambda: self.spectrometer.read_spectrum_into(raw_buffer)
             self.process_spectra = self.spectrometer.process_spectrum
         elif isinstance(self.spectrometer, Spectrometers):
             self.read_spectra = self.spectrometer.read_spectra
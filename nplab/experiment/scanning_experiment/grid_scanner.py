@@ -10,13 +10,13 @@ __author__ = 'alansanders'
 import numpy as np
 import threading
 import time
-import operator
 from nplab.experiment.scanning_experiment import ScanningExperiment, TimedScan
 from nplab.instrument.stage import Stage
 from functools import partial
 from nplab.utils.gui import *
 from nplab.ui.ui_tools import UiTools
 from nplab import inherit_docstring
+from nplab.experiment.scanning_experiment.trajectories import scan_order_indices, changed_axes
 
 
 class GridScan(ScanningExperiment, TimedScan):
@@ -40,6 +40,9 @@ class GridScan(ScanningExperiment, TimedScan):
         self._unit_conversion = {'nm': 1e-9, 'um': 1e-6, 'mm': 1e-3}
         self._size_unit, self._step_unit, self._init_unit = ('um', 'um', 'um')
         self.grid_shape = (0,0)
+        self.scan_order = 'snake' # name, function or list of indices (see init_trajectory)
+        self.trajectory = None
+        self._pending_moves = None
         #self.init_grid(self.axes, self.size, self.step, self.init)
 
     def _update_axes(self, num_axes):
@@ -124,8 +127,9 @@ class GridScan(ScanningExperiment, TimedScan):
             ax = np.arange(0, s+st/2., st) - s/2. + s0
             scan_axes.append(ax)
         self.grid_shape = tuple(ax.size for ax in scan_axes)
-        self.total_points = reduce(operator.mul, self.grid_shape, 1)
         self.scan_axes = scan_axes
+        self.init_trajectory(scan_axes)
+        self.total_points = len(self.trajectory)
         return scan_axes
 
     def init_current_grid(self):
@@ -156,6 +160,75 @@ class GridScan(ScanningExperiment, TimedScan):
         """Move to a position along a given axis."""
         self.stage.move(position/self.stage_units, axis=axis)
 
+    def move_async(self, position, axis):
+        """Start moving to a position along a given axis, returning a future (see `Stage.move_async`)."""
+        return self.stage.move_async(position/self.stage_units, axis=axis)
+
+    def start_next_move(self):
+        """Start moving to the next point of the scan, without waiting for the stage.
+
+        Call this from `scan_function` once the detector has finished acquiring
+        (e.g. at the end of the exposure) but before reading it out or
+        processing the data.  The stage then moves and settles while that
+        happens, and the scan waits for the move to finish before the next
+        point.  This does nothing if the stage is following the trajectory
+        by itself (see `Stage.follow_trajectory`), or if several axes need to
+        move and the stage can't move them at the same time.
+        """
+        n = self._index + 1 # scan_function is running for point number self._index
+        if self._pending_moves is not None or self.trajectory is None or n >= len(self.trajectory):
+            return
+        moving_axes = np.flatnonzero(self.trajectory_changes[n])
+        if self.stage.can_follow_trajectory or (len(moving_axes) > 1 and not self.stage.can_start_move):
+            return # leave it to the stage, or move the axes one at a time as usual
+        self._pending_moves = (n, [self.move_async(self.trajectory_positions[n, d], self._trajectory_axes[d])
+                                   for d in moving_axes])
+
+    def _move_to_trajectory_point(self, n):
+        """Move the axes that change between the last point and point n (unless they already are)."""
+        if self._pending_moves is not None:
+            pending_n, futures = self._pending_moves
+            self._pending_moves = None
+            for future in futures:
+                future.result()
+            if pending_n == n:
+                return
+        moving_axes = np.flatnonzero(self.trajectory_changes[n])
+        if len(moving_axes) > 1 and self.stage.can_start_move:
+            # move all the axes at once, rather than one after another
+            for future in [self.move_async(self.trajectory_positions[n, d], self._trajectory_axes[d])
+                           for d in moving_axes]:
+                future.result()
+        else:
+            for d in moving_axes:
+                self.move(self.trajectory_positions[n, d], self._trajectory_axes[d])
+
+    def _follow_trajectory(self, axes):
+        """Move through the trajectory, yielding the index of each point once we're there."""
+        if self.stage.can_follow_trajectory:
+            for n in self.stage.follow_trajectory(self.trajectory_positions/self.stage_units, axes):
+                yield n
+        else:
+            for n in range(len(self.trajectory)):
+                self._move_to_trajectory_point(n)
+                yield n
+
+    def init_trajectory(self, scan_axes, scan_order=None):
+        """Work out the order in which to visit the points of the grid.
+
+        The trajectory is an array of grid indices with one row per point (see
+        `nplab.experiment.scanning_experiment.trajectories`).  We also work out
+        the position of each point, and which axes change between points, so
+        that only those axes are moved.
+        """
+        if scan_order is None:
+            scan_order = self.scan_order
+        shape = tuple(ax.size for ax in scan_axes)
+        self.trajectory = scan_order_indices(scan_order, shape)
+        self.trajectory_positions = np.array([ax[self.trajectory[:, d]] for d, ax in enumerate(scan_axes)]).T
+        self.trajectory_changes = changed_axes(self.trajectory)
+        return self.trajectory
+
     def get_position(self, axis):
         return self.stage.get_position(axis=axis) * self.stage_units
     
@@ -171,58 +244,69 @@ class GridScan(ScanningExperiment, TimedScan):
     def middle_loop_end(self):
         """This function is called after the scan happens, for each value of the second-outermost variable (usually Y)"""
         pass
+    def _loop_start(self, n):
+        """Call the loop start functions if point n starts a new layer or line (N.B. before moving there)."""
+        if self.trajectory_changes[n, 0]:
+            self._layer += 1
+            self.status = 'Scanning layer {0:d}/{1:d}'.format(self._layer, self.grid_shape[0])
+            self.outer_loop_start()
+        if self.trajectory.shape[1] > 2 and np.any(self.trajectory_changes[n, :2]):
+            self.middle_loop_start()
+
+    def _loop_end(self, n, last=False):
+        """Call the loop end functions if point n is the last of a layer or line (or the last we'll do)."""
+        last = last or n + 1 >= len(self.trajectory)
+        if self.trajectory.shape[1] > 2 and (last or np.any(self.trajectory_changes[n + 1, :2])):
+            self.middle_loop_end()
+        if last or self.trajectory_changes[n + 1, 0]:
+            self.outer_loop_end()
+
     def scan(self, axes, size, step, init):
-        """Scans a grid, applying a function at each position."""
+        """Scans a grid, applying a function at each position.
+
+        The points are visited in the order given by `scan_order` (see
+        `init_trajectory`), moving only the axes that change from one point to
+        the next.  The loop start/end functions are called whenever the
+        outermost (and, for 3D scans, the middle) index changes.
+        """
         self.abort_requested = False
         axes, size, step, init = (axes[::-1], size[::-1], step[::-1], init[::-1])
         scan_axes = self.init_grid(axes, size, step, init)
         print scan_axes
         self.open_scan()
-        # get the indices of points along each of the scan axes for use with snaking over array
-        pnts = [range(axis.size) for axis in scan_axes]
+        self._trajectory_axes = axes
 
         self.indices = [-1,] * len(axes)
-        self._index = 0
-        self._step_times = np.zeros(self.grid_shape)
+        self._index = 0 # the number of points done so far
+        self._layer = 0
+        # step times are stored in the order the points are visited, for the time estimate
+        self._step_times = np.zeros(len(self.trajectory))
         self._step_times.fill(np.nan)
+        self._pending_moves = None
         self.status = 'acquiring data'
         self.acquiring.set()
         scan_start_time = time.time()
-        for k in pnts[0]:  # outer most axis
-            self.indices = list(self.indices)
-            self.indices[0] = k # Make sure indices is always up-to-date, for the drift compensation
-            if self.abort_requested:
-                break
-            self.outer_loop_start()
-            self.status = 'Scanning layer {0:d}/{1:d}'.format(k + 1, len(pnts[0]))
-            self.move(scan_axes[0][k], axes[0])
-            pnts[1] = pnts[1][::-1]  # reverse which way is iterated over each time
-            for j in pnts[1]:
+        if len(self.trajectory) > 0:
+            self._loop_start(0)
+        points = self._follow_trajectory(axes)
+        try:
+            for n in points:
+                indices = tuple(self.trajectory[n])
+                self.indices = indices
+                self.scan_function(*indices)
+                self._step_times[n] = time.time()
+                self._index = n + 1
+                self._loop_end(n, last=self.abort_requested)
                 if self.abort_requested:
                     break
-                self.move(scan_axes[1][j], axes[1])
-                self.indices = list(self.indices)
-                self.indices[1] = j
-                if len(axes) == 3:  # for 3d grid (volume) scans
-                    self.middle_loop_start()
-                    pnts[2] = pnts[2][::-1]  # reverse which way is iterated over each time
-                    for i in pnts[2]:
-                        if self.abort_requested:
-                            break
-                        self.move(scan_axes[2][i], axes[2])
-                        self.indices[2] = i # These two lines are redundant.  TODO: pick one...
-                        #self.indices = (k, j, i) # keeping it as a list allows index assignment
-                        self.scan_function(k, j, i)
-                        self._step_times[k,j,i] = time.time()
-                        self._index += 1
-                    self.middle_loop_end()
-                elif len(axes) == 2:  # for regular 2d grid scans ignore third axis i
-                    self.indices = (k, j)
-                    self.scan_function(k, j)
-                    self._step_times[k,j] = time.time()
-                    self._index += 1
-            self.outer_loop_end()
-
+                if n + 1 < len(self.trajectory):
+                    self._loop_start(n + 1)
+        finally:
+            points.close()
+            if self._pending_moves is not None:
+                for future in self._pending_moves[1]:
+                    future.result()
+                self._pending_moves = None
         self.print_scan_time(time.time() - scan_start_time)
         self.acquiring.clear()
         # move back to initial positions
@@ -0,0 +1,120 @@
+"""
+Scan orders for grid scans.  Each function takes the shape of a grid and returns an integer array
+of shape (number of points, number of axes), giving the grid indices of each point in the order they
+should be visited.  The first axis is the outermost (slowest-varying) one, as in GridScan.
+
+Any function with this signature can be used as a scan order, as can an array of indices (e.g. a
+list of points of interest).  Orders that are intrinsically 2D (spiral and Hilbert) are applied to
+the last two axes, with any outer axes visited in snake order.
+"""
+
+import numpy as np
+
+
+def raster_order(shape):
+    """Visit each line of the grid in the same direction, like reading a page."""
+    shape = tuple(shape)
+    return np.indices(shape).reshape(len(shape), -1).T
+
+
+def snake_order(shape):
+    """Visit each line of the grid in the opposite direction to the last (a boustrophedon scan)."""
+    shape = tuple(shape)
+    indices = raster_order(shape)
+    counter = np.arange(indices.shape[0])
+    for d in range(1, len(shape)):
+        # every time an outer axis steps, this axis reverses direction
+        reverse = (counter // int(np.prod(shape[d:]))) % 2 == 1
+        indices[reverse, d] = shape[d] - 1 - indices[reverse, d]
+    return indices
+
+
+def _spiral_order_2d(shape):
+    """Visit a 2D grid in rings, working outwards from the centre."""
+    indices = raster_order(shape)
+    displacement = indices - (np.array(shape) - 1) / 2.0
+    ring = np.max(np.abs(displacement), axis=1)
+    angle = np.arctan2(displacement[:, 1], displacement[:, 0])
+    return indices[np.lexsort((angle, ring))]
+
+
+def _hilbert_order_2d(shape):
+    """Visit a 2D grid along a Hilbert curve, which keeps consecutive points close together."""
+    indices = raster_order(shape)
+    n = 2 ** int(np.ceil(np.log2(max(max(shape), 1))))
+    x, y = indices[:, 0].copy(), indices[:, 1].copy()
+    distance = np.zeros(x.shape, dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        distance += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve joins up
+        flip = ~ry & rx
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s //= 2
+    return indices[np.argsort(distance, kind='mergesort')]
+
+
+def _planar_order(order_2d, shape):
+    """Apply a 2D scan order to the last two axes, snaking through the outer axes."""
+    shape = tuple(shape)
+    if len(shape) < 2:
+        return snake_order(shape)
+    plane = order_2d(shape[-2:])
+    outer = snake_order(shape[:-2]) if len(shape) > 2 else np.zeros((1, 0), dtype=plane.dtype)
+    blocks = []
+    for i, outer_index in enumerate(outer):
+        # alternate planes are traversed backwards, to avoid jumping across the grid between them
+        p = plane if i % 2 == 0 else plane[::-1]
+        blocks.append(np.hstack([np.tile(outer_index, (p.shape[0], 1)), p]))
+    return np.vstack(blocks)
+
+
+def spiral_order(shape):
+    """Spiral outwards from the centre of the grid (in the last two axes)."""
+    return _planar_order(_spiral_order_2d, shape)
+
+
+def hilbert_order(shape):
+    """Follow a Hilbert curve through the grid (in the last two axes)."""
+    return _planar_order(_hilbert_order_2d, shape)
+
+
+SCAN_ORDERS = {'raster': raster_order,
+               'snake': snake_order,
+               'spiral': spiral_order,
+               'hilbert': hilbert_order}
+
+
+def scan_order_indices(order, shape):
+    """Return the indices of the points to visit, given a scan order and the shape of the grid.
+
+    order may be the name of one of the SCAN_ORDERS, a function taking the grid shape, or an
+    array of indices with one row per point.
+    """
+    shape = tuple(shape)
+    if isinstance(order, basestring):
+        if order not in SCAN_ORDERS:
+            raise ValueError("{0} is not a valid scan order, must be one of {1}".format(order, SCAN_ORDERS.keys()))
+        order = SCAN_ORDERS[order]
+    indices = order(shape) if callable(order) else order
+    indices = np.array(indices, dtype=np.int64, ndmin=2)
+    if indices.shape[1] != len(shape):
+        raise ValueError("the scan order must give {0} indices for each point".format(len(shape)))
+    if np.any(indices < 0) or np.any(indices >= np.array(shape)):
+        raise ValueError("the scan order contains points outside the grid")
+    return indices
+
+
+def changed_axes(indices):
+    """Return a boolean array, True where an axis must move to reach each point from the last.
+
+    All axes are marked as changed at the first point.
+    """
+    changed = np.ones(indices.shape, dtype=bool)
+    changed[1:] = indices[1:] != indices[:-1]
+    return changed
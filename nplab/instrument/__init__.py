@@ -23,9 +23,75 @@ import inspect
 import os
 import h5py
 import datetime
+import time
+import threading
+import functools
 LOGGER = create_logger('Instrument')
 LOGGER.setLevel('INFO')
 
+class PropertyCache(object):
+    """Remembers recently-read property values, so they needn't be re-read.
+
+    Each value is stored along with the time it expires.  How long values are
+    kept depends on their "time to live" (TTL), in seconds: this is looked up
+    first in `ttls` (a dictionary of property names), then from the property
+    itself (e.g. the `cache_ttl` argument of a `queried_property`) and finally
+    falls back to `default_ttl`.  A TTL of None disables caching for that
+    property, and float('inf') keeps the value until it's invalidated.
+    """
+    def __init__(self, default_ttl=None, ttls=None):
+        self.default_ttl = default_ttl
+        self.ttls = dict(ttls) if ttls is not None else {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def ttl_for(self, name, property_ttl=None):
+        """Return the time-to-live for the named property (None = don't cache)."""
+        if name in self.ttls:
+            return self.ttls[name]
+        if property_ttl is not None:
+            return property_ttl
+        return self.default_ttl
+
+    def get(self, name, getter, property_ttl=None):
+        """Return the cached value if it's fresh, otherwise call getter() and cache the result."""
+        with self._lock:
+            expiry, value = self._values.get(name, (None, None))
+        if expiry is not None and time.time() < expiry:
+            return value
+        value = getter()
+        ttl = self.ttl_for(name, property_ttl)
+        if ttl is not None:
+            self.store(name, value, ttl)
+        return value
+
+    def store(self, name, value, ttl=float('inf')):
+        """Put a value in the cache, to expire after `ttl` seconds."""
+        with self._lock:
+            self._values[name] = (time.time() + ttl, value)
+
+    def invalidate(self, *names):
+        """Forget the named values (or everything, if no names are given)."""
+        with self._lock:
+            if len(names) == 0:
+                self._values.clear()
+            for name in names:
+                self._values.pop(name, None)
+
+
+def descriptor_name(descriptor, obj):
+    """Return the name of the attribute of obj's class that holds `descriptor`.
+    
+    Properties don't know their own names, but they need one to use the
+    property cache.  Returns None if the descriptor can't be found.
+    """
+    for cls in type(obj).__mro__:
+        for name, value in vars(cls).items():
+            if value is descriptor:
+                return name
+    return None
+
+
 class Instrument(object, ShowGUIMixin):
     """Base class for all instrument-control classes.
 
@@ -33,6 +99,11 @@ class Instrument(object, ShowGUIMixin):
     """
     __instances = None
     metadata_property_names = () #"Tuple of names of properties that should be automatically saved as HDF5 metadata
+    property_cache = None #: A `PropertyCache`, if caching is enabled (see `enable_property_cache`)
+    shared_metadata_min_size = None
+    """If set, arrays in saved metadata with at least this many elements are 
+    stored once per file and referenced, rather than copied into every 
+    dataset (see `nplab.datafile.attributes_from_dict`)."""
 
     def __init__(self):
         """Create an instrument object."""
@@ -40,6 +111,12 @@ class Instrument(object, ShowGUIMixin):
         Instrument.instances_set().add(self) #keep track of instances (should this be in __new__?)
         self._logger = logging.getLogger('Instrument.' + str(type(self)).split('.')[-1].split('\'')[0])
 
+    def __setattr__(self, name, value):
+        # Setting a property must never leave its old value in the cache
+        if self.property_cache is not None:
+            self.property_cache.invalidate(name)
+        super(Instrument, self).__setattr__(name, value)
+
     @classmethod
     def instances_set(cls):
         if Instrument.__instances is None:
@@ -102,6 +179,7 @@ class Instrument(object, ShowGUIMixin):
         """
         if "%d" not in name: # is this really necessary?
             name = name + '_%d'
+        kwargs.setdefault('shared_attrs_min_size', cls.shared_metadata_min_size)
         df = cls.get_root_data_folder()
         dset = df.create_dataset(name, *args, **kwargs)
         if 'data' in kwargs and flush:
@@ -153,10 +231,70 @@ class Instrument(object, ShowGUIMixin):
                     keys.remove(p)
                 except ValueError:
                     pass # Don't worry if we exclude items that are not there!
-        return {name: getattr(self,name) for name in keys}
+        return {name: self.cached_property_value(name, functools.partial(getattr, self, name))
+                for name in keys}
 
     metadata = property(get_metadata)
 
+    def enable_property_cache(self, default_ttl=None, **ttls):
+        """Start caching property values, to avoid reading them from hardware repeatedly.
+        
+        Arguments:
+        default_ttl : float, optional
+            The time (in seconds) for which values are kept.  By default, only
+            properties given a TTL (either here or in their definition, e.g.
+            `queried_property(..., cache_ttl=1)`) are cached.
+        **ttls
+            Time-to-live for individual properties, by name.  These take
+            precedence over the TTL in the property's definition.
+        
+        Values are discarded whenever the property is set.  If setting one
+        property changes another (e.g. binning changes the image size) use
+        `invalidate_property_cache`.
+        """
+        self.property_cache = PropertyCache(default_ttl, ttls)
+
+    def disable_property_cache(self):
+        """Stop caching property values (they will all be read afresh)."""
+        self.property_cache = None
+
+    def invalidate_property_cache(self, *names):
+        """Discard cached values of the named properties (all of them if none are named)."""
+        if self.property_cache is not None:
+            self.property_cache.invalidate(*names)
+
+    def cached_property_value(self, name, getter, ttl=None):
+        """Return the value of a property, from the cache if possible.
+        
+        If caching is disabled, or there's no fresh value in the cache, this
+        calls `getter()` to retrieve the value (caching it if appropriate).
+        `ttl` is the default time-to-live for this property.
+        """
+        if self.property_cache is None:
+            return getter()
+        return self.property_cache.get(name, getter, ttl)
+
+    def snapshot_metadata(self, **kwargs):
+        """Read all the metadata afresh and keep it until it's invalidated.
+        
+        This is intended for saving lots of data quickly: after a snapshot,
+        `get_metadata` (and hence `bundle_metadata`, saving, etc.) will use the
+        stored values rather than reading each property from the instrument
+        every time.  Setting a property discards its stored value as usual,
+        and calling `snapshot_metadata` again refreshes everything.  The
+        property cache is enabled if it isn't already.
+        
+        Keyword arguments are passed to `get_metadata`, and the metadata is
+        returned.
+        """
+        if self.property_cache is None:
+            self.enable_property_cache()
+        self.property_cache.invalidate()
+        metadata = self.get_metadata(**kwargs)
+        for name, value in metadata.iteritems():
+            self.property_cache.store(name, value)
+        return metadata
+
     def bundle_metadata(self, data, enable=True, **kwargs):
         """Add metadata to a dataset, returning an ArrayWithAttrs.
         
@@ -14,13 +14,16 @@ import traceback
 import os
 import datetime
 import time
+import functools
 from PIL import Image
 import warnings
 import pyqtgraph as pg
 from pyqtgraph.graphicsItems.GradientEditorItem import Gradients
 from weakref import WeakSet
 
-from nplab.instrument import Instrument
+from nplab.instrument import Instrument, descriptor_name
+from nplab.instrument.camera.frame_buffer import FrameRingBuffer, FrameReader, FrameOverwrittenError
+from nplab.instrument.camera.preview import PreviewWorker, decimation_factor, downsample, display_levels
 from nplab.utils.notified_property import NotifiedProperty, DumbNotifiedProperty, register_for_property_changes
 
 
@@ -38,8 +41,11 @@ class CameraParameter(NotifiedProperty):
     (otherwise we'd send them the value that was requested, even if it was
     not valid).  This behaviour can be disabled by setting read_back to False
     in the constructor.
+    
+    If the camera's property cache is enabled, values are re-used for up to
+    `cache_ttl` seconds (see `Instrument.enable_property_cache`).
     """
-    def __init__(self, parameter_name, doc=None, read_back=True):
+    def __init__(self, parameter_name, doc=None, read_back=True, cache_ttl=None):
         """Create a property that reads and writes the given parameter.
         
         This internally uses the `get_camera_parameter` and 
@@ -52,12 +58,24 @@ class CameraParameter(NotifiedProperty):
                                                       doc=doc,
                                                       read_back=read_back)
         self.parameter_name = parameter_name
+        self.cache_ttl = cache_ttl
+        self._name = None
         
     def fget(self, obj):
+        if obj.property_cache is not None:
+            if self._name is None:
+                self._name = descriptor_name(self, obj)
+            return obj.cached_property_value(self._name,
+                        functools.partial(obj.get_camera_parameter, self.parameter_name),
+                        self.cache_ttl)
         return obj.get_camera_parameter(self.parameter_name)
             
     def fset(self, obj, value):
         obj.set_camera_parameter(self.parameter_name, value)
+        if obj.property_cache is not None:
+            if self._name is None:
+                self._name = descriptor_name(self, obj)
+            obj.invalidate_property_cache(self._name) # so read_back gets the new value
 
 
 class Camera(Instrument):
@@ -71,6 +89,7 @@ class Camera(Instrument):
     you should override     
     """
     
+    shared_metadata_min_size = 64 # large metadata arrays (e.g. calibrations, backgrounds) are saved once per file
     video_priority = DumbNotifiedProperty(False)
     filename = DumbNotifiedProperty('snapshot_%d')
     """Set video_priority to True to avoid disturbing the video stream when
@@ -83,12 +102,20 @@ class Camera(Instrument):
     """This function is run on the image before it's displayed in live view.  
     It should accept, and return, an RGB image as its argument."""
     
+    frame_buffer_size = 16
+    """The number of recent frames kept in `frame_buffer`."""
+    live_view_interval = 0.1
+    """The time (in seconds) to wait between frames in the default live view
+    implementation.  Set it to 0 to acquire frames as fast as possible."""
+    preview_max_rate = 30
+    """The maximum number of times per second the preview widgets are updated
+    (frames arriving faster than this are still acquired, just not displayed)."""
+    
     def __init__(self):
         super(Camera,self).__init__()
         self.acquisition_lock = threading.Lock()    
-        self._latest_frame_update_condition = threading.Condition()
+        self.frame_buffer = FrameRingBuffer(self.frame_buffer_size)
         self._live_view = False
-        self._frame_counter = 0
         # Ensure camera parameters get saved in the metadata.  You may want to override this in subclasses
         # to remove junk (e.g. if some of the parameters are meaningless)
 #        self.metadata_property_names = self.metadata_property_names + tuple(self.camera_parameter_names())
@@ -103,10 +130,13 @@ class Camera(Instrument):
         
         override in subclass if you want to shut down hardware."""
         self.live_view = False
+        if self._preview_worker is not None:
+            self._preview_worker.stop()
+            self._preview_worker = None
         
     
     def get_next_frame(self, timeout=60, discard_frames=0, 
-                       assert_live_view=True, raw=True):
+                       assert_live_view=True, raw=True, copy=True):
         """Wait for the next frame to arrive and return it.
         
         This function is mostly intended for acquiring frames from a video
@@ -126,33 +156,58 @@ class Camera(Instrument):
         when that is the case.
         @param: raw: The default (True) returns a raw frame - False returns the
         frame after processing by the filter function if any.
+        @param: copy: The default (True) returns a copy of the frame.  False 
+        returns a view into `frame_buffer`, which avoids copying the image but
+        will be overwritten once `frame_buffer_size` more frames arrive.
+        
+        To process every frame in turn (and find out if you've missed any), 
+        use `frame_reader()` instead.
         """
         if assert_live_view:
             assert self.live_view, """Can't wait for the next frame if live view is not enabled!"""
-        with self._latest_frame_update_condition:
-            # We use the Condition object to block until a new frame appears
-            # However we need to check that a new frame has actually been taken
-            # so we use the frame counter.
-            # NB the current implementation may be vulnerable to dropped frames
-            # which will probably cause a timeout error.
-            # Checking for frame_counter being >= target_frame is vulnerable to
-            # overflow.
-            target_frame = self._frame_counter + 1 + discard_frames
-            expiry_time = time.time() + timeout
-            while self._frame_counter != target_frame and time.time() < expiry_time:
-                self._latest_frame_update_condition.wait(timeout) #wait for a new frame
-            if time.time() >= expiry_time:
-                raise IOError("Timed out waiting for a fresh frame from the video stream.")
-            if raw:
-                return self.latest_raw_frame
-            else:
-                return self.latest_frame
+        target_frame = self.frame_buffer.latest_seq + 1 + discard_frames
+        if not self.frame_buffer.wait_for(target_frame, timeout):
+            raise IOError("Timed out waiting for a fresh frame from the video stream.")
+        try:
+            frame = self.frame_buffer.get(target_frame, copy=copy)
+        except FrameOverwrittenError: # we were too slow - the latest frame is even fresher
+            frame = self.frame_buffer.get(copy=copy)
+        if raw or self.filter_function is None:
+            return frame
+        else:
+            return self.filter_function(frame)
+    
+    def frame_reader(self):
+        """Return a `FrameReader` that returns each new frame from the camera in turn.
+        
+        Call `read()` on the reader to get the next frame.  If you fall more
+        than `frame_buffer_size` frames behind, frames are skipped and counted
+        in the reader's `dropped` attribute.
+        """
+        return self.frame_buffer.reader()
+    
+    def last_frames(self, k, copy=True):
+        """Return the last k frames acquired (oldest first), and their sequence numbers.
+        
+        This is useful for saving the frames leading up to an event.  See
+        `FrameRingBuffer.last_frames` for details.
+        """
+        return self.frame_buffer.last_frames(k, copy=copy)
         
     def raw_snapshot(self):
         """Take a snapshot and return it.  No filtering or conversion."""
         raise NotImplementedError("Cameras must subclass raw_snapshot!")
         return True, np.zeros((640,480,3),dtype=np.uint8)
         
+    def raw_snapshot_into(self, frame):
+        """Take a snapshot, writing it into the supplied array, and return True if it worked.
+        
+        This is optional: cameras that can write straight into an existing
+        array should implement it, so that live view doesn't need to allocate
+        memory for each frame.  The array will have the same shape and dtype 
+        as the last frame from `raw_snapshot`."""
+        raise NotImplementedError("This camera can't write frames into an existing array.")
+        
     def get_image(self):
         print "Warning: get_image is deprecated, use raw_image() instead."
         return self.raw_image()
@@ -225,36 +280,54 @@ class Camera(Instrument):
         live_view is enabled.  This is before processing by any filter function
         that may be in effect.  May be NxMx3 or NxM for monochrome.  To get a
         fresh frame, use raw_image().  Setting this property will update any
-        preview widgets that are in use."""
+        preview widgets that are in use.
+        
+        During live view this may be a view of a slot in `frame_buffer` (see
+        `raw_snapshot_into`), which is overwritten once the buffer wraps 
+        round, so the array can change after it is read.  Copy it if you need 
+        to keep it, or use `get_next_frame` or `last_frames`, which copy by 
+        default."""
         return self._latest_raw_frame
     @latest_raw_frame.setter
     def latest_raw_frame(self, frame):
-        """Set the latest raw frame, and update the preview widget if any."""
-        with self._latest_frame_update_condition:
-            self._latest_raw_frame = frame
-            self._frame_counter += 1
-            self._latest_frame_update_condition.notify_all()
+        """Set the latest raw frame, and update the preview widget if any.
+        
+        The frame is also added to `frame_buffer` (if it was written straight 
+        into the buffer, see `raw_snapshot_into`, it isn't copied)."""
+        self._latest_raw_frame = frame
+        if frame is not None:
+            self.frame_buffer.push(frame)
         
         # TODO: use the NotifiedProperty to do this with less code?
         self.update_widgets()
 
+    _preview_worker = None
     def update_widgets(self):
-        """Iterates over the preview widgets and updates them. It's a good method to override in subclasses"""
-        if self._preview_widgets is not None:
-            for w in self._preview_widgets:
-                try:
-                    w.update_image(self.latest_frame)
-                except Exception as e:
-                    print "something went wrong updating the preview widget"
-                    print e
+        """Iterates over the preview widgets and updates them. It's a good method to override in subclasses
+        
+        This returns immediately: the widgets are updated by a `PreviewWorker`
+        thread, which applies `filter_function` and downsamples the frame to
+        the size of each widget, at most `preview_max_rate` times per second."""
+        if not self._preview_widgets or self.latest_raw_frame is None:
+            return
+        if self._preview_worker is None or not self._preview_worker.running:
+            self._preview_worker = PreviewWorker(self, self.preview_max_rate)
+        self._preview_worker.submit(self.latest_raw_frame)
 
     @property
     def latest_frame(self):
-        """The last frame acquired (in live view/from GUI), after filtering."""
+        """The last frame acquired (in live view/from GUI), after filtering.
+        
+        This is a copy, because `latest_raw_frame` may be a slot in 
+        `frame_buffer` that live view overwrites while it's being filtered."""
+        frame = self.latest_raw_frame
+        if frame is None:
+            return None
+        frame = np.copy(frame)
         if self.filter_function is not None:
-            return self.filter_function(self.latest_raw_frame)
+            return self.filter_function(frame)
         else:
-            return self.latest_raw_frame
+            return frame
     
     
     def update_latest_frame(self, frame=None):
@@ -267,7 +340,8 @@ class Camera(Instrument):
         acquired.
         
         Unless you need the filtered image, you should probably use 
-        raw_image, color_image or gray_image.
+        raw_image, color_image or gray_image.  NB the filter is applied here,
+        on the calling thread, so live view doesn't use this method.
         """
         if frame is None: 
             frame = self.color_image()
@@ -292,22 +366,43 @@ class Camera(Instrument):
         If you need more sophisticated control, I suggest subclassing
         `CameraParameter`, though I can't currently see how that would help...
         """
-        # first, identify all the CameraParameter properties we've got
-        p_list = []
-        for p in dir(self.__class__):
-            try:
-                if isinstance(getattr(self.__class__, p), CameraParameter):
-                    getattr(self,p)
-                    p_list.append(p)
-            except:
+        # The parameters are listed from the class, without reading them from
+        # the camera - see available_camera_parameter_names for that.
+        return [p for p in dir(self.__class__)
+                if isinstance(getattr(self.__class__, p, None), CameraParameter)]
+
+    _available_parameter_names = None
+    def available_camera_parameter_names(self):
+        """Return the names of the parameters this particular camera supports.
+        
+        Not every camera in a family supports every `CameraParameter`, so the 
+        first time this is called each parameter is read (through the property
+        cache, if it's enabled), and those that fail are left out.  The result 
+        is remembered, so the hardware is only probed once, and not until a 
+        parameter table or metadata needs it.
+        """
+        if self._available_parameter_names is None:
+            available = []
+            for p in self.camera_parameter_names():
                 try:
-                    delattr(self.__class__,p)
-                except:
+                    getattr(self, p)
+                    available.append(p)
+                except Exception:
                     pass
-                pass
-        return p_list
-   #     return [p for p in dir(self.__class__)
-    #              if isinstance(getattr(self.__class__, p), CameraParameter)]
+            self._available_parameter_names = available
+        return list(self._available_parameter_names)
+    
+    def get_metadata(self, property_names=[], include_default_names=True, exclude=None):
+        """A dictionary of settings, properties, etc. to save along with data.
+        
+        This is `Instrument.get_metadata`, leaving out any camera parameters
+        that this camera doesn't support."""
+        available = self.available_camera_parameter_names()
+        unsupported = [p for p in self.camera_parameter_names() if p not in available]
+        exclude = list(exclude or []) + unsupported
+        return super(Camera, self).get_metadata(property_names, include_default_names, exclude)
+
+    metadata = property(get_metadata)
     
     def get_camera_parameter(self, parameter_name):
         """Return the named property from the camera"""
@@ -334,7 +429,6 @@ class Camera(Instrument):
                 return # do nothing if it's going already.
             print "starting live view thread"
             try:
-                self._frame_counter = 0
                 self._live_view_stop_event = threading.Event()
                 self._live_view_thread = threading.Thread(target=self._live_view_function)
                 self._live_view_thread.start()
@@ -358,10 +452,30 @@ class Camera(Instrument):
         Loop until the event tells us to stop, constantly taking snapshots.
         Ideally you should override live_view to start and stop streaming
         from the camera, using a callback function to update latest_raw_frame.
+        
+        If the camera implements `raw_snapshot_into`, frames after the first 
+        are written straight into `frame_buffer`, so no memory is allocated.
         """
-        while not self._live_view_stop_event.wait(timeout=0.1):
-            success, frame = self.raw_snapshot()
-            self.update_latest_frame(frame)
+        write_into_buffer = (type(self).raw_snapshot_into.__func__ 
+                             is not Camera.raw_snapshot_into.__func__)
+        while not self._live_view_stop_event.wait(timeout=self.live_view_interval):
+            if write_into_buffer and self.frame_buffer.frame_shape is not None:
+                frame = self.frame_buffer.claim_slot()
+                try:
+                    success = self.raw_snapshot_into(frame)
+                except:
+                    self.frame_buffer.cancel()
+                    raise
+                if not success:
+                    self.frame_buffer.cancel()
+                    continue
+            else:
+                success, frame = self.raw_snapshot()
+                if frame is None:
+                    continue
+            # store the raw frame only: filter_function is applied by the
+            # preview worker, not on this thread (see update_widgets)
+            self.latest_raw_frame = frame
             
     legacy_click_callback = None
     def set_legacy_click_callback(self, function):
@@ -482,12 +596,8 @@ class CameraParametersTableModel(QtCore.QAbstractTableModel):
     def __init__(self, camera, parent=None):
         super(CameraParametersTableModel, self).__init__(parent)
         self.camera = camera
-        self.parameter_names = self.camera.camera_parameter_names()
-        for parameter_name in self.parameter_names[:]:   #Added to prevent properties the camera does not posses from trying to appear in the list of parameters
-            try:
-                getattr(self.camera, parameter_name)
-            except:
-                self.parameter_names.remove(parameter_name)
+        # only show the parameters this camera has (it's probed once, see available_camera_parameter_names)
+        self.parameter_names = self.camera.available_camera_parameter_names()
         
         # Here, we register to get a callback if any of the parameters change
         # so that we stay in sync with the camera.
@@ -594,8 +704,20 @@ class PreviewImageItem(pg.ImageItem):
     
 
 class CameraPreviewWidget(pg.GraphicsView):
-    """A Qt Widget to display the live feed from a camera."""
-    update_data_signal = QtCore.Signal(np.ndarray)
+    """A Qt Widget to display the live feed from a camera.
+    
+    Frames are downsampled to roughly the size of the widget before they are
+    displayed (see `nplab.instrument.camera.preview`), but the image is still
+    drawn in sensor pixel coordinates, so the crosshair and click callbacks 
+    don't depend on the widget size.  Set `downsample_method` to "bin" to 
+    average blocks of pixels rather than just taking every nth pixel.
+    
+    Images are displayed with fixed black/white `levels`: if they're not set,
+    they're worked out from the first frame (and again if the frame size or
+    type changes, or after `reset_levels()`).
+    """
+    update_data_signal = QtCore.Signal(np.ndarray, object)
+    downsample_method = 'stride'
     
     def __init__(self):
         super(CameraPreviewWidget, self).__init__()
@@ -610,35 +732,62 @@ class CameraPreviewWidget(pg.GraphicsView):
         for item in self.crosshair.values():
             self.view_box.addItem(item)
         self._image_shape = ()
+        self._image_dtype = None
+        self.levels = None
+        self.update_pending = False
+        self._display_shape = None
 
         # We want to make sure we always update the data in the GUI thread.
         # This is done using the signal/slot mechanism
         self.update_data_signal.connect(self.update_widget, type=QtCore.Qt.QueuedConnection)
 
-    def update_widget(self, newimage):
-        """Set the image, but do so in the Qt main loop to avoid threading nasties."""
-        # I've explicitly dealt with the datatype of the source image, to avoid
-        # a bug in the way pyqtgraph interacts with numpy 1.10.  This means
-        # scaling the display values will fail for integer data.  I've thus
-        # forced floating-point for anything that isn't a u8, and assumed u8
-        # wants to be displayed raw.  You can always use filter_function to
-        # tweak the brightness/contrast.
+    def resizeEvent(self, ev):
+        """Keep track of our size (in screen pixels) so we can downsample frames to match."""
+        super(CameraPreviewWidget, self).resizeEvent(ev)
+        self._display_shape = (self.height(), self.width())
+
+    def downsample(self, frame):
+        """Shrink a frame to roughly the size of this widget.
+        
+        This is called from the preview worker thread, not the GUI thread."""
+        factor = decimation_factor(frame.shape, self._display_shape)
+        return downsample(frame, factor, self.downsample_method)
+
+    def reset_levels(self):
+        """Work out the display levels again from the next frame."""
+        self.levels = None
+
+    def update_widget(self, newimage, full_shape=None):
+        """Set the image, but do so in the Qt main loop to avoid threading nasties.
+        
+        full_shape is the (rows, columns) of the frame before it was
+        downsampled: the image is scaled up to that size.  The image is 
+        displayed in its native data type with fixed levels, as autoscaling
+        every frame is slow."""
+        self.update_pending = False
+        if full_shape is None:
+            full_shape = newimage.shape[:2]
+        if self.levels is None or newimage.dtype != self._image_dtype:
+            self.levels = display_levels(newimage)
+            self._image_dtype = newimage.dtype
+        # pyqtgraph wants (x, y) indexing - transposing gives a view, not a copy
         if len(newimage.shape)==2:
             newimage = newimage.transpose()
         elif len(newimage.shape)==3:
             newimage = newimage.transpose((1,0,2))
-        if newimage.dtype =="uint8":
-            self.image_item.setImage(newimage, autoLevels=False)
-        else:
-            self.image_item.setImage(newimage.astype(float))
-        if newimage.shape != self._image_shape:
-            self._image_shape = newimage.shape
-            self.set_crosshair_centre((newimage.shape[1]/2.0, newimage.shape[0]/2.0))
-    def update_image(self, newimage):
-        """Update the image displayed in the preview widget."""
-        # NB compared to previous versions, pyqtgraph flips in y, hence the
-        # funny slice on the next line.
-        self.update_data_signal.emit(newimage)
+        self.image_item.setImage(newimage, autoLevels=False, levels=self.levels)
+        # scale the image so its coordinates are sensor pixels, however much it was downsampled
+        self.image_item.setRect(QtCore.QRectF(0, 0, full_shape[1], full_shape[0]))
+        if tuple(full_shape) != self._image_shape:
+            self._image_shape = tuple(full_shape)
+            self.set_crosshair_centre((full_shape[0]/2.0, full_shape[1]/2.0))
+    def update_image(self, newimage, full_shape=None):
+        """Update the image displayed in the preview widget.
+        
+        This may be called from any thread: the image is displayed by the GUI
+        thread."""
+        self.update_pending = True
+        self.update_data_signal.emit(newimage, full_shape)
         
     def add_legacy_click_callback(self, function):
         """Add an old-style (coordinates in fractions-of-an-image) callback."""
@@ -656,9 +805,18 @@ class DummyCamera(Camera):
     def __init__(self):
         super(DummyCamera, self).__init__()
         self._camera_parameters = {'exposure':40, 'gain':1}
+        self._noise_frames = None
+        self._noise_index = 0
     def raw_snapshot(self):
         ran = np.random.random((100,100,3))
         return True, (ran * 255.9).astype(np.uint8)
+    def raw_snapshot_into(self, frame):
+        # cycle through some pre-generated frames, so we can test live view at high frame rates
+        if self._noise_frames is None or self._noise_frames.shape[1:] != frame.shape:
+            self._noise_frames = (np.random.random((8,) + frame.shape) * 255.9).astype(frame.dtype)
+        self._noise_index = (self._noise_index + 1) % self._noise_frames.shape[0]
+        frame[...] = self._noise_frames[self._noise_index]
+        return True
     def get_camera_parameter(self, name):
         return self._camera_parameters[name]
     def set_camera_parameter(self, name, value):
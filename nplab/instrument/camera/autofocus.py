@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Autofocus strategies
+====================
+
+`CameraWithLocation.autofocus` moves to a fixed list of Z positions, and measures the sharpness of a full image at
+each one.  That's robust, but slow.  This module provides alternative strategies, which can be run with
+`CameraWithLocation.run_autofocus`:
+
+`GoldenSectionAutofocus`
+    A coarse sweep to find roughly where the focus is, followed by a golden-section search and a parabolic fit, which
+    needs far fewer images to reach a given precision.
+`ContinuousAutofocus`
+    Moves the stage through the focus without stopping, taking images as it goes, so no time is spent settling.  This
+    needs a stage that can report its position while moving (see `Stage.move_async`).
+
+Each strategy returns an `AutofocusResult`, which records how many frames were acquired and how long it took, so that
+strategies can be compared (see `compare_autofocus_strategies`).
+
+The merit functions here work on the image as a numpy array, and `roi_merit` will restrict any merit function to part
+of the image and/or downsample it first, which often speeds things up a lot without affecting the result.
+"""
+
+import time
+import numpy as np
+
+
+####### Merit functions #######
+def _as_gray(image):
+    """Convert an image to a floating-point grayscale array."""
+    image = np.asarray(image, dtype=np.float32)
+    if len(image.shape) == 3:
+        image = np.mean(image, axis=2)
+    assert len(image.shape) == 2, "The image is the wrong shape - must be 2D or 3D"
+    return image
+
+
+def af_merit_laplacian_variance(image):
+    """Return the variance of the Laplacian of an image - a sharpness metric that ignores brightness offsets."""
+    image = _as_gray(image)
+    laplacian = (image[:-2, 1:-1] + image[2:, 1:-1] + image[1:-1, :-2] + image[1:-1, 2:] - 4 * image[1:-1, 1:-1])
+    return np.var(laplacian)
+
+
+def af_merit_brenner(image):
+    """Return the Brenner gradient of an image: the sum of squared differences between pixels two apart."""
+    image = _as_gray(image)
+    return np.sum((image[2:, :] - image[:-2, :]) ** 2) + np.sum((image[:, 2:] - image[:, :-2]) ** 2)
+
+
+def af_merit_fft_band(image, low=0.05, high=0.25):
+    """Return the power in a band of spatial frequencies (in cycles per pixel, so 0.5 is the highest).
+
+    Ignoring the highest frequencies makes this less sensitive to noise than gradient-based metrics, and ignoring the
+    lowest makes it insensitive to changes in illumination."""
+    image = _as_gray(image)
+    power = np.abs(np.fft.rfft2(image - np.mean(image))) ** 2
+    fy = np.fft.fftfreq(image.shape[0])[:, np.newaxis]
+    fx = np.fft.rfftfreq(image.shape[1])[np.newaxis, :]
+    frequency = np.sqrt(fx ** 2 + fy ** 2)
+    return np.sum(power[(frequency >= low) & (frequency <= high)])
+
+
+def roi_merit(merit_function, roi=0.5, downsample=1):
+    """Make a merit function that only looks at part of the image, optionally downsampled.
+
+    roi : float or tuple
+        Either the fraction of the image (in each direction) to use, centred on the middle of the image, or a tuple of
+        pixel coordinates (row_start, row_stop, column_start, column_stop).
+    downsample : int
+        Use only every `downsample`th row and column of the region of interest.
+    """
+    def merit(image):
+        if np.isscalar(roi):
+            margin = (1 - roi) / 2.0
+            rows, cols = image.shape[:2]
+            region = image[int(rows * margin):int(rows * (1 - margin)), int(cols * margin):int(cols * (1 - margin))]
+        else:
+            region = image[roi[0]:roi[1], roi[2]:roi[3]]
+        return merit_function(np.asarray(region)[::downsample, ::downsample, ...])
+    merit.__name__ = "{0}_roi".format(getattr(merit_function, '__name__', 'merit'))
+    return merit
+
+
+####### Strategies #######
+class AutofocusResult(object):
+    """The outcome of an autofocus: where we ended up, what we measured, and what it cost.
+
+    Attributes:
+    position : numpy.ndarray
+        The stage position we moved to at the end.
+    shift : float
+        How far we moved in Z, compared to where we started.
+    positions, merits : numpy.ndarray
+        The stage positions where images were taken, and their focus scores.
+    frames : int
+        The number of frames acquired from the camera (including any that were discarded while settling).
+    elapsed : float
+        The wall-clock time taken, in seconds.
+    """
+    def __init__(self, strategy, position, shift, positions, merits, frames, elapsed):
+        self.strategy = strategy
+        self.position = position
+        self.shift = shift
+        self.positions = positions
+        self.merits = merits
+        self.frames = frames
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return "<AutofocusResult ({0}): moved {1:.3g} in Z using {2} frames in {3:.3g}s>".format(
+            self.strategy, self.shift, self.frames, self.elapsed)
+
+
+class AutofocusStrategy(object):
+    """Base class for autofocus strategies.
+
+    Subclasses should override `focus`, which is called with an `AutofocusSession` and returns the best Z position
+    it found (or None to return to the starting position).  The session takes care of moving the stage, acquiring
+    images and keeping count of the frames used.
+    """
+    def focus(self, session):
+        raise NotImplementedError("You must override focus() in an AutofocusStrategy subclass")
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+    def run(self, cwl, merit_function, update_progress=lambda p: p):
+        """Focus the CameraWithLocation `cwl`, and return an `AutofocusResult`."""
+        session = AutofocusSession(cwl, merit_function, update_progress)
+        camera_live_view = cwl.camera.live_view
+        if cwl.disable_live_view:
+            cwl.camera.live_view = False
+        try:
+            best_z = self.focus(session)
+        finally:
+            cwl.camera.live_view = camera_live_view
+        return session.finish(best_z, str(self))
+
+
+class AutofocusSession(object):
+    """Moves the stage and measures focus on behalf of an `AutofocusStrategy`, keeping track of what it costs."""
+    def __init__(self, cwl, merit_function, update_progress=lambda p: p):
+        self.cwl = cwl
+        self.merit_function = merit_function
+        self.update_progress = update_progress
+        self.start_time = time.time()
+        self.initial_position = np.array(cwl.stage.position, dtype=np.float)
+        self.positions = []
+        self.merits = []
+        self.frames = 0
+
+    @property
+    def z(self):
+        """The Z position we started at."""
+        return self.initial_position[2]
+
+    def position_at(self, z):
+        """The stage position with the starting X and Y, and the given Z."""
+        position = self.initial_position.copy()
+        position[2] = z
+        return position
+
+    def acquire(self):
+        """Take an image and return its focus score (without moving or settling first)."""
+        image = self.cwl.color_image()
+        self.frames += 1
+        return self.merit_function(image)
+
+    def measure(self, z):
+        """Move to a given Z position, wait for the stage to settle, and return the focus score there."""
+        self.cwl.move(self.position_at(z))
+        self.cwl.settle()
+        self.frames += self.cwl.frames_to_discard
+        merit = self.acquire()
+        self.positions.append(np.array(self.cwl.stage.position, dtype=np.float))
+        self.merits.append(merit)
+        self.update_progress(len(self.merits))
+        return merit
+
+    def finish(self, best_z, strategy_name=""):
+        """Move to the best position (or back to the start if it's None) and summarise what happened."""
+        final_position = self.initial_position if best_z is None else self.position_at(best_z)
+        self.cwl.move(final_position)
+        return AutofocusResult(strategy_name, final_position, final_position[2] - self.z,
+                               np.array(self.positions), np.array(self.merits), self.frames,
+                               time.time() - self.start_time)
+
+
+def parabola_peak(z, merits):
+    """Fit a parabola to focus scores and return the Z position of its peak (or None if there isn't one)."""
+    z = np.asarray(z, dtype=np.float)
+    if len(np.unique(z)) < 3:
+        return None
+    coefficients = np.polyfit(z, merits, deg=2)
+    if coefficients[0] >= 0:
+        return None  # the parabola has a minimum, not a maximum
+    return -coefficients[1] / (2 * coefficients[0])
+
+
+class GoldenSectionAutofocus(AutofocusStrategy):
+    """Find the focus with a coarse sweep, then narrow it down with a golden-section search.
+
+    search_range : float
+        The coarse sweep covers this distance either side of the starting position.
+    coarse_steps : int
+        The number of positions in the coarse sweep.
+    tolerance : float
+        The golden-section search stops once the focus is bracketed to within this distance; a parabola is then
+        fitted to the best points to estimate the focus (a little) more precisely.
+
+    NB this visits positions in both directions, so stages with significant backlash should correct for it.
+    """
+    def __init__(self, search_range=5, coarse_steps=5, tolerance=0.1):
+        self.search_range = search_range
+        self.coarse_steps = coarse_steps
+        self.tolerance = tolerance
+
+    def __repr__(self):
+        return "GoldenSectionAutofocus(search_range={0}, coarse_steps={1}, tolerance={2})".format(
+            self.search_range, self.coarse_steps, self.tolerance)
+
+    def focus(self, session):
+        zs = session.z + np.linspace(-self.search_range, self.search_range, self.coarse_steps)
+        merits = [session.measure(z) for z in zs]
+        best = int(np.argmax(merits))
+        if best == 0 or best == len(zs) - 1:
+            session.cwl.log("Autofocus: the best focus was at the edge of the search range.", level='WARN')
+        a, b = zs[max(best - 1, 0)], zs[min(best + 1, len(zs) - 1)]
+        ratio = (np.sqrt(5) - 1) / 2
+        c, d = b - ratio * (b - a), a + ratio * (b - a)
+        fc, fd = session.measure(c), session.measure(d)
+        while b - a > self.tolerance:
+            if fc > fd:
+                b, d, fd = d, c, fc
+                c = b - ratio * (b - a)
+                fc = session.measure(c)
+            else:
+                a, c, fc = c, d, fd
+                d = a + ratio * (b - a)
+                fd = session.measure(d)
+        # Fit a parabola through the best three points we've measured, and use it if it peaks in the bracket
+        z_measured = np.array([p[2] for p in session.positions])
+        top = np.argsort(session.merits)[-3:]
+        peak = parabola_peak(z_measured[top], np.array(session.merits)[top])
+        if peak is not None and a <= peak <= b:
+            return peak
+        return c if fc > fd else d
+
+
+class ContinuousAutofocus(AutofocusStrategy):
+    """Sweep through the focus without stopping, taking images as the stage moves.
+
+    The stage moves to `search_range` below the starting position, then (using `Stage.move_async`) to the same
+    distance above it, and images are acquired until it stops.  The Z position of each image is taken as the average
+    of the positions read before and after acquiring it, and a parabola is fitted to the points around the best one.
+    This is only useful if the stage reports its position while it's moving, and moves slowly enough to get a few
+    frames across the focus.
+    """
+    def __init__(self, search_range=5, fit_points=5):
+        self.search_range = search_range
+        self.fit_points = fit_points
+
+    def __repr__(self):
+        return "ContinuousAutofocus(search_range={0})".format(self.search_range)
+
+    def focus(self, session):
+        cwl = session.cwl
+        cwl.move(session.position_at(session.z - self.search_range))
+        cwl.settle()
+        session.frames += cwl.frames_to_discard
+        move = cwl.stage.move_async(session.position_at(session.z + self.search_range))
+        while not move.done():
+            before = cwl.stage.position[2]
+            merit = session.acquire()
+            position = np.array(cwl.stage.position, dtype=np.float)
+            position[2] = (position[2] + before) / 2.0
+            session.positions.append(position)
+            session.merits.append(merit)
+            session.update_progress(len(session.merits))
+        move.result()
+        if len(session.merits) == 0:
+            return None
+        z = np.array([p[2] for p in session.positions])
+        merits = np.array(session.merits)
+        best = int(np.argmax(merits))
+        near_best = slice(max(best - self.fit_points // 2, 0), best + self.fit_points // 2 + 1)
+        peak = parabola_peak(z[near_best], merits[near_best])
+        if peak is not None and z[near_best].min() <= peak <= z[near_best].max():
+            return peak
+        return z[best]
+
+
+def compare_autofocus_strategies(cwl, strategies, merit_function=af_merit_laplacian_variance, focus_z=None,
+                                 defocus=(-2, 2), tolerance=None):
+    """Run several autofocus strategies from a few starting points, and report how fast and accurate they are.
+
+    cwl : CameraWithLocation
+        The camera and stage to use.
+    strategies : list of AutofocusStrategy
+        The strategies to compare.  Any of them may be given as a tuple of (strategy, merit function), to use a
+        different merit function from `merit_function` - this lets you compare merit functions too.
+    focus_z : float (optional)
+        The true focus position.  By default, it's the current Z position (so you should focus carefully first).
+    defocus : list of float
+        Each strategy is started this far away from the focus.
+    tolerance : float (optional)
+        If given, results are marked with whether the error was always smaller than this.
+
+    Returns a list of dictionaries (one per strategy), with the mean number of frames and time taken, and the worst
+    error, sorted so the quickest is first.  The stage is returned to the focus afterwards.
+    """
+    if focus_z is None:
+        focus_z = cwl.stage.position[2]
+    focus_position = np.array(cwl.stage.position, dtype=np.float)
+    focus_position[2] = focus_z
+    summary = []
+    for entry in strategies:
+        strategy, merit = entry if isinstance(entry, tuple) else (entry, merit_function)
+        results = []
+        for dz in defocus:
+            start = focus_position.copy()
+            start[2] += dz
+            cwl.move(start)
+            results.append(strategy.run(cwl, merit))
+        errors = [abs(r.position[2] - focus_z) for r in results]
+        row = {'strategy': str(strategy),
+               'merit_function': getattr(merit, '__name__', str(merit)),
+               'frames': np.mean([r.frames for r in results]),
+               'elapsed': np.mean([r.elapsed for r in results]),
+               'max_error': max(errors),
+               'results': results}
+        if tolerance is not None:
+            row['meets_tolerance'] = row['max_error'] <= tolerance
+        summary.append(row)
+    cwl.move(focus_position)
+    return sorted(summary, key=lambda row: row['elapsed'])
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration cache
+=================
+
+Calibrating the relationship between camera pixels and stage position means acquiring a grid of images and fitting
+a matrix, which can take minutes.  The answer doesn't change unless the hardware does, so a `CalibrationCache` keeps
+every calibration as a record in an HDF5 group (usually in the instrument's config file), tagged with the hardware
+configuration it was made with (objective, camera binning, stage, and so on).  When an instrument starts up, it can
+load the most recent record that matches its current configuration, and check it's still good with a couple of
+moves (see `calibration_error`) rather than recalibrating from scratch.
+
+Each record is a dataset holding the calibration matrix.  Its attributes are the hardware configuration, the
+residuals of the fit, the format version (`CALIBRATION_FORMAT_VERSION`) and the usual creation timestamp.
+"""
+
+import numpy as np
+
+CALIBRATION_FORMAT_VERSION = 1
+
+
+def _attr_string(value):
+    """Convert a hardware configuration value to the string we compare it by.
+
+    Values are compared as strings, so that e.g. a binning of ``(2, 2)`` matches the same binning read back from
+    the HDF5 file as an array."""
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    return str(value)
+
+
+class CalibrationCache(object):
+    """A versioned store of calibration matrices, keyed by hardware configuration.
+
+    Arguments:
+    group : nplab.datafile.Group
+        The HDF5 group in which to keep the records.
+    """
+    def __init__(self, group):
+        self.group = group
+
+    def save(self, matrix, hardware, residuals=None, attrs=None):
+        """Store a new calibration, and return the dataset it's stored in.
+
+        Arguments:
+        matrix : np.ndarray
+            The calibration matrix.
+        hardware : dict
+            The hardware configuration the calibration applies to, e.g. ``{'objective': '100x', 'binning': 1}``.
+        residuals : float (optional)
+            How well the calibration fitted the data (e.g. the RMS fractional error).
+        attrs : dict (optional)
+            Any other metadata to save with the calibration (e.g. the measured shifts).
+        """
+        record_attrs = dict(attrs or {})
+        record_attrs.update(dict(("hardware_" + k, _attr_string(v)) for k, v in hardware.items()))
+        record_attrs['hardware_keys'] = _attr_string(sorted(hardware.keys()))
+        record_attrs['calibration_version'] = CALIBRATION_FORMAT_VERSION
+        if residuals is not None:
+            record_attrs['residuals'] = residuals
+        record = self.group.create_dataset("calibration_%d", data=np.asarray(matrix), attrs=record_attrs)
+        self.group.file.flush()
+        return record
+
+    def matches(self, record, hardware):
+        """Whether a record was made with the given hardware configuration (and can be read by this version)."""
+        attrs = record.attrs
+        if attrs.get('calibration_version', None) != CALIBRATION_FORMAT_VERSION:
+            return False
+        if attrs.get('hardware_keys', None) != _attr_string(sorted(hardware.keys())):
+            return False
+        return all(attrs.get("hardware_" + k, None) == _attr_string(v) for k, v in hardware.items())
+
+    def records(self, hardware=None):
+        """Return the stored calibrations (optionally only those matching `hardware`), newest first."""
+        records = self.group.numbered_items("calibration")
+        if hardware is not None:
+            records = [r for r in records if self.matches(r, hardware)]
+        return records[::-1]
+
+    def latest(self, hardware):
+        """Return the most recent calibration made with the given hardware configuration, or None."""
+        records = self.records(hardware)
+        return records[0] if len(records) > 0 else None
+
+
+def calibration_error(pixel_shifts, location_shifts, pixel_to_sample):
+    """Compare measured shifts to those predicted by a calibration, and return the fractional error.
+
+    Arguments:
+    pixel_shifts : np.ndarray
+        Nx2 array of the shifts seen in the image, in pixels.
+    location_shifts : np.ndarray
+        Nx2 array of the corresponding moves of the stage.
+    pixel_to_sample : np.ndarray
+        The (2x2 or larger) matrix converting pixel shifts to stage shifts, so that
+        ``np.dot(pixel_shifts, pixel_to_sample[:2, :2]) == location_shifts`` if the calibration is perfect.
+
+    The result is the RMS difference between predicted and actual stage shifts, divided by the RMS stage shift.  A
+    couple of moves are enough to check a calibration this way, which is much quicker than redoing it.
+    """
+    pixel_shifts = np.asarray(pixel_shifts, dtype=np.float)[:, :2]
+    location_shifts = np.asarray(location_shifts, dtype=np.float)[:, :2]
+    predicted = np.dot(pixel_shifts, np.asarray(pixel_to_sample)[:2, :2])
+    return np.sqrt(np.mean((predicted - location_shifts) ** 2) / np.mean(location_shifts ** 2))
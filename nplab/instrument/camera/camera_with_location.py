@@ -21,6 +21,11 @@ from nplab.instrument.stage import Stage
 from nplab.instrument import Instrument
 import numpy as np
 from nplab.utils.image_with_location import ImageWithLocation, ensure_3d, ensure_2d, locate_feature_in_image, datum_pixel
+from nplab.utils.mosaic import Mosaic
+from nplab.instrument.camera.drift_tracker import DriftTracker
+from nplab.instrument.camera.calibration_cache import CalibrationCache, calibration_error
+from nplab.instrument.camera.autofocus import (GoldenSectionAutofocus, af_merit_laplacian_variance, roi_merit,
+                                               compare_autofocus_strategies)
 from nplab.experiment import Experiment, ExperimentStopped
 from nplab.experiment.gui import ExperimentWithProgressBar, run_function_modally
 from nplab.utils.gui import QtCore, QtGui, QtWidgets
@@ -29,7 +34,7 @@ import cv2
 from scipy import ndimage
 from scipy.signal import argrelextrema
 from nplab.ui.ui_tools import QuickControlBox, UiTools
-from nplab.utils.notified_property import DumbNotifiedProperty
+from nplab.utils.notified_property import DumbNotifiedProperty, NotifiedProperty
 import time
 
 # Autofocus merit functions
@@ -57,9 +62,12 @@ class CameraWithLocation(Instrument):
     datum_pixel = None # The position, in pixels in the image, of the "datum point" of the system.
     settling_time = 0.0 # How long to wait for the stage to stop vibrating.
     frames_to_discard = 1 # How many frames to discard from the camera after a move.
+    flush_while_settling = False # Discard frames during settling_time, rather than after it (see settle).
     disable_live_view = DumbNotifiedProperty(False) # Whether to disable live view while calibrating/autofocusing/etc.
     af_step_size = DumbNotifiedProperty(1) # The size of steps to take when autofocusing
     af_steps = DumbNotifiedProperty(7) # The number of steps to take during autofocus
+    _objective = ""
+    _initialised = False
 
     def __init__(self, camera=None, stage=None):
         # If no camera or stage is supplied, attempt to retrieve them - but crash with an exception if they don't exist.
@@ -74,9 +82,24 @@ class CameraWithLocation(Instrument):
 
         shape = self.camera.color_image().shape
         self.datum_pixel = np.array(shape[:2])/2.0 # Default to using the centre of the image as the datum point
+        self._initialised = True
+        self._auto_load_calibration()
    #     self.camera.set_legacy_click_callback(self.move_to_feature_pixel)
         self.camera.set_legacy_click_callback(self.move_to_pixel)
 
+    @NotifiedProperty
+    def objective(self):
+        """The objective in use - calibrations are stored separately for each one.
+
+        Changing it loads the stored calibration for the new objective, if there is one."""
+        return self._objective
+    @objective.setter
+    def objective(self, objective):
+        changed = objective != self._objective
+        self._objective = objective
+        if changed and self._initialised:
+            self._auto_load_calibration()
+
     @property
     def pixel_to_sample_matrix(self):
         here = self.datum_location
@@ -159,10 +182,21 @@ class CameraWithLocation(Instrument):
         After moving the stage, to get a fresh image from the camera we usually need to both wait for the stage to stop
         vibrating, and discard one or more frames from the camera, so we have a fresh one.  This function does both of
         those things (except if flush_camera is False).
+
+        By default we wait for settling_time first, then discard the frames, so
+        the next frame is exposed after the stage has settled.  If
+        flush_while_settling is True, the frames are discarded while we wait,
+        so the delay is the longer of the two rather than their sum.  Only do
+        this if the camera exposes a new frame when asked for one: a camera that
+        buffers frames may then return one exposed while the stage vibrated.
         """
-        time.sleep(self.settling_time)
-        for i in range(self.frames_to_discard):
-            self.camera.raw_image(*args, **kwargs)
+        settled_time = time.time() + self.settling_time
+        if not self.flush_while_settling:
+            time.sleep(self.settling_time)
+        if flush_camera:
+            for i in range(self.frames_to_discard):
+                self.camera.raw_image(*args, **kwargs)
+        time.sleep(max(settled_time - time.time(), 0))
 
     def move_to_feature(self, feature, ignore_position=False, ignore_z_pos = False, margin=50, tolerance=0.5, max_iterations = 10):
         """Bring the feature in the supplied image to the centre of the camera
@@ -254,14 +288,19 @@ class CameraWithLocation(Instrument):
         if self.disable_live_view:
             self.camera.live_view = False
 
+        # We start each move as soon as the image has been acquired, so that the merit function is calculated
+        # while the stage moves to the next point.
+        next_move = self.stage.move_async(np.array([0, 0, dz[0]]) + here)
         for step_num, z in enumerate(dz):
-            self.stage.move(np.array([0, 0, z]) + here)
+            next_move.result()
             self.settle()
             positions.append(self.stage.position)
             if use_thumbnail is True:
                 image = self.thumb_image()
             else:
                 image = self.color_image()
+            if step_num + 1 < len(dz):
+                next_move = self.stage.move_async(np.array([0, 0, dz[step_num + 1]]) + here)
             powers.append(merit_function(image))
             update_progress(step_num)
         powers = np.array(powers)
@@ -308,6 +347,35 @@ class CameraWithLocation(Instrument):
         else:
             return shift, pos, powers
 
+    def run_autofocus(self, strategy=None, merit_function=af_merit_laplacian_variance, roi=None, downsample=1,
+                      update_progress=lambda p:p):
+        """Focus using one of the strategies in `nplab.instrument.camera.autofocus`, and return an `AutofocusResult`.
+
+        Arguments:
+        strategy : AutofocusStrategy, optional
+            How to search for the focus.  Defaults to a `GoldenSectionAutofocus` that searches af_steps/2 steps of
+            af_step_size either side of the current position, to a tolerance of 1/10 of a step.
+        merit_function : function, optional
+            A function that takes an image and returns a focus score, which we maximise.
+        roi : float or tuple, optional
+            Only use part of the image to calculate the focus score (see `roi_merit`).
+        downsample : int, optional
+            Only use every nth row and column of the image to calculate the focus score.
+
+        The result records the number of frames and the time taken, so you can compare strategies using
+        `compare_autofocus_strategies`.
+        """
+        if strategy is None:
+            strategy = GoldenSectionAutofocus(search_range=self.af_step_size * (self.af_steps - 1) / 2.0,
+                                              tolerance=self.af_step_size / 10.0)
+        if roi is not None or downsample > 1:
+            merit_function = roi_merit(merit_function, 1 if roi is None else roi, downsample)
+        return strategy.run(self, merit_function, update_progress=update_progress)
+
+    def compare_autofocus_strategies(self, strategies, **kwargs):
+        """Try out several autofocus strategies - see `nplab.instrument.camera.autofocus.compare_autofocus_strategies`"""
+        return compare_autofocus_strategies(self, strategies, **kwargs)
+
     def autofocus_gui(self):
         """Run an autofocus using default parameters, with a GUI progress bar."""
         run_function_modally(self.autofocus, progress_maximum=self.af_steps+1)
@@ -396,10 +464,127 @@ class CameraWithLocation(Instrument):
                                                                    self.pixel_to_sample_displacement))
         update_progress(7)
         self.update_config('pixel_to_sample_displacement',self.pixel_to_sample_displacement)
+        self.calibration_cache.save(self.pixel_to_sample_displacement, self.calibration_hardware(),
+                                    residuals=fractional_error,
+                                    attrs={'location_shifts': location_shifts, 'pixel_shifts': pixel_shifts})
         return self.pixel_to_sample_displacement, location_shifts, pixel_shifts, fractional_error
-    def load_calibration(self):
-        """Acquire a new spectrum and use it as a reference."""
-        self.pixel_to_sample_displacement = self.config_file['pixel_to_sample_displacement'][:]
+
+    ####### Calibration cache #######
+    _calibration_cache = None
+    @property
+    def calibration_cache(self):
+        """The `CalibrationCache` where XY calibrations are kept (by default, in the config file)."""
+        if self._calibration_cache is None:
+            self._calibration_cache = CalibrationCache(self.config_file.require_group("calibrations"))
+        return self._calibration_cache
+
+    @calibration_cache.setter
+    def calibration_cache(self, cache):
+        self._calibration_cache = cache
+
+    def calibration_hardware(self):
+        """Describe the hardware configuration that the XY calibration depends on, as a dictionary."""
+        frame = self.camera.latest_raw_frame
+        if frame is None:
+            frame = self.camera.raw_image()
+        return {'objective': self.objective,
+                'camera': self.camera.__class__.__name__,
+                'binning': getattr(self.camera, 'binning', None),
+                'stage': self.stage.__class__.__name__,
+                'image_shape': frame.shape[:2]}
+
+    def load_calibration(self, fallback=True):
+        """Load the most recent XY calibration for the current hardware, returning its record (or None).
+
+        If there's no matching calibration in `calibration_cache` and `fallback` is True, we fall back to the last
+        calibration saved in the config file (which may have been made with different hardware).
+        """
+        record = self.calibration_cache.latest(self.calibration_hardware())
+        if record is not None:
+            self.pixel_to_sample_displacement = np.array(record)
+            self.log("Loaded XY calibration {0} from {1}".format(record.name, record.attrs['creation_timestamp']))
+        elif fallback and 'pixel_to_sample_displacement' in self.config_file:
+            self.pixel_to_sample_displacement = self.config_file['pixel_to_sample_displacement'][:]
+        return record
+
+    def _auto_load_calibration(self):
+        """Load a stored calibration matching the current hardware, if there is one (called on creation).
+
+        Unlike `load_calibration`, this never uses a calibration made with different hardware: if none matches, the
+        current calibration is kept and a warning is logged."""
+        try:
+            if self.load_calibration(fallback=False) is None:
+                self.log("No stored XY calibration matches the current hardware", level="warn")
+        except Exception as e:
+            self.log("Couldn't load a stored XY calibration: {0}".format(e), level="warn")
+
+    def check_calibration(self, step=None, tolerance=0.05):
+        """Check the XY calibration by moving the stage twice, and return the fractional error.
+
+        Arguments:
+        step : float, optional
+            The distance to move in X and in Y.  By default this is 10% of the field of view.
+        tolerance : float, optional
+            If the error is larger than this, we log a warning.
+
+        This is much quicker than `calibrate_xy`, so it's a good way of checking that a stored calibration is still
+        valid.  See `nplab.instrument.camera.calibration_cache.calibration_error` for how the error is defined.
+        """
+        assert self.pixel_to_sample_displacement is not None, "There's no calibration to check!"
+        self.settle()
+        starting_image = self.color_image()
+        starting_location = self.datum_location
+        w, h = starting_image.shape[:2]
+        template = starting_image[w/4:3*w/4,h/4:3*h/4, ...]
+        if step is None:
+            pixel_size = np.sqrt(np.abs(np.linalg.det(self.pixel_to_sample_displacement[:2, :2])))
+            step = w * 0.1 * pixel_size
+        pixel_shifts = []
+        location_shifts = []
+        for p in [[step, 0, 0], [0, step, 0]]:
+            self.move(starting_location + np.array(p))
+            self.settle()
+            image = self.color_image()
+            pixel_shifts.append(-locate_feature_in_image(image, template) + image.datum_pixel)
+            location_shifts.append(ensure_2d(image.attrs['stage_position'] - starting_location))
+        self.move(starting_location)
+        error = calibration_error(pixel_shifts, location_shifts, self.pixel_to_sample_displacement)
+        if error > tolerance:
+            self.log("The XY calibration is out by {0:.1f}%".format(error * 100), level="warn")
+        return error
+
+    def ensure_calibrated(self, tolerance=0.05, **kwargs):
+        """Load a stored XY calibration if it's still good, and recalibrate if not.
+
+        The stored calibration is checked with `check_calibration`: if the error is less than `tolerance`, we use
+        it; otherwise (or if there's no calibration for the current hardware) we run `calibrate_xy`, passing it
+        any keyword arguments.  Returns True if the stored calibration was used.
+        """
+        if self.load_calibration() is not None and self.check_calibration(tolerance=tolerance) < tolerance:
+            return True
+        self.calibrate_xy(**kwargs)
+        return False
+    ####### Drift tracking #######
+    drift_tracker = None
+    def start_drift_tracking(self, **kwargs):
+        """Start measuring drift in the background, and return the `DriftTracker` that's doing it.
+
+        The current image is used as the reference.  Keyword arguments are passed to `DriftTracker`: in particular
+        pass ``compensate=True`` to move the stage to cancel out drift.  The drift trace is available from
+        ``drift_tracker.drift_trace``, including after tracking has stopped.
+        """
+        self.stop_drift_tracking()
+        self.drift_tracker = DriftTracker(self, **kwargs)
+        self.drift_tracker.start()
+        self.log("Started drift tracking")
+        return self.drift_tracker
+
+    def stop_drift_tracking(self):
+        """Stop measuring drift (if we are)."""
+        if self.drift_tracker is not None and self.drift_tracker.running:
+            self.drift_tracker.stop()
+            self.log("Stopped drift tracking after {0} measurements".format(len(self.drift_tracker.trace)))
+
     def get_qt_ui(self):
         """Create a QWidget that controls the camera.
 
@@ -473,18 +658,24 @@ class CameraWithLocationUI(QtWidgets.QWidget):
 
 
 class AcquireGridOfImages(ExperimentWithProgressBar):
-    """Use a CameraWithLocation to acquire a grid of image tiles that can later be stitched together"""
+    """Use a CameraWithLocation to acquire a grid of image tiles that can later be stitched together
+
+    If `stitch` is True, the tiles are also stitched together as they arrive, in a `Mosaic` saved in a "mosaic" group
+    alongside the tiles (see `nplab.utils.mosaic`)."""
     def __init__(self, camera_with_location=None,completion_function= None, **kwargs):
         super(AcquireGridOfImages, self).__init__(**kwargs)
         self.cwl = camera_with_location
         self.completion_function = completion_function
+        self.mosaic = None
 
     def prepare_to_run(self, n_tiles=None, overlap_pixels = 250,
-                       data_group=None,autofocus = False, *args, **kwargs):
+                       data_group=None,autofocus = False, stitch=False, mosaic_args={}, *args, **kwargs):
         self.autofocus = autofocus
         self.progress_maximum = n_tiles[0] * n_tiles[1]
         self.overlap_pixels = overlap_pixels
         self.dest = self.cwl.create_data_group("tiled_image_%d")  if data_group is None else data_group
+        self.stitch = stitch
+        self.mosaic_args = mosaic_args
 
     def run(self, n_tiles=(1,1), autofocus_args=None):
         """Acquire a grid of images with the specified overlap."""
@@ -497,6 +688,13 @@ class AcquireGridOfImages(ExperimentWithProgressBar):
         dest = self.dest
         x_indices = np.arange(n_tiles[0]) - (n_tiles[0] - 1) / 2.0
         y_indices = np.arange(n_tiles[1]) - (n_tiles[1] - 1) / 2.0
+        self.mosaic = None
+        if self.stitch:
+            # Each tile is centred on the pixel of the centre image we move to, so its corner is datum_pixel before it
+            tile_offsets = [np.array([x_index, y_index]) * scan_step - centre_image.datum_pixel
+                            for y_index in y_indices for x_index in x_indices]
+            self.mosaic = Mosaic.for_tiles(centre_image, tile_offsets, dest=dest.create_group("mosaic"),
+                                           **self.mosaic_args)
         images_acquired = 0
         try:
             for y_index in y_indices:
@@ -509,7 +707,10 @@ class AcquireGridOfImages(ExperimentWithProgressBar):
                     if autofocus_args is not None:
                         cwl.autofocus(**autofocus_args)
                     cwl.settle()  # wait for the camera to be ready/stage to settle
-                    dest.create_dataset("tile_%d",data=cwl.color_image())
+                    image = cwl.color_image()
+                    dest.create_dataset("tile_%d",data=image)
+                    if self.mosaic is not None:
+                        self.mosaic.add_tile(image)
                     dest.file.flush()
                     images_acquired += 1 # TODO: work out why I can't just use dest.count_numbered_items("tile")
                     self.update_progress(images_acquired)
@@ -518,6 +719,9 @@ class AcquireGridOfImages(ExperimentWithProgressBar):
             self.log("Experiment was aborted.")
         finally:
             self.cwl.move(centre_image.datum_location)  # go back to the start point
+            if self.mosaic is not None:
+                self.mosaic.build_pyramid()
+                dest.file.flush()
             if self.completion_function is not None:
                 self.completion_function()
         return dest
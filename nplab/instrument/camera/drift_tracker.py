@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Drift tracking
+==============
+
+Long measurements on a single particle need the sample to stay put, but it never quite does.  A `DriftTracker`
+periodically takes an image from a `CameraWithLocation`, and measures how far the sample has moved since it started
+by FFT phase correlation (see `nplab.utils.image_with_location.phase_correlation`) of a region of interest against a
+reference image.  It keeps a trace of the drift and, if asked, moves the stage to cancel it out.  Corrections are
+limited in size and frequency, so that a bad measurement can't send the stage flying.
+
+Usually you would use `CameraWithLocation.start_drift_tracking()`, which runs the tracker in a background thread.
+"""
+
+import threading
+import time
+import numpy as np
+from nplab.utils.image_with_location import phase_correlation
+
+
+class DriftTracker(object):
+    """Measure (and optionally correct) sample drift, using images from a `CameraWithLocation`.
+
+    Arguments:
+    cwl : CameraWithLocation
+        The camera and stage to use.  It must be calibrated to convert drift to stage units, or to compensate.
+    roi : float or tuple (optional, default 0.5)
+        The region of the image to track: either a fraction of the image (in each direction) centred on the middle,
+        or a tuple of pixel coordinates (row_start, row_stop, column_start, column_stop).  Drift of more than half
+        the size of the region can't be measured unambiguously, so measure often enough to avoid that.
+    interval : float (optional)
+        The time between measurements, in seconds, when running in the background.
+    compensate : bool (optional, default False)
+        Whether to move the stage to cancel out the drift.
+    deadband : float (optional)
+        Don't correct drift smaller than this (in stage units).
+    max_step : float (optional)
+        The largest correction to make in one go (in stage units) - larger drifts are corrected over several steps.
+    max_correction_rate : float (optional)
+        The maximum number of corrections per second (None for no limit).
+    min_correlation : float (optional)
+        Measurements where the phase correlation peak is lower than this are assumed to be unreliable, and ignored.
+    """
+    def __init__(self, cwl, roi=0.5, interval=1.0, compensate=False, deadband=0, max_step=np.infty,
+                 max_correction_rate=0.2, min_correlation=0.1):
+        self.cwl = cwl
+        self.roi = roi
+        self.interval = interval
+        self.compensate = compensate
+        self.deadband = deadband
+        self.max_step = max_step
+        self.max_correction_rate = max_correction_rate
+        self.min_correlation = min_correlation
+        self.reference = None
+        self.total_correction = np.zeros(3)  # the sum of the moves we've made to compensate for drift
+        self.trace = []
+        self._last_correction_time = -np.infty
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def _region(self, image):
+        """Extract the region of interest from an image, as a plain numpy array."""
+        image = np.asarray(image)
+        if np.isscalar(self.roi):
+            margin = (1 - self.roi) / 2.0
+            rows, cols = image.shape[:2]
+            return image[int(rows * margin):int(rows * (1 - margin)), int(cols * margin):int(cols * (1 - margin))]
+        return image[self.roi[0]:self.roi[1], self.roi[2]:self.roi[3]]
+
+    def _acquire(self):
+        """Get an image, from the live view stream if it's running (so we don't interrupt it)."""
+        camera = self.cwl.camera
+        if camera.live_view:
+            return camera.get_next_frame(timeout=max(self.interval, 1) * 10)
+        return self.cwl.color_image()
+
+    def _pixel_to_sample(self, pixel_shift):
+        """Convert a shift in pixels to a displacement in the sample (NaN if the camera isn't calibrated)."""
+        A = self.cwl.pixel_to_sample_displacement
+        if A is None:
+            return np.array([np.nan] * 3)
+        return np.dot(np.array([pixel_shift[0], pixel_shift[1], 0]), A)
+
+    def set_reference(self, image=None):
+        """Use a new reference image (by default, take one now).  The drift trace is cleared."""
+        if image is None:
+            image = self._acquire()
+        self.reference = self._region(image).copy()
+        self.total_correction = np.zeros(3)
+        self.trace = []
+        self._start_time = time.time()
+
+    def measure(self, image=None):
+        """Measure the drift (taking an image if none is given), apply a correction if needed, and return the record.
+
+        The record is a dictionary, which is also appended to `trace`.  It holds the `time` (since the reference was
+        taken), the `pixel_shift` of the image since the last correction, the total `drift` of the sample in stage
+        units (including any drift that's been corrected), the `correction` made (if any), and the height of the
+        correlation `peak`.
+        """
+        if self.reference is None:
+            self.set_reference(image)
+        if image is None:
+            image = self._acquire()
+        pixel_shift, peak = phase_correlation(self.reference, self._region(image))
+        record = {'time': time.time() - self._start_time, 'peak': peak, 'pixel_shift': pixel_shift,
+                  'drift': np.array([np.nan] * 3), 'correction': np.zeros(3), 'reliable': peak >= self.min_correlation}
+        if record['reliable']:
+            residual = self._pixel_to_sample(pixel_shift)
+            record['drift'] = self.total_correction + residual
+            if self.compensate:
+                record['correction'] = self._correct(residual)
+        self.trace.append(record)
+        return record
+
+    def _correct(self, residual):
+        """Move the stage to cancel out some drift, subject to the limits on size and rate of corrections."""
+        distance = np.sqrt(np.sum(residual ** 2))
+        if not np.isfinite(distance) or distance <= self.deadband:
+            return np.zeros(3)
+        now = time.time()
+        if self.max_correction_rate and now - self._last_correction_time < 1.0 / self.max_correction_rate:
+            return np.zeros(3)
+        correction = residual * min(1.0, self.max_step / distance)
+        # As in CameraWithLocation.move_to_feature, moving the stage by the displacement of the image brings it back
+        position = np.array(self.cwl.stage.position, dtype=np.float)
+        position[:3] += correction
+        self.cwl.move(position)
+        self.total_correction += correction
+        self._last_correction_time = now
+        return correction
+
+    @property
+    def drift_trace(self):
+        """The drift measured so far, as a dictionary of arrays (see `measure` for the keys)."""
+        keys = ['time', 'peak', 'pixel_shift', 'drift', 'correction', 'reliable']
+        return dict((k, np.array([record[k] for record in self.trace])) for k in keys)
+
+    ####### Running in the background #######
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Take a reference image, then measure drift every `interval` seconds in a background thread."""
+        if self.running:
+            return
+        self.set_reference()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop measuring drift."""
+        self._stop_event.set()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.measure()
+            except Exception as e:
+                self.cwl.log("Drift tracking failed to measure drift: {0}".format(e), level='WARN')
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Frame ring buffer
+=================
+
+A `FrameRingBuffer` keeps the last N frames from a camera in one preallocated array, so that live
+view doesn't allocate memory for every frame, and so that consumers that are slower than the camera
+can tell which frames they've missed.
+
+Every frame gets a sequence number (0 for the first frame, counting up).  Frames are written by the
+thread acquiring them (usually the live view thread), and any number of other threads can read them
+without taking a lock: each reader checks, after reading a frame, that it wasn't overwritten while
+it was being read.  Writers do share a lock with each other, in case (for example) a snapshot is
+taken from the GUI while live view is running.
+
+Readers can get copies of frames, or views into the buffer (which avoid copying, but are only valid
+until the buffer wraps around - see `FrameRingBuffer.is_valid`).  A `FrameReader` goes through every
+frame in order, counting the frames it has dropped because they were overwritten before it got
+to them.
+"""
+
+import threading
+import time
+import numpy as np
+
+
+class FrameOverwrittenError(IndexError):
+    """The frame requested is no longer in the buffer, because newer frames have replaced it."""
+    pass
+
+
+class FrameRingBuffer(object):
+    """Store the most recent `size` frames, each with a sequence number and timestamp.
+
+    Memory is allocated when the first frame arrives, and again if the shape or dtype of the frames
+    changes (e.g. if the camera's ROI is altered).  Sequence numbers continue across such changes,
+    but the older frames are discarded.
+    """
+    def __init__(self, size=16):
+        self.size = size
+        self._frames = None
+        self._timestamps = np.zeros(size, dtype=np.float64)
+        self._latest_seq = -1  # the last frame to be completely written
+        self._writing_seq = -1  # the frame being written now (or the last one, if we're not writing)
+        self._oldest_seq = 0  # the first frame stored with the current shape
+        self._claimed_slot = None
+        self._write_lock = threading.RLock()
+        self._new_frame_event = threading.Event()
+
+    @property
+    def frame_shape(self):
+        """The shape of the frames in the buffer (None if we've not had any yet)."""
+        return None if self._frames is None else self._frames.shape[1:]
+
+    @property
+    def dtype(self):
+        """The data type of the frames in the buffer (None if we've not had any yet)."""
+        return None if self._frames is None else self._frames.dtype
+
+    @property
+    def latest_seq(self):
+        """The sequence number of the most recent frame, or -1 if there hasn't been one."""
+        return self._latest_seq
+
+    def _allocate(self, shape, dtype):
+        """Make space for frames of the given shape and data type (dropping any we had)."""
+        self._frames = np.zeros((self.size,) + tuple(shape), dtype=dtype)
+        self._oldest_seq = self._latest_seq + 1
+
+    ####### Writing frames #######
+    def claim_slot(self, shape=None, dtype=None):
+        """Return the (writeable) slot where the next frame should go.
+
+        This lets a camera write frames directly into the buffer.  Once the frame is complete, call
+        `commit()` (or `push()` with the slot) to make it available, or `cancel()` if the acquisition
+        failed.  If shape and dtype aren't given, they're the same as the last frame.
+        """
+        self._write_lock.acquire()
+        if self._claimed_slot is not None:
+            self._write_lock.release()
+            raise RuntimeError("A slot has already been claimed - commit or cancel it first.")
+        if shape is None:
+            shape = self.frame_shape
+        if dtype is None:
+            dtype = self.dtype
+        if self._frames is None or self.frame_shape != tuple(shape) or self._frames.dtype != np.dtype(dtype):
+            self._allocate(shape, dtype)
+        # after this, readers treat the frame in this slot as invalid
+        self._writing_seq = self._latest_seq + 1
+        self._claimed_slot = self._frames[self._writing_seq % self.size]
+        return self._claimed_slot
+
+    def commit(self, timestamp=None):
+        """Make the frame in the claimed slot available to readers, and return its sequence number."""
+        if self._claimed_slot is None:
+            raise RuntimeError("There's no claimed slot to commit.")
+        seq = self._writing_seq
+        slot = seq % self.size
+        self._timestamps[slot] = time.time() if timestamp is None else timestamp
+        self._claimed_slot = None
+        self._latest_seq = seq
+        event, self._new_frame_event = self._new_frame_event, threading.Event()
+        self._write_lock.release()
+        event.set()  # wake up anyone waiting for a frame
+        return seq
+
+    def cancel(self):
+        """Release the claimed slot without adding a frame."""
+        if self._claimed_slot is None:
+            return
+        # NB we leave _writing_seq alone: the frame that was in this slot may be half-overwritten,
+        # so it must stay invalid.
+        self._claimed_slot = None
+        self._write_lock.release()
+
+    def push(self, frame, timestamp=None):
+        """Add a frame to the buffer (copying it in, unless it's the claimed slot) and return its sequence number."""
+        if self._claimed_slot is not None and frame is self._claimed_slot:
+            return self.commit(timestamp)
+        frame = np.asarray(frame)
+        slot = self.claim_slot(frame.shape, frame.dtype)
+        try:
+            slot[...] = frame
+        except:
+            self.cancel()
+            raise
+        return self.commit(timestamp)
+
+    ####### Reading frames #######
+    @property
+    def oldest_seq(self):
+        """The sequence number of the oldest frame that can still be read."""
+        return max(self._oldest_seq, self._writing_seq - self.size + 1, 0)
+
+    def is_valid(self, seq):
+        """Whether frame `seq` is (still) in the buffer - use this to check views are up to date."""
+        return self.oldest_seq <= seq <= self._latest_seq
+
+    def _check_available(self, seq):
+        if seq > self._latest_seq or seq < 0:
+            raise IndexError("Frame {0} hasn't been acquired yet.".format(seq))
+        if seq < self.oldest_seq:
+            raise FrameOverwrittenError("Frame {0} has been overwritten (the oldest frame in the buffer is {1})."
+                                        .format(seq, self.oldest_seq))
+
+    def get(self, seq=None, copy=True):
+        """Return frame number `seq` (the latest frame, if seq is None).
+
+        If copy is False, this returns a view into the buffer: it's fast, but the contents will change
+        once `size` more frames have arrived.  Check `is_valid(seq)` after using it if that matters.
+        """
+        if seq is None:
+            seq = self._latest_seq
+        self._check_available(seq)
+        frames = self._frames
+        frame = frames[seq % self.size]
+        if copy:
+            frame = frame.copy()
+        # check the slot wasn't overwritten (or reallocated) while we were reading it
+        self._check_available(seq)
+        if frames is not self._frames:
+            raise FrameOverwrittenError("Frame {0} was discarded when the frame shape changed.".format(seq))
+        return frame
+
+    def timestamp(self, seq=None):
+        """Return the time at which frame `seq` (default: the latest) was added."""
+        if seq is None:
+            seq = self._latest_seq
+        self._check_available(seq)
+        return self._timestamps[seq % self.size]
+
+    def last_frames(self, k, copy=True):
+        """Return the last `k` frames (oldest first) and their sequence numbers.
+
+        This is intended for "triggered" saving, i.e. keeping the frames leading up to an event.
+        If copy is True (the default) the frames are returned as a single (k, ...) array.  Otherwise
+        a list of views into the buffer is returned - these will change as new frames arrive.
+        If fewer than `k` frames are available, fewer are returned.
+        """
+        if k > self.size:
+            raise ValueError("Only {0} frames are kept in the buffer.".format(self.size))
+        while True:
+            latest = self._latest_seq
+            seqs = np.arange(max(latest - k + 1, self.oldest_seq), latest + 1)
+            frames = self._frames
+            if frames is None:
+                return np.zeros((0,)), seqs
+            if copy:
+                selected = frames[seqs % self.size]  # fancy indexing makes a copy
+            else:
+                selected = [frames[s % self.size] for s in seqs]
+            if len(seqs) == 0 or (seqs[0] >= self.oldest_seq and frames is self._frames):
+                return selected, seqs
+            # frames were overwritten while we copied them, so try again with the newest ones
+
+    def wait_for(self, seq, timeout=None):
+        """Wait until frame `seq` has arrived.  Returns False if we timed out."""
+        expiry_time = None if timeout is None else time.time() + timeout
+        while True:
+            event = self._new_frame_event  # NB get the event before checking, to avoid a race
+            if self._latest_seq >= seq:
+                return True
+            remaining = None if expiry_time is None else expiry_time - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            event.wait(remaining)
+
+    def reader(self, start=None):
+        """Return a `FrameReader` that starts with frame `start` (by default, the next new frame)."""
+        return FrameReader(self, start)
+
+
+class FrameReader(object):
+    """Read every frame from a `FrameRingBuffer` in turn, keeping count of any that were missed.
+
+    If the reader falls more than one buffer's worth of frames behind, the frames it missed are
+    added to `dropped` and it skips forward to the oldest frame still available.
+    """
+    def __init__(self, frame_buffer, start=None):
+        self.frame_buffer = frame_buffer
+        self.next_seq = frame_buffer.latest_seq + 1 if start is None else start
+        self.last_seq = None  # the sequence number of the frame read most recently
+        self.dropped = 0
+
+    @property
+    def frames_waiting(self):
+        """The number of frames that have arrived but not been read yet."""
+        return max(self.frame_buffer.latest_seq + 1 - self.next_seq, 0)
+
+    def read(self, timeout=None, copy=True):
+        """Wait for the next frame and return it.  Raises an IOError if we time out.
+
+        See `FrameRingBuffer.get` for the meaning of copy.
+        """
+        if not self.frame_buffer.wait_for(self.next_seq, timeout):
+            raise IOError("Timed out waiting for frame {0}.".format(self.next_seq))
+        while True:
+            oldest = self.frame_buffer.oldest_seq
+            if self.next_seq < oldest:
+                self.dropped += oldest - self.next_seq
+                self.next_seq = oldest
+            try:
+                frame = self.frame_buffer.get(self.next_seq, copy=copy)
+                break
+            except FrameOverwrittenError:
+                continue  # it was overwritten as we read it: skip on to the oldest available frame
+        self.last_seq = self.next_seq
+        self.next_seq += 1
+        return frame
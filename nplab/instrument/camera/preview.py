@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Camera preview pipeline
+=======================
+
+Displaying every frame from a fast, high resolution camera at full resolution swamps the GUI
+thread.  This module does the expensive parts of live view in a background thread, so that the
+cost of the preview depends on the number of pixels on the screen rather than on the sensor:
+
+* frames are only sent to the preview widgets at most `max_rate` times per second (frames arriving
+  faster than that are skipped, and a widget that hasn't drawn its last frame yet is skipped too),
+* the camera's `filter_function` is applied in the worker thread, rather than in the thread that
+  acquired the frame (or, worse, the GUI thread), and
+* frames are downsampled to roughly the size of the widget (by taking every nth pixel, or by
+  binning) before they are handed over to Qt, and only the downsampled frame is copied (see `detach`).
+
+The downsampling functions don't depend on Qt, so they can be used (and tested) on their own.
+"""
+
+import threading
+import time
+import weakref
+import numpy as np
+
+
+def decimation_factor(frame_shape, display_shape):
+    """The largest integer factor we can shrink a frame by, while still filling the display.
+
+    frame_shape and display_shape are (rows, columns); any further dimensions (e.g. colour) are
+    ignored.  If the display size isn't known, the factor is 1.
+    """
+    if display_shape is None or min(display_shape[:2]) <= 0:
+        return 1
+    ratio = min(float(frame_shape[0]) / display_shape[0], float(frame_shape[1]) / display_shape[1])
+    return max(int(ratio), 1)
+
+
+def downsample(frame, factor, method='stride'):
+    """Shrink a frame by an integer factor in both directions, keeping its data type.
+
+    method may be "stride", which returns a view of every `factor`th pixel (so nothing is copied),
+    or "bin", which averages blocks of `factor` x `factor` pixels (less noisy, but it touches every
+    pixel).  Any dimensions after the first two (e.g. colour channels) are left alone.
+    """
+    if factor <= 1:
+        return frame
+    if method == 'stride':
+        return frame[::factor, ::factor]
+    elif method == 'bin':
+        rows, cols = frame.shape[0] // factor, frame.shape[1] // factor
+        blocks = frame[:rows * factor, :cols * factor].reshape((rows, factor, cols, factor) + frame.shape[2:])
+        binned = blocks.mean(axis=3, dtype=np.float32).mean(axis=1)
+        return binned.astype(frame.dtype) if frame.dtype.kind in 'iub' else binned
+    else:
+        raise ValueError("{0} is not a valid downsampling method, must be 'stride' or 'bin'".format(method))
+
+
+def detach(image, source):
+    """Return image, or a copy of it if it shares memory with source.
+
+    During live view, frames may be views of a slot in the camera's frame buffer, which is overwritten
+    once the buffer wraps round.  Widgets draw in the GUI thread some time after they're given an
+    image, so they must be given one that won't change underneath them.  Downsampling first means
+    only the pixels that are displayed are copied.
+    """
+    if np.may_share_memory(image, source):
+        return image.copy()  # this is also contiguous, which Qt needs anyway
+    return image
+
+
+def display_levels(image):
+    """Black and white levels to display an image with.
+
+    8-bit images are displayed as they are; anything else is scaled between its minimum and maximum.
+    This is intended to be called once (e.g. when the image size changes), after which the levels
+    stay fixed, because working them out for every frame is slow and makes the preview flicker.
+    """
+    if image.dtype == np.uint8:
+        return 0, 255
+    low, high = float(np.min(image)), float(np.max(image))
+    if high <= low:
+        high = low + 1
+    return low, high
+
+
+class PreviewWorker(object):
+    """Update a camera's preview widgets from a background thread.
+
+    Call `submit(frame)` whenever a new frame arrives: it returns immediately.  The worker thread
+    picks up the most recent frame (at most `max_rate` times per second), applies the camera's
+    `filter_function`, and passes it to each widget's `update_image` method.  Widgets that have a
+    `downsample` method are given a downsampled frame, along with the full size of the frame (so they
+    can keep displaying it in sensor pixel coordinates).  Widgets that have an `update_pending`
+    attribute that's True are skipped, because they've not drawn the last frame yet.
+
+    The worker only holds a weak reference to the camera, and stops when the camera is deleted.
+    """
+    def __init__(self, camera, max_rate=30):
+        self._camera = weakref.ref(camera)
+        self.max_rate = max_rate
+        self.frames_submitted = 0
+        self.frames_displayed = 0
+        self._pending_frame = None
+        self._new_frame = threading.Event()
+        self._stop = threading.Event()
+        self._last_update = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def submit(self, frame):
+        """Queue a frame for display, replacing any frame that hasn't been displayed yet."""
+        self._pending_frame = frame
+        self.frames_submitted += 1
+        self._new_frame.set()
+
+    def stop(self, timeout=None):
+        """Stop the worker thread (any frame waiting to be displayed is dropped)."""
+        self._stop.set()
+        self._new_frame.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._new_frame.wait(1):
+                if self._camera() is None:
+                    return  # the camera has been deleted
+                continue
+            # wait until it's time for the next update; frames that arrive meanwhile replace this one
+            if self.max_rate:
+                delay = self._last_update + 1.0 / self.max_rate - time.time()
+                if delay > 0 and self._stop.wait(delay):
+                    return
+            self._new_frame.clear()
+            frame, self._pending_frame = self._pending_frame, None
+            camera = self._camera()
+            if camera is None:
+                return
+            if frame is None:
+                continue
+            self._last_update = time.time()
+            try:
+                self._update_widgets(camera, frame)
+            except Exception as e:
+                print "something went wrong updating the preview widget"
+                print e
+            del camera  # don't keep the camera alive while we wait
+
+    def _update_widgets(self, camera, frame):
+        widgets = list(camera._preview_widgets) if camera._preview_widgets is not None else []
+        if not any(not getattr(w, 'update_pending', False) for w in widgets):
+            return  # don't bother filtering a frame nobody will see
+        raw_frame = frame
+        if camera.filter_function is not None:
+            frame = camera.filter_function(frame)
+        for w in widgets:
+            if getattr(w, 'update_pending', False):
+                continue
+            try:
+                if hasattr(w, 'downsample'):
+                    w.update_image(detach(w.downsample(frame), raw_frame), full_shape=frame.shape[:2])
+                else:
+                    w.update_image(detach(frame, raw_frame))
+            except Exception as e:
+                print "something went wrong updating the preview widget"
+                print e
+        self.frames_displayed += 1
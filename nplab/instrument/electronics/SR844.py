@@ -48,6 +48,15 @@ class Lockin_SR844(vi.VisaInstrument):
                           10 : 10, 11 : 30, 12 : 100,13 : 300, 14 : 1E3, 15 : 3E3, 
                           16 : 10E3, 17 : 30E3}
         self.filter_list = {0 : "No Filter", 1 : "6 dB", 2:"12 dB",3:"24 dB"}
+        #reverse lookup tables, from real values to the integers the lockin uses
+        self.sens_lookup = dict((value, i) for i, value in self.sens_list.items())
+        self.time_lookup = dict((value, i) for i, value in self.time_list.items())
+        #the data buffer sample rates (Hz), 14 stores one point per trigger
+        self.sample_rate_list = {0 : 62.5E-3, 1 : 125E-3, 2 : 250E-3, 3 : 500E-3, 4 : 1, 5 : 2, 6 : 4,
+                                 7 : 8, 8 : 16, 9 : 32, 10 : 64, 11 : 128, 12 : 256, 13 : 512, 14 : "Trigger"}
+        #the quantities each display (and so each buffer) can show
+        self.ch1_display_list = {'X' : 0, 'R[V]' : 1, 'R [dBm]' : 2, 'X noise' : 3, 'AUX1' : 4}
+        self.ch2_display_list = {'Y' : 0, 'theta' : 1, 'Y noise [V]' : 2, 'Y noise [dBm]' : 3, 'AUX2' : 4}
         
     def measure_variables(self,channels = "1,2"):
         """Upto six variable read, must be greater than 1 measure via a string
@@ -70,6 +79,24 @@ class Lockin_SR844(vi.VisaInstrument):
         variables = variables.split(",")  
         variables = [float(i) for i in variables]
         return variables
+
+    def snapshot(self, *quantities):
+        '''Measure 2 to 6 quantities at the same instant, with a single query (SNAP?)
+        Args:
+            quantities(str or int): the names of the quantities, as in self.ch_list 
+                                    (e.g. 'X', 'theta'), or their numbers
+        Returns:
+            np.ndarray of the values, in the order requested
+        '''
+        assert 2 <= len(quantities) <= 6, "SNAP? reads between 2 and 6 quantities"
+        channels = ",".join(str(self.ch_list.get(q, q)) for q in quantities)
+        return np.array(self.measure_variables(channels))
+
+    def measure_XYRtheta(self):
+        '''Measure X, Y, R and theta at the same time, with one query
+        Returns:
+            X, Y, R [V], theta '''
+        return tuple(self.snapshot('X', 'Y', 'R[V]', 'theta'))
     
     def measure_X(self):
         '''Measure the current X value
@@ -200,12 +227,26 @@ class Lockin_SR844(vi.VisaInstrument):
             integrationtime(float):     The real value for the time constant in seconds
                                         for allowed values see self.time_list
         '''
-        for i in range(len(self.time_list.values()[:])):
-            if self.time_list.values()[i] == integrationtime:
-                self.time_constant = self.time_list.keys()[i]
-                return True
-        print 'Setting integration time failed. '+str(integrationtime)+' is not in self.time_list'
-        return False
+        try:
+            self.time_constant = self.time_lookup[integrationtime]
+            return True
+        except KeyError:
+            print 'Setting integration time failed. '+str(integrationtime)+' is not in self.time_list'
+            return False
+
+    def set_sensitivity_from_value(self,sensitivity):
+        '''Command to reverse read a dictionary and set the sensitivity
+        
+        Args:
+            sensitivity(float):     The real value for the sensitivity in Vrms
+                                    for allowed values see self.sens_list
+        '''
+        try:
+            self.sensitivity = self.sens_lookup[sensitivity]
+            return True
+        except KeyError:
+            print 'Setting sensitivity failed. '+str(sensitivity)+' is not in self.sens_list'
+            return False
 
     def get_filter(self):
         ''' The filterslope property 
@@ -282,23 +323,22 @@ class Lockin_SR844(vi.VisaInstrument):
             wide_res(int):  The new wide reserve (high = 0, normal = 1, low noise = 2)
             close_res(int): The new close reserve (high = 0, normal = 1, low noise = 2)
         '''
-        testmax = np.max([np.abs(self.measure_R()),np.abs(self.measure_X()),np.abs(self.measure_Y())])
-        try:
-            Lowersense = self.sens_list[self.sensitivity[0]-1]
-        except KeyError:
-            Lowersense = 0.0
-        while testmax>self.sensitivity[1] or testmax<Lowersense:
-            testmax = np.max([np.abs(self.measure_R()),np.abs(self.measure_X()),np.abs(self.measure_Y())])
-            try:
-                Lowersense = self.sens_list[self.sensitivity[0]-1]
-            except KeyError:
-                Lowersense = 0.0
-            if testmax>self.sensitivity[1]:
-                if self.sensitivity[0]==14:
+        #X, Y and R are read together, and the sensitivity is only queried once
+        sens = self.sensitivity[0]
+        testmax = np.max(np.abs(self.snapshot('R[V]', 'X', 'Y')))
+        Lowersense = self.sens_list.get(sens-1, 0.0)
+        while testmax>self.sens_list[sens] or testmax<Lowersense:
+            testmax = np.max(np.abs(self.snapshot('R[V]', 'X', 'Y')))
+            if testmax>self.sens_list[sens]:
+                if sens==14:
                     print "OVERLOADED RUNNNNNN"
-                self.sensitivity = self.sensitivity[0]+1
+                    break
+                sens = sens+1
+                self.sensitivity = sens
             elif testmax<Lowersense:
-                self.sensitivity = self.sensitivity[0]-1
+                sens = sens-1
+                self.sensitivity = sens
+            Lowersense = self.sens_list.get(sens-1, 0.0)
             sleep(1)
             self.write("AWRS")  #wideband reseve
             wide_res = self.wide_res
@@ -310,6 +350,83 @@ class Lockin_SR844(vi.VisaInstrument):
         return sens, wide_res, close_res
        # else:
           #  print "Measurement within range"
+
+    def setup_buffer(self, sample_rate = 14, loop = False, ch1 = 'X', ch2 = 'Y'):
+        '''Set up the internal data buffers, ready to store a scan
+        
+        Each of the two buffers stores what is shown on its channel's display, so the displays
+        are set to show ch1 and ch2 (see self.ch1_display_list and self.ch2_display_list).
+        The buffers are cleared, and start storing when start_buffer is called.
+        
+        Args:
+            sample_rate(int):   The sample rate as shown by the dict self.sample_rate_list, 
+                                14 stores one point each time the lockin is triggered 
+                                (by trigger() or the rear panel trigger input)
+            loop(bool):         If True the buffer wraps round when full, otherwise 
+                                storage stops
+            ch1(str):           The quantity stored in buffer 1
+            ch2(str):           The quantity stored in buffer 2
+        '''
+        self.write("DDEF1,%d" % self.ch1_display_list[ch1])
+        self.write("DDEF2,%d" % self.ch2_display_list[ch2])
+        self.write("SRAT%d" % sample_rate)
+        self.write("SEND%d" % int(loop))
+        self.reset_buffer()
+
+    def start_buffer(self):
+        '''Start (or resume) storing data in the buffers '''
+        self.write("STRT")
+
+    def pause_buffer(self):
+        '''Pause storing data in the buffers '''
+        self.write("PAUS")
+
+    def reset_buffer(self):
+        '''Clear the buffers '''
+        self.write("REST")
+
+    def trigger(self):
+        '''Software trigger - with sample_rate 14, this stores one point in each buffer '''
+        self.write("TRIG")
+
+    def get_buffered_points(self):
+        '''Return the number of points stored in the buffers '''
+        return self.int_query("SPTS?")
+
+    buffered_points = property(get_buffered_points)
+
+    def read_buffer(self, channel = 1, start = 0, count = None):
+        '''Read the stored points from a buffer, as a numpy array
+        
+        The points are transferred as binary (TRCB?), which is much faster than 
+        reading them one at a time.
+        
+        Args:
+            channel(int):   The buffer to read (1 or 2)
+            start(int):     The first point to read
+            count(int):     The number of points, by default all the stored points after start
+        '''
+        if count is None:
+            count = self.buffered_points - start
+        if count <= 0:
+            return np.zeros(0)
+        self.write("TRCB? %d,%d,%d" % (channel, start, count))
+        read_termination = self.instr.read_termination
+        self.instr.read_termination = None # the data may contain newline characters
+        try:
+            data = self.instr.read_raw()
+        finally:
+            self.instr.read_termination = read_termination
+        #4 byte IEEE floats, least significant byte first
+        return np.frombuffer(data[:4*count], dtype='<f4').astype(np.float64)
+
+    def read_buffers(self):
+        '''Pause storage, and read all the stored points from both buffers
+        Returns:
+            np.ndarray of shape (2, points): the contents of buffer 1 and buffer 2 '''
+        self.pause_buffer()
+        count = self.buffered_points
+        return np.vstack((self.read_buffer(1, 0, count), self.read_buffer(2, 0, count)))
     
     
 
@@ -9,6 +9,7 @@ A nplab wrapper to the ThorlabsPM100 reppo
 from nplab.instrument import Instrument
 from ThorlabsPM100 import ThorlabsPM100
 import visa
+import time
 import numpy as np
 from nplab.ui.ui_tools import QuickControlBox
 from nplab.utils.notified_property import DumbNotifiedProperty,NotifiedProperty
@@ -21,20 +22,61 @@ class ThorPM100(ThorlabsPM100,Instrument):
         rm = visa.ResourceManager()
         instr = rm.open_resource(address)
         super(ThorPM100, self).__init__(instr)
-        self.num_averages = 100
+        self._average_count = None
+        self.num_averages = num_averages
         self.ui = None
         if calibration == None:
             self.calibration = 1.0
         else:
             self.calibration = calibration
+
+    def get_average_count(self):
+        """The number of samples the power meter averages for each reading """
+        if self._average_count is None:
+            self._average_count = int(self.sense.average.count)
+        return self._average_count
+    def set_average_count(self,count):
+        count = int(count)
+        if count != self._average_count: #avoid a VISA write if it's already set
+            self.sense.average.count = count
+            self._average_count = count
+    average_count = NotifiedProperty(get_average_count,set_average_count)
+
     def read_average(self,num_averages = None):
-        """a quick averaging tool for the pm100 power meter """
+        """Read the power, averaged over num_averages samples by the power meter itself.
+        
+        This takes one VISA round trip, rather than one per sample."""
         if num_averages==None:
             num_averages = self.num_averages
-        values =[]
-        for i in range(num_averages):
-            values.append(self.read)
-        return np.average(values)
+        self.average_count = num_averages
+        return self.read
+
+    def sample(self,n_samples = None,duration = None,averages_per_sample = 1):
+        """Read the power repeatedly, as fast as the power meter allows.
+        
+        Either n_samples readings are taken, or readings are taken until duration (in seconds) has
+        passed.  Each reading is averaged over averages_per_sample samples by the power meter.  The
+        PM100 has no buffered acquisition mode, so each reading is one READ? query.
+        
+        Returns two numpy arrays: the time of each reading (in seconds, from the start of sampling), and the
+        power (without the calibration applied).
+        """
+        assert (n_samples is None) != (duration is None), "Specify either n_samples or duration"
+        self.average_count = averages_per_sample
+        size = n_samples if n_samples is not None else 1000
+        times = np.empty(size)
+        powers = np.empty(size)
+        start = time.time()
+        i = 0
+        while (i < n_samples) if n_samples is not None else (time.time() - start < duration):
+            if i == len(powers): #grow the arrays, for timed sampling
+                times = np.concatenate((times, np.empty(len(times))))
+                powers = np.concatenate((powers, np.empty(len(powers))))
+            t = time.time()
+            powers[i] = self.read
+            times[i] = (t + time.time())/2.0 - start #the middle of the query
+            i += 1
+        return times[:i], powers[:i]
     
     def read_average_power(self):
         """Return the average power including a calibration """
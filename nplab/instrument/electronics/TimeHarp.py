@@ -10,6 +10,7 @@ Created on Wed Sept 20 2017
 from ctypes import *
 import sys
 from nplab.instrument import Instrument
+from nplab.instrument.electronics.tttr import TTTRAcquisition
 import time
 import numpy as np
 import matplotlib.pyplot as plt
@@ -23,9 +24,12 @@ class TimeHarp(Instrument):
     ctcstatus = 0
     countrate = 0
     BLOCKSIZE =  4096;
+    TTREADMAX = 131072 #the largest number of TTTR records read at once
 
-    def __init__(self):
+    def __init__(self, timeharp_mode = None):
         super(TimeHarp,self).__init__()
+        if timeharp_mode is not None:
+            self.timeharp_mode = timeharp_mode
         #for Windows
         #self.TH_dll = cdll.LoadLibrary(r'C:\Program Files (x86)\PicoQuant\TH200-THLibv61\Thlib_for_x64\Thlib.dll')
        # self.TH_dll = cdll.LoadLibrary('C:\Program Files\PicoQuant\TH200-THLibv61\ThLib.lib')
@@ -160,6 +164,26 @@ class TimeHarp(Instrument):
             self.TH_dll.TH_Shutdown()
         return retarr, retint
     
+
+    def TimeHarp_TTReadData(self, buffer):
+        """Read up to len(buffer) TTTR records into buffer (a uint32 numpy array), returning the number read.
+
+        Raises an IOError (after shutting down the card) if the driver reports an error."""
+        retint = self.TH_dll.TH_TTReadData(buffer.ctypes.data_as(POINTER(c_uint32)), len(buffer))
+        if retint < 0:
+            self.verbose(self.FindError(retint), sys._getframe().f_code.co_name) 
+            self.TH_dll.TH_Shutdown()
+            raise IOError("TH_TTReadData failed with error code %d" % retint)
+        return retint
+
+    def stream_tttr(self, Tacq = 1000, consumers = ()):
+        """Start a TTTR measurement of Tacq milliseconds, passing the events to consumers as they arrive.
+
+        The TimeHarp must have been initialised in TTTR mode (timeharp_mode = 1).  Consumers are
+        called with the raw records and decoded events, e.g. tttr.MicrotimeHistogram, tttr.EventCorrelator
+        or daq_streaming.HDF5StreamWriter.  Returns a started tttr.TTTRAcquisition - call wait() for it to finish."""
+        assert self.timeharp_mode == 1, "The TimeHarp must be initialised in TTTR mode"
+        return TTTRAcquisition(TimeHarpTTTRSource(self, Tacq), consumers = consumers).start()
        
     def ReadErrorFile(self):
         #mypath = r'C:\Program Files (x86)\PicoQuant\TH200-THLibv61'
@@ -180,6 +204,35 @@ class TimeHarp(Instrument):
     def FindError(self, thiserror):
         error_index = self.ERROR_CODE.index(str(thiserror))
         return self.ERROR_CODE[error_index - 1]
+
+
+class TimeHarpTTTRSource(object):
+    """Reads the records of a TTTR measurement from a TimeHarp, for tttr.TTTRAcquisition"""
+    def __init__(self, timeharp, Tacq = 1000):
+        self.timeharp = timeharp
+        self.Tacq = Tacq
+        self.buffer = np.empty(timeharp.TTREADMAX, dtype = np.uint32) #reused for every read
+        self.finished = False
+
+    def start(self):
+        self.finished = False
+        self.timeharp.TimeHarp_SetMMode(0, self.Tacq)
+        self.timeharp.TimeHarp_StartMeas()
+
+    def read_records(self):
+        #check the timer *before* reading, so records arriving between the read and the check aren't lost
+        timer_expired = self.timeharp.TimeHarp_CTCStatus() != 0
+        n = self.timeharp.TimeHarp_TTReadData(self.buffer)
+        if n == 0:
+            #the measurement has finished once the timer had expired and the FIFO is still empty
+            self.finished = timer_expired
+            return self.buffer[:0]
+        return self.buffer[:n].copy()
+
+    def stop(self):
+        self.timeharp.TimeHarp_StopMeas()
+        self.finished = True
+
 if __name__ == '__main__':   
     th = TimeHarp()
     th.TimeHarp_Calibrate()
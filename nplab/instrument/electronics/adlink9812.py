@@ -5,6 +5,7 @@ from ctypes import *
 import nplab
 from nplab.instrument import Instrument
 from nplab.instrument.electronics import adlink9812_constants
+from nplab.instrument.electronics.daq_streaming import StreamingAcquisition
 from nplab.utils.gui import *
 from nplab.ui.ui_tools import *
 from nplab.experiment.dynamic_light_scattering import dls_signal_postprocessing 
@@ -15,6 +16,7 @@ import scipy.stats
 import threading
 import logging
 import timeit
+import time
 
 ### Steps of PCI-DASK applications:
 #
@@ -147,112 +149,81 @@ class Adlink9812(Instrument):
 	def asynchronous_double_buffered_analog_input_read(self,sample_freq,sample_count,card_buffer_size = 500000,verbose=False, channel = 0):
 		'''
 		Non-Triggered Double-Buffered Asynchronous  Analog Input Continuous Read
-		Steps: [Adlink PCIS-DASK manual,page 47]
 
-		1. AI_XXXX_Config
-			Configure the card for the asynchronous mode
+		Acquires sample_count samples with `stream`, copying each half buffer into one
+		preallocated array as it arrives, and returns the voltages.
+		'''
+		voltages = np.empty(sample_count, dtype=np.float64)
+		position = [0]
+		def store(block):
+			voltages[position[0]:position[0]+len(block)] = block
+			position[0] += len(block)
+		self.stream(sample_freq, sample_count, store, card_buffer_size=card_buffer_size, verbose=verbose, channel=channel)
+		return voltages
+
+	def _wait_for_half_buffer(self, poll_interval):
+		'''Wait until half of the card buffer is full, sleeping between checks rather than busy-polling'''
+		#I16 AI_AsyncDblBufferHalfReady (U16 CardNumber, BOOLEAN *HalfReady,BOOLEAN *StopFlag)
+		halfReady = c_bool(0)
+		stopFlag = c_bool(0)
+		while True:
+			buffReadyErr = ctypes.c_int16(self.dll.AI_AsyncDblBufferHalfReady(
+				c_ushort(self.card_id),
+				ctypes.byref(halfReady),
+				ctypes.byref(stopFlag))
+			)
+			if buffReadyErr.value!=0:
+				self.log(message="buffReadErr:"+str(buffReadyErr.value))
+			if halfReady.value == True:
+				return
+			time.sleep(poll_interval)
+
+	def stream(self,sample_freq,sample_count,consumer,card_buffer_size = 500000,max_queued_blocks = 8,verbose=False,channel = 0):
+		'''
+		Double-buffered acquisition, passing the data to consumer(voltages) as it arrives.
+		Steps: [Adlink PCIS-DASK manual,page 47]
 
-		2. AI_AsyncDblBufferMode 
+		1. AI_AsyncDblBufferMode
 			Enable double buffered mode
 
-		3. AI_ContReadChannel
+		2. AI_ContReadChannel
 			Read from a single channel (=0)
 
-		4. while not stop:
-
-			4.1 if (AI_AsyncDblBufferHaldReady):   #Check if buffer is half full]
-				
-				4.1.1 AI_AsyncDblBufferTransfer	   #Transfer data from card buffer into user buffer
-			
-		5. AI_AsyncClear
-		6. Convert all data to volts and return
-
-		'''
-		
-		#AI_AsyncDblBufferMode - initialize Double Buffer Mode
-		buffModeErr = ctypes.c_int16(self.dll.AI_AsyncDblBufferMode(c_ushort(self.card_id),ctypes.c_bool(1)))
-		if verbose or buffModeErr.value != 0:
-			self.log(message="AI_AsyncDblBufferMode: Non-zero status code"+str(buffModeErr.value))
-
-		#card buffer
-		cardBuffer = (c_ushort*card_buffer_size)()
+		3. for each half buffer:
 
-		#user buffers
-		user_buffer_size = card_buffer_size/2 #half due to being full when buffer is read
-		nbuff = int(math.ceil(sample_count/float(user_buffer_size)))
-		
-		# uBs = [(c_double*user_buffer_size)()]*nbuff
-		uBs = []
-		print uBs
-		# oBs = [(c_double*user_buffer_size)()]*nbuff
-		oBs = []
-		if verbose:
-			self.log(message="Number of user buffers:"+str(nbuff))
+			3.1 wait for AI_AsyncDblBufferHalfReady, sleeping between checks
 
-		#AI_ContReadChanne
+			3.2 AI_AsyncDblBufferTransfer into a numpy array, convert to volts
+			    and put the voltages in a queue for the consumer
 
-		readErr = ctypes.c_int16(self.dll.AI_ContReadChannel(
-			c_ushort(self.card_id), 					#CardNumber
-			c_ushort(channel),       			#Channel
-			c_ushort(adlink9812_constants.AD_B_1_V),		#AdRange
-			cardBuffer,									#Buffer
-			c_uint32(card_buffer_size),			#ReadCount
-			c_double(sample_freq),				#SampleRate (Hz)
-			c_ushort(adlink9812_constants.ASYNCH_OP)		#SyncMode - Asynchronous
-		))
-
-		if verbose or readErr.value != 0:
-			self.log(message="AI_ContReadChannel: Non-zero status code"+str(readErr.value))
+		4. AI_AsyncClear
 
-		#AI_AsyncDblBufferHalfReader
-		#I16 AI_AsyncDblBufferHalfReady (U16 CardNumber, BOOLEAN *HalfReady,BOOLEAN *StopFlag)
-		
-		for i in range(nbuff):
-			currentBuffer = (c_double*user_buffer_size)()
-			halfReady = c_bool(0)
-			stopFlag = c_bool(0)
-			while halfReady.value != True:
-				buffReadyErr = ctypes.c_int16(self.dll.AI_AsyncDblBufferHalfReady(
-					c_ushort(self.card_id),
-					ctypes.byref(halfReady),
-					ctypes.byref(stopFlag))
-				)
-				if buffReadyErr.value!=0:
-					self.log(message="buffReadErr:"+str(buffReadyErr.value))
-					self.log(message="HalfReady:"+str(halfReady.value))
-		
-			#AI_AsyncDblBufferTransfer
-			#I16 AI_AsyncDblBufferTransfer (U16 CardNumber, U16 *Buffer)
-			buffTransferErr = ctypes.c_int16(self.dll.AI_AsyncDblBufferTransfer(c_ushort(self.card_id), ctypes.byref(currentBuffer)))
-			uBs.append(currentBuffer)
-			if buffTransferErr.value != 0:
-				self.log(message="buffTransferErr:"+str(buffTransferErr.value))
+		The card is read by an `Adlink9812Source`, run by a
+		daq_streaming.StreamingAcquisition.  consumer is called in a separate
+		thread with a numpy array of voltages for each half buffer
+		(card_buffer_size/2 samples, except the last which is cut down to give
+		sample_count samples in total), so it can write to disk (e.g. with a
+		daq_streaming.HDF5StreamWriter), bin or correlate the data while the
+		acquisition carries on.  At most max_queued_blocks are held in memory:
+		if the consumer can't keep up, the acquisition waits for it.  Any
+		exception raised by the consumer stops the acquisition and is re-raised
+		here.
 
-		accessCnt = ctypes.c_int32(0)
-		clearErr = ctypes.c_int16(self.dll.AI_AsyncClear(self.card_id, ctypes.byref(accessCnt)))
+		Returns the number of samples acquired.
+		'''
+		user_buffer_size = card_buffer_size/2 #half due to being full when buffer is read
 		if verbose:
-			self.log(message="AI_AsyncClear,AccessCnt:"+str(accessCnt.value))
-		
-		#concatenate user buffer onto existing numpy array
-		#reinitialize user buffer
-
-		for i in range(nbuff):
-			oB = (c_double*user_buffer_size)()
-			convertErr = ctypes.c_int16(self.dll.AI_ContVScale(
-			c_ushort(self.card_id),				#CardNumber
-			c_ushort(adlink9812_constants.AD_B_1_V),	#AdRange
-			uBs[i], 					#DataBuffer   - array storing raw 16bit A/D values
-			oB, 					#VoltageArray - reference to array storing voltages
-			c_uint32(user_buffer_size) 			#Sample count - number of samples to be converted
-			))
-			oBs.append(oB)
-			if convertErr.value != 0:
-				self.log(message="AI_ContVScale: Non-zero status code:"+str(convertErr.value))
-		return np.concatenate(oBs)
+			self.log(message="Number of user buffers:"+str(int(math.ceil(sample_count/float(user_buffer_size)))))
+		source = Adlink9812Source(self, sample_freq, card_buffer_size=card_buffer_size, verbose=verbose, channel=channel)
+		#the source gives (1, n) blocks, but the consumer expects 1D arrays
+		acquisition = StreamingAcquisition(source, user_buffer_size, consumers=[lambda block: consumer(block[0])],
+			ring_capacity=0, sample_count=sample_count, max_queued_blocks=max_queued_blocks)
+		acquisition.start().wait()
+		return sample_count
 
 	@staticmethod
 	def get_times(dt,nsamples):
-		return [i*dt for i in range(nsamples)]
+		return np.arange(nsamples)*dt
 
 	def capture(self,sample_freq, sample_count,verbose = False):
 		assert(sample_freq <= int(2e7) and sample_freq > 1)
@@ -271,6 +242,75 @@ class Adlink9812(Instrument):
 
 
 
+class Adlink9812Source(object):
+	'''Reads half buffers from an Adlink9812 in double-buffered mode, for daq_streaming.StreamingAcquisition.
+
+	In debug mode, random voltages are returned instead.'''
+	n_channels = 1
+
+	def __init__(self, card, sample_freq, card_buffer_size = 500000, verbose = False, channel = 0):
+		self.card = card
+		self.sample_freq = sample_freq
+		self.card_buffer_size = card_buffer_size
+		self.user_buffer_size = card_buffer_size/2
+		self.verbose = verbose
+		self.channel = channel
+		#sleep for a fraction of the time it takes to fill half the buffer between checks
+		self.poll_interval = self.user_buffer_size/float(sample_freq)/20.0
+
+	def start(self):
+		if self.card.debug:
+			return
+		dll = self.card.dll
+		#AI_AsyncDblBufferMode - initialize Double Buffer Mode
+		buffModeErr = ctypes.c_int16(dll.AI_AsyncDblBufferMode(c_ushort(self.card.card_id),ctypes.c_bool(1)))
+		if self.verbose or buffModeErr.value != 0:
+			self.card.log(message="AI_AsyncDblBufferMode: Non-zero status code"+str(buffModeErr.value))
+
+		#card buffer
+		self.cardBuffer = (c_ushort*self.card_buffer_size)()
+		#user buffer, reused for every transfer
+		self.rawBuffer = np.empty(self.user_buffer_size, dtype=np.uint16)
+		self.rawPointer = self.rawBuffer.ctypes.data_as(POINTER(c_ushort))
+
+		readErr = ctypes.c_int16(dll.AI_ContReadChannel(
+			c_ushort(self.card.card_id), 			#CardNumber
+			c_ushort(self.channel),       			#Channel
+			c_ushort(adlink9812_constants.AD_B_1_V),		#AdRange
+			self.cardBuffer,						#Buffer
+			c_uint32(self.card_buffer_size),		#ReadCount
+			c_double(self.sample_freq),				#SampleRate (Hz)
+			c_ushort(adlink9812_constants.ASYNCH_OP)		#SyncMode - Asynchronous
+		))
+
+		if self.verbose or readErr.value != 0:
+			self.card.log(message="AI_ContReadChannel: Non-zero status code"+str(readErr.value))
+
+	def read_block(self, n):
+		'''Wait for the next half buffer, and return the first n (at most card_buffer_size/2) voltages in it as a (1, n) array'''
+		if self.card.debug:
+			return (2.0*np.random.rand(1, n))-1.0
+		self.card._wait_for_half_buffer(self.poll_interval)
+
+		#AI_AsyncDblBufferTransfer
+		#I16 AI_AsyncDblBufferTransfer (U16 CardNumber, U16 *Buffer)
+		buffTransferErr = ctypes.c_int16(self.card.dll.AI_AsyncDblBufferTransfer(c_ushort(self.card.card_id), self.rawPointer))
+		if buffTransferErr.value != 0:
+			self.card.log(message="buffTransferErr:"+str(buffTransferErr.value))
+
+		voltages = np.empty((1, self.user_buffer_size), dtype=np.float64)
+		self.card.convert_to_volts(self.rawPointer, voltages.ctypes.data_as(POINTER(c_double)), self.user_buffer_size)
+		return voltages[:, :n]
+
+	def stop(self):
+		if self.card.debug:
+			return
+		accessCnt = ctypes.c_int32(0)
+		clearErr = ctypes.c_int16(self.card.dll.AI_AsyncClear(self.card.card_id, ctypes.byref(accessCnt)))
+		if self.verbose:
+			self.card.log(message="AI_AsyncClear,AccessCnt:"+str(accessCnt.value))
+
+
 class Adlink9812UI(QtWidgets.QWidget, UiTools):
 	def __init__(self,card, parent=None,debug = False, verbose = False):
 		if not isinstance(card, Adlink9812):
@@ -396,13 +436,10 @@ class Adlink9812UI(QtWidgets.QWidget, UiTools):
 		#take difference of voltages
 		rounded_diff = dls_signal_postprocessing.signal_diff(voltages)
 		
-		#thresholding
-		thresholded = np.absolute(rounded_diff).astype(int)
-
-		#binning
+		#binning - this sums the absolute values, so edges in either direction are counted
 		time_bin_width = self.bin_width
 		index_bin_width = dls_signal_postprocessing.binwidth_time_to_index(time_bin_width,dt)
-		binned_counts = dls_signal_postprocessing.binning(thresholded=thresholded,index_bin_width=index_bin_width)
+		binned_counts = dls_signal_postprocessing.binning(thresholded=rounded_diff,index_bin_width=index_bin_width)
 		time_bins = time_bin_width*np.arange(0,len(binned_counts))
 
 		total_counts = np.sum(binned_counts)
@@ -435,9 +472,8 @@ class Adlink9812UI(QtWidgets.QWidget, UiTools):
 		sample_count = int(1e6) #0.05s  
 		voltages, dt = self.card.capture(sample_freq=frequency, sample_count=sample_count)
 		sample_time = dt*sample_count
-		#convert rounded difference to integers
-		thresholded = np.absolute(dls_signal_postprocessing.signal_diff(voltages)).astype(int)
-		total_counts = np.sum(thresholded)
+		#every nonzero difference is an edge
+		total_counts = np.count_nonzero(dls_signal_postprocessing.signal_diff(voltages, overwrite_input=True))
 		count_rate = total_counts/sample_time
 		self.log("Total Counts: {0} [counts], Rate: {1} [counts/s]".format(int(total_counts), count_rate))
 		return total_counts, count_rate 
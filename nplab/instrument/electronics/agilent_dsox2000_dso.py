@@ -7,6 +7,40 @@ from nplab.utils.gui import *
 from nplab.ui.ui_tools import *
 
 
+def parse_ieee_block(block, dtype):
+    """Convert an IEEE 488.2 definite-length binary block (e.g. "#800001000<data>") to a numpy array."""
+    if block[0:1] != b'#':
+        raise ValueError("This isn't an IEEE binary block (it should start with #)")
+    n_digits = int(block[1:2])
+    length = int(block[2:2 + n_digits])
+    start = 2 + n_digits
+    if len(block) < start + length:
+        raise ValueError("The binary block was truncated ({0} of {1} bytes)".format(len(block) - start, length))
+    return np.frombuffer(block, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=start)
+
+
+class WaveformPreamble(object):
+    """The scaling information for a trace, from the reply to :waveform:preamble?"""
+    formats = {0: 'byte', 1: 'word', 4: 'ascii'}
+
+    def __init__(self, reply):
+        values = [float(v) for v in reply.strip().split(',')]
+        self.format = self.formats[int(values[0])]
+        self.acquire_type = int(values[1])
+        self.points = int(values[2])
+        self.count = int(values[3])
+        self.x_inc, self.x_or, self.x_ref, self.y_inc, self.y_or, self.y_ref = values[4:10]
+
+    def times(self, n_points=None):
+        """The time of each point in the trace."""
+        n_points = self.points if n_points is None else n_points
+        return (np.arange(n_points) - self.x_ref) * self.x_inc + self.x_or
+
+    def scale(self, trace):
+        """Convert raw values from the scope to volts (or whatever the channel units are)."""
+        return self.y_or + self.y_inc * (np.asarray(trace, dtype=np.float64) - self.y_ref)
+
+
 class AgilentDSOChannel(object):
     def __init__(self, dso, channel):
         self.parent = dso
@@ -40,12 +74,36 @@ class AgilentDSO(VisaInstrument):
         for ch in self.channel_names:
             setattr(self, 'channel{0}'.format(ch), AgilentDSOChannel(self, ch))
         self.channels = tuple(getattr(self, 'channel{0}'.format(ch)) for ch in self.channel_names)
-        # set byte transmission
-        self.waveform_format = 'byte'
-        byteorder = self.waveform_byteorder
+        self._preambles = {} # preambles of each channel, discarded when settings change
+        self._trace_parameters = None # the (points mode, points) last written by set_trace_parameters
+        self.set_waveform_format('byte')
+
+    # commands that don't change the scaling of the traces, so we can keep using the cached preambles.  Starting
+    # or stopping the scope can change the record length (in 'maximum' points mode) so :run, :stop and :single
+    # aren't included, and traces are checked against the number of points in the preamble anyway.
+    _commands_preserving_preamble = (':digitize', ':trigger:force', ':waveform:source',
+                                     ':acquire:segmented:index', '*cls')
+
+    def write(self, command, *args, **kwargs):
+        """Send a command to the scope, discarding cached preambles if it could change the settings."""
+        if not command.lower().startswith(self._commands_preserving_preamble):
+            self.invalidate_preambles()
+        return super(AgilentDSO, self).write(command, *args, **kwargs)
+
+    def invalidate_preambles(self):
+        """Discard the cached waveform preambles (do this if settings are changed on the front panel)."""
+        self._preambles = {}
+        self._trace_parameters = None
+
+    def set_waveform_format(self, waveform_format='byte'):
+        """Set binary transfer of traces, with 8 ('byte') or 16 ('word') bits per point."""
+        self.waveform_format = waveform_format
         self.waveform_unsigned = 1
-        byteorder = True if byteorder == 'MSBF' else False
-        self.instr.values_format.use_binary('B', byteorder, np.array)
+        byteorder = self.waveform_byteorder
+        bits = '>' if byteorder.upper().startswith('MSBF') else '<'
+        self._waveform_dtype = np.dtype('u1' if waveform_format == 'byte' else bits + 'u2')
+        self.instr.values_format.use_binary('B' if waveform_format == 'byte' else 'H',
+                                            bits == '>', np.array)
 
     def reset(self):
         self.write('*rst')
@@ -109,7 +167,7 @@ class AgilentDSO(VisaInstrument):
                                       validate=[0, 1], dtype='int')
     trigger_status = queried_property(':ter?', dtype='int')
     waveform_format = queried_property(':waveform:format?', ':waveform:format {0}',
-                                       validate=['byte', 'ascii'], dtype='str')
+                                       validate=['byte', 'word', 'ascii'], dtype='str')
     waveform_byteorder = queried_property(':waveform:byteorder?', ':waveform:byteorder {0}',
                                           validate=['lsbfirst', 'msbfirst', 'LSBFirst', 'MSBFirst', 'LSBF', 'MSBF'],
                                           dtype='str')
@@ -132,26 +190,100 @@ class AgilentDSO(VisaInstrument):
     y_ref = queried_property(":waveform:yreference?")
 
     def set_trace_parameters(self, ch, mode='maximum'):
+        """Transfer all the acquired points of a channel, writing the settings only if they have changed.
+
+        Writing them would discard the cached preambles, so repeated calls don't re-query them."""
         assert ch in self.channel_names
         self.set_source(ch)
-        self.waveform_points_mode = mode
-        self.waveform_points = self.acquire_points
+        parameters = (mode, self.acquire_points)
+        if parameters != self._trace_parameters:
+            self.waveform_points_mode = mode
+            self.waveform_points = parameters[1]
+            self._trace_parameters = parameters # set after the writes, which reset it
+
+    def get_preamble(self, ch, points=None):
+        """Return the `WaveformPreamble` for a channel, querying the scope only if settings have changed.
+
+        If `points` (the length of the trace to be scaled) is given and doesn't match the cached preamble, the
+        preamble is out of date (e.g. the record length changed when the scope stopped) and is queried again."""
+        if ch in self._preambles and points is not None and self._preambles[ch].points != points:
+            del self._preambles[ch]
+        if ch not in self._preambles:
+            self.set_source(ch)
+            self._preambles[ch] = WaveformPreamble(self.query(':waveform:preamble?'))
+        return self._preambles[ch]
 
-    def scale_trace(self, trace):
+    def scale_trace(self, trace, ch=None):
+        """Convert a raw trace to time and voltage arrays.
+
+        If the channel is given, the cached preamble is used (see `get_preamble`), otherwise the scaling is
+        queried from the scope for the current waveform source."""
+        if ch is not None:
+            preamble = self.get_preamble(ch, trace.size)
+            return preamble.times(trace.size), preamble.scale(trace)
         trace = self.y_or + (self.y_inc * (trace - self.y_ref))
         time = np.arange(trace.size)*self.x_inc + self.x_or
         return time, trace
 
+    def read_raw_trace(self):
+        """Read the current waveform source as a binary block, and return the raw values as a numpy array."""
+        self.instr.write(':waveform:data?')
+        read_termination = self.instr.read_termination
+        self.instr.read_termination = None # the data may contain newline characters
+        try:
+            block = self.instr.read_raw()
+        finally:
+            self.instr.read_termination = read_termination
+        return parse_ieee_block(block, self._waveform_dtype)
+
     def read_trace(self, ch, renew=True):
         assert ch in self.channel_names
         if renew:
             self.set_trace_parameters(ch)
         self.set_source(ch)
-        trace = self.instr.query_values(':waveform:data?')
+        trace = self.read_raw_trace()
 
-        time, trace = self.scale_trace(trace)
+        time, trace = self.scale_trace(trace, ch)
         return time, trace
 
+    def read_traces(self, channels=None, capture=True, segments=None):
+        """Capture and read traces from several channels, returning time and a 2D array of traces.
+
+        Arguments:
+        channels : list (optional)
+            The channels to read (by default, all of them).
+        capture : bool (optional, default True)
+            Whether to capture new traces (on all the channels at once) before reading them.
+        segments : int (optional)
+            If specified, the scope's segmented memory is used to capture this many triggers, and the result has
+            shape (n_channels, segments, n_points).  Otherwise it's (n_channels, n_points).  The scope is left in
+            segmented acquisition mode.
+
+        The scaling of each channel is cached (see `get_preamble`), so repeatedly calling this only transfers the
+        binary data.
+        """
+        channels = self.channel_names if channels is None else channels
+        if segments is not None and capture:
+            self.write(':acquire:mode segmented')
+            self.write(':acquire:segmented:count {0}'.format(segments))
+        if capture:
+            self.write(':digitize ' + ','.join('channel{0}'.format(ch) for ch in channels))
+        traces = []
+        for ch in channels:
+            self.set_source(ch)
+            if segments is None:
+                raw_trace = self.read_raw_trace()
+                traces.append(self.get_preamble(ch, raw_trace.size).scale(raw_trace))
+            else:
+                segment_traces = []
+                for i in range(segments):
+                    self.write(':acquire:segmented:index {0}'.format(i + 1))
+                    raw_trace = self.read_raw_trace()
+                    segment_traces.append(self.get_preamble(ch, raw_trace.size).scale(raw_trace))
+                traces.append(segment_traces)
+        traces = np.array(traces)
+        return self.get_preamble(channels[0], traces.shape[-1]).times(traces.shape[-1]), traces
+
     def check_trigger(self, force=False):
         if force:
             self.force_trigger()
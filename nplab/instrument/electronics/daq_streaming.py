@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Continuous acquisition
+======================
+
+Reading a fixed chunk from a DAQ card whenever Python gets round to it loses data as soon as Python falls behind.
+A `StreamingAcquisition` instead runs a dedicated reader thread, which does nothing but pull a block of
+``samples_per_block`` samples per channel from a source as soon as it's available.  Each block is:
+
+* written into a `RingBuffer`, which always holds the most recent samples (e.g. for a live display), and
+* put in a queue for a second thread, which passes it to the consumers, e.g. a `HDF5StreamWriter` that appends it
+  to a resizable dataset on disk.
+
+The threads are run by `ThreadedAcquisition`, which is also used for time-tagged photon counting
+(`nplab.instrument.electronics.tttr`) and by `Adlink9812.stream`.
+
+The reader only waits for the consumers if ``max_queued_blocks`` blocks are waiting to be processed, and the
+hardware buffer gives it some slack even then, so slow disk writes don't make the acquisition lose samples.
+
+A source is any object with an ``n_channels`` attribute and ``start()``, ``read_block(n)`` and ``stop()`` methods,
+where ``read_block`` waits until n samples per channel are available and returns them as an
+(n_channels, n) array.  `nplab.instrument.electronics.nidaq.NIDAQAISource` reads from a National Instruments
+card, and `SimulatedDAQ` stands in for one, so the rest of the chain can be tested without hardware.
+"""
+
+import threading
+import time
+import Queue
+import numpy as np
+
+
+class RingBuffer(object):
+    """A fixed-size buffer holding the most recent samples on each channel."""
+    def __init__(self, n_channels, capacity, dtype=np.float64):
+        self._data = np.zeros((n_channels, capacity), dtype=dtype)
+        self.capacity = capacity
+        self.total_written = 0
+        self._lock = threading.Lock()
+
+    def write(self, block):
+        """Add an (n_channels, n) block of samples, overwriting the oldest ones."""
+        block = np.asarray(block)
+        n = block.shape[1]
+        with self._lock:
+            if n >= self.capacity:
+                self._data[:, :] = block[:, n - self.capacity:]
+                self.total_written += n
+                return
+            start = self.total_written % self.capacity
+            first = min(n, self.capacity - start)
+            self._data[:, start:start + first] = block[:, :first]
+            self._data[:, :n - first] = block[:, first:]
+            self.total_written += n
+
+    def latest(self, n=None):
+        """Return (a copy of) the most recent n samples on each channel, oldest first.
+
+        If n is None, or fewer samples have been written, all the samples in the buffer are returned."""
+        with self._lock:
+            available = min(self.total_written, self.capacity)
+            n = available if n is None else min(n, available)
+            end = self.total_written % self.capacity
+            indices = np.arange(end - n, end) % self.capacity
+            return self._data[:, indices]
+
+
+class HDF5StreamWriter(object):
+    """A consumer that appends each block to a dataset on disk, which grows as data arrives.
+
+    If ``n_channels`` is None, blocks are 1D arrays and the dataset is 1D; otherwise blocks are (n_channels, n)
+    arrays, appended along the second axis.  Any further arguments the consumer is called with (e.g. the decoded
+    events from a `tttr.TTTRAcquisition`) are ignored, so the raw data is what's written.
+    """
+    def __init__(self, group, n_channels=None, name="daq_stream_%d", attrs=None, dtype=np.float64, chunks=True,
+                 flush_every=10):
+        if n_channels is None:
+            shape, maxshape = (0,), (None,)
+        else:
+            shape, maxshape = (n_channels, 0), (n_channels, None)
+        self.dataset = group.create_dataset(name, shape=shape, maxshape=maxshape, dtype=dtype, chunks=chunks,
+                                            attrs=attrs)
+        self.flush_every = flush_every
+        self._blocks = 0
+
+    def __call__(self, block, *args):
+        n = self.dataset.shape[-1]
+        self.dataset.resize(self.dataset.shape[:-1] + (n + block.shape[-1],))
+        self.dataset[..., n:] = block
+        self._blocks += 1
+        if self._blocks % self.flush_every == 0:
+            self.dataset.file.flush()
+
+    def close(self):
+        self.dataset.file.flush()
+
+
+class ThreadedAcquisition(object):
+    """Read blocks of data from a source in one thread, and pass them to consumers in another.
+
+    This is the engine behind `StreamingAcquisition` and `tttr.TTTRAcquisition`: subclasses supply the read step,
+    by overriding `read_block` and `finished`.  `read_block` returns a tuple of the arguments each consumer is called
+    with, or None if there's no data yet, in which case the reader sleeps for ``poll_interval`` seconds, or stops if
+    `finished` is True.  The source must have ``start()`` and ``stop()`` methods.
+
+    If a consumer has a ``close`` method, it's called when the acquisition finishes.  The reader only waits for the
+    consumers if ``max_queued_blocks`` blocks are waiting to be processed.
+    """
+    def __init__(self, source, consumers=(), max_queued_blocks=16, poll_interval=0.01):
+        self.source = source
+        self.consumers = list(consumers)
+        self.poll_interval = poll_interval
+        self._blocks = Queue.Queue(maxsize=max_queued_blocks)
+        self._stop_event = threading.Event()
+        self._errors = []
+        self._reader_thread = None
+        self._consumer_thread = None
+
+    def read_block(self):
+        """Read the next block from the source, returning the consumers' arguments as a tuple (or None)."""
+        raise NotImplementedError
+
+    @property
+    def finished(self):
+        """Whether the source has no more data to give (checked when `read_block` returns None)."""
+        return False
+
+    def start(self):
+        """Start the source, and the threads that read from it and pass the data to the consumers."""
+        self.source.start()
+        self._consumer_thread = threading.Thread(target=self._consume)
+        self._consumer_thread.start()
+        self._reader_thread = threading.Thread(target=self._read)
+        self._reader_thread.start()
+        return self
+
+    @property
+    def running(self):
+        """Whether the acquisition is still reading data."""
+        return self._reader_thread is not None and self._reader_thread.is_alive()
+
+    def wait(self, timeout=None):
+        """Wait for a finite acquisition to finish, then re-raise any error from the reader or consumers.
+
+        Returns True if the acquisition has finished."""
+        self._reader_thread.join(timeout)
+        if self._reader_thread.is_alive():
+            return False
+        self._consumer_thread.join()
+        if self._errors:
+            raise self._errors[0]
+        return True
+
+    def stop(self):
+        """Stop reading, let the consumers catch up, and re-raise any error from the reader or consumers."""
+        self._stop_event.set()
+        return self.wait()
+
+    def _read(self):
+        try:
+            while not self._stop_event.is_set() and not self._errors:
+                block = self.read_block()
+                if block is not None:
+                    self._blocks.put(block)
+                elif self.finished:
+                    break
+                else:
+                    time.sleep(self.poll_interval)
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            try:
+                self.source.stop()
+            finally:
+                self._blocks.put(None)
+
+    def _consume(self):
+        while True:
+            block = self._blocks.get()
+            if block is None:
+                break
+            if self._errors:
+                continue  # discard the data, but keep emptying the queue
+            try:
+                for consumer in self.consumers:
+                    consumer(*block)
+            except Exception as e:
+                self._errors.append(e)
+        for consumer in self.consumers:
+            if hasattr(consumer, "close"):
+                try:
+                    consumer.close()
+                except Exception as e:
+                    self._errors.append(e)
+
+
+class StreamingAcquisition(ThreadedAcquisition):
+    """Continuously read blocks from a source, into a ring buffer and on to consumers (see module docstring).
+
+    Arguments:
+    source : the source of data, e.g. a `SimulatedDAQ` or `NIDAQAISource`
+    samples_per_block : int
+        The number of samples per channel read at a time.
+    consumers : list of callables
+        Each one is called with every block, in a separate thread from the reader.  If a consumer has a ``close``
+        method, it's called when the acquisition finishes.
+    ring_capacity : int (default 10 blocks)
+        The number of samples per channel kept in `ring_buffer`, or 0 for no ring buffer.
+    sample_count : int (default None)
+        Stop after this many samples per channel (the last block is cut short), or run until `stop` if None.
+    max_queued_blocks : int (default 16)
+        The number of blocks that may be waiting for the consumers before the reader waits for them.
+    """
+    def __init__(self, source, samples_per_block, consumers=(), ring_capacity=None, sample_count=None,
+                 max_queued_blocks=16):
+        ThreadedAcquisition.__init__(self, source, consumers, max_queued_blocks)
+        self.samples_per_block = samples_per_block
+        if ring_capacity is None:
+            ring_capacity = 10 * samples_per_block
+        self.ring_buffer = RingBuffer(source.n_channels, ring_capacity) if ring_capacity > 0 else None
+        self.sample_count = sample_count
+        self.samples_read = 0
+
+    @property
+    def finished(self):
+        return self.sample_count is not None and self.samples_read >= self.sample_count
+
+    def read_block(self):
+        n = self.samples_per_block
+        if self.sample_count is not None:
+            n = min(n, self.sample_count - self.samples_read)
+            if n <= 0:
+                return None
+        block = self.source.read_block(n)
+        if self.ring_buffer is not None:
+            self.ring_buffer.write(block)
+        self.samples_read += n
+        return (block,)
+
+
+class SimulatedDAQ(object):
+    """A stand-in for a DAQ card, for testing continuous acquisitions without hardware.
+
+    The analog inputs read ``signal(t)``, where t is an array of sample times and the result is an
+    (n_channels, len(t)) array (by default, Gaussian noise).  If an analog output waveform has been set with
+    `write_ao_waveform`, it is added to the inputs, as if each output were wired to the input with the same index,
+    and regenerated continuously, as in a synchronised scan.  If ``realtime`` is True, `read_block` waits as long as
+    real hardware would.
+    """
+    def __init__(self, n_channels, sample_rate, signal=None, realtime=True):
+        self.n_channels = n_channels
+        self.sample_rate = float(sample_rate)
+        self.signal = signal
+        self.realtime = realtime
+        self.ao_waveform = None
+        self.running = False
+        self._samples = 0
+        self._start_time = None
+
+    def write_ao_waveform(self, waveform):
+        """Set the (n_ao_channels, n_points) waveform looped back onto the first n_ao_channels inputs."""
+        waveform = np.atleast_2d(np.asarray(waveform, dtype=np.float64))
+        assert waveform.shape[0] <= self.n_channels, "There are more outputs than inputs to loop them back to"
+        self.ao_waveform = waveform
+
+    def start(self):
+        self._samples = 0
+        self._start_time = time.time()
+        self.running = True
+
+    def read_block(self, n):
+        assert self.running, "The simulated DAQ has not been started"
+        indices = np.arange(self._samples, self._samples + n)
+        self._samples += n
+        if self.realtime:
+            delay = self._start_time + self._samples / self.sample_rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        t = indices / self.sample_rate
+        if self.signal is not None:
+            block = np.array(self.signal(t), dtype=np.float64).reshape(self.n_channels, n)
+        else:
+            block = np.random.normal(size=(self.n_channels, n))
+        if self.ao_waveform is not None:
+            n_ao, n_points = self.ao_waveform.shape
+            block[:n_ao, :] += self.ao_waveform[:, indices % n_points]
+        return block
+
+    def stop(self):
+        self.running = False
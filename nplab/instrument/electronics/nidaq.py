@@ -1,6 +1,7 @@
 __author__ = 'alansanders'
 
 from nplab.instrument import Instrument
+from nplab.instrument.electronics.daq_streaming import StreamingAcquisition
 from PyDAQmx import *
 import PyDAQmx as pdmx #pointess line of code ?
 import numpy as np
@@ -155,6 +156,111 @@ class NIDAQ(Instrument):
         """
         self.current_task.StopTask()
 
+    def stream_ai(self, channels, sample_rate, samples_per_block, consumers=(), sample_count=None,
+                  ring_capacity=None, buffer_size=None):
+        """
+        Start a continuous, hardware-timed analog input acquisition, which runs in the background
+        until stopped (or until sample_count samples per channel have been read).
+
+        Every block of samples_per_block samples is kept in the returned acquisition's ring_buffer
+        and passed to each of the consumers, e.g. a daq_streaming.HDF5StreamWriter.
+
+        :param channels: an iterable containing a sequence of channel identifiers, e.g. 0,1,2..
+        :param sample_rate: the sampling frequency
+        :param samples_per_block: the number of samples per channel read at a time
+        :param consumers: callables that are given each (channels, samples) block of data
+        :param sample_count: the number of samples per channel to acquire, or None to run until stopped
+        :param ring_capacity: the number of samples per channel kept in the ring buffer
+        :param buffer_size: the size of the card's buffer, per channel (default: 10 blocks)
+        :return: a started daq_streaming.StreamingAcquisition
+        """
+        source = NIDAQAISource(self.device_id, channels, sample_rate, buffer_size or 10 * samples_per_block)
+        acquisition = StreamingAcquisition(source, samples_per_block, consumers=consumers,
+                                           sample_count=sample_count, ring_capacity=ring_capacity)
+        return acquisition.start()
+
+    def synchronised_scan(self, ao_channels, ao_waveform, ai_channels, sample_rate, samples_per_block,
+                          consumers=(), repeats=1, ring_capacity=None):
+        """
+        Output a waveform on the analog outputs while acquiring on the analog inputs, with both tasks
+        clocked by the analog input sample clock, so every output point lines up with an input sample.
+
+        :param ao_channels: the analog output channels, e.g. [0, 1]
+        :param ao_waveform: an (len(ao_channels), n_points) array of output voltages
+        :param ai_channels: the analog input channels
+        :param sample_rate: the sampling frequency of both input and output
+        :param samples_per_block: the number of samples per channel read at a time
+        :param consumers: callables that are given each block of input data
+        :param repeats: the number of times the waveform is output (it is regenerated continuously)
+        :return: a started daq_streaming.StreamingAcquisition - call wait() for the scan to finish
+        """
+        ao_waveform = np.atleast_2d(np.asarray(ao_waveform, dtype=np.float64))
+        n_points = ao_waveform.shape[1]
+        source = NIDAQAISource(self.device_id, ai_channels, sample_rate, max(n_points, 10 * samples_per_block),
+                               ao_channels=ao_channels, ao_waveform=ao_waveform)
+        acquisition = StreamingAcquisition(source, samples_per_block, consumers=consumers,
+                                           sample_count=n_points * repeats, ring_capacity=ring_capacity)
+        return acquisition.start()
+
+
+class NIDAQAISource(object):
+    """A continuous, hardware-timed analog input task, for use with daq_streaming.StreamingAcquisition.
+
+    If an analog output waveform is given, it is output continuously on ao_channels, clocked by the
+    analog input sample clock, so the outputs and inputs are synchronised.
+    """
+    def __init__(self, device_id, channels, sample_rate, buffer_size, voltage_range=(-10.0, 10.0),
+                 ao_channels=None, ao_waveform=None, timeout=10.0):
+        self.device_id = device_id
+        self.channels = list(channels)
+        self.n_channels = len(self.channels)
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.voltage_range = voltage_range
+        self.ao_channels = ao_channels
+        self.ao_waveform = ao_waveform
+        self.timeout = timeout
+        self.analog_input = None
+        self.analog_output = None
+
+    def start(self):
+        analog_input = Task()
+        s = ','.join('{0}/ai{1}'.format(self.device_id, ch) for ch in self.channels)
+        analog_input.CreateAIVoltageChan(s, "", DAQmx_Val_Cfg_Default, self.voltage_range[0],
+                                         self.voltage_range[1], DAQmx_Val_Volts, None)
+        analog_input.CfgSampClkTiming("", self.sample_rate, DAQmx_Val_Rising, DAQmx_Val_ContSamps,
+                                      self.buffer_size)
+        if self.ao_waveform is not None:
+            n_points = self.ao_waveform.shape[1]
+            analog_output = Task()
+            s = ','.join('{0}/ao{1}'.format(self.device_id, ch) for ch in self.ao_channels)
+            analog_output.CreateAOVoltageChan(s, "", self.voltage_range[0], self.voltage_range[1],
+                                              DAQmx_Val_Volts, None)
+            analog_output.CfgSampClkTiming("/{0}/ai/SampleClock".format(self.device_id), self.sample_rate,
+                                           DAQmx_Val_Rising, DAQmx_Val_ContSamps, n_points)
+            analog_output.WriteAnalogF64(n_points, False, self.timeout, DAQmx_Val_GroupByChannel,
+                                         np.ascontiguousarray(self.ao_waveform).ravel(), byref(int32()), None)
+            # the output waits for the input's sample clock, so it must be started first
+            analog_output.StartTask()
+            self.analog_output = analog_output
+        analog_input.StartTask()
+        self.analog_input = analog_input
+
+    def read_block(self, n):
+        data = np.empty((self.n_channels, n), dtype=np.float64)
+        read = int32()
+        self.analog_input.ReadAnalogF64(n, self.timeout, DAQmx_Val_GroupByChannel, data, data.size,
+                                        byref(read), None)
+        return data
+
+    def stop(self):
+        for task in (self.analog_input, self.analog_output):
+            if task is not None:
+                task.StopTask()
+                task.ClearTask()
+        self.analog_input = None
+        self.analog_output = None
+
 
 
 class Itask(Task):
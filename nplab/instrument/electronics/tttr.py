@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Time-tagged (TTTR) event streaming
+==================================
+
+In time-tagged time-resolved (TTTR) mode, a TCSPC card like the TimeHarp 200 records every photon as a 32 bit
+event record, instead of building a histogram on the card.  A `TTTRAcquisition` reads these records continuously
+on a worker thread into numpy buffers, decodes them (vectorised - see `decode_t3r_records`), and passes each
+block on to consumers in a second thread (using `daq_streaming.ThreadedAcquisition`), so slow consumers don't
+make the card's FIFO overflow:
+
+* `MicrotimeHistogram` builds the usual start-stop (lifetime) histogram as the data arrives,
+* `EventCorrelator` builds the intensity cross-correlation (g2) between two detectors, and
+* `daq_streaming.HDF5StreamWriter` writes the raw records to a chunked, resizable HDF5 dataset, e.g.
+  ``HDF5StreamWriter(group, name="tttr_records_%d", dtype=np.uint32, chunks=(65536,))``.
+
+A source has ``start()``, ``read_records()`` and ``stop()`` methods, and a ``finished`` attribute.
+``read_records`` returns a (possibly empty) uint32 array of the records that have arrived since it was last called,
+and ``finished`` becomes True when the source has no more to give.  `nplab.instrument.electronics.TimeHarp`
+provides `TimeHarpTTTRSource`, and `SyntheticEventSource` stands in for a card in tests.
+
+TimeHarp 200 T3R records are packed as follows (bit 0 is the least significant):
+
+    bits 0-15   time tag: the macrotime, in units of the 100ns TTTR clock, modulo 65536
+    bits 16-27  channel: the microtime, i.e. the start-stop time bin
+    bits 28-29  route: the detector, if a router is used
+    bit 30      valid: 0 for special records, where bit 11 of the channel field marks a time tag overflow
+"""
+
+import numpy as np
+
+from nplab.instrument.electronics.daq_streaming import ThreadedAcquisition
+
+TIME_TAG_BITS = 16
+OVERFLOW_PERIOD = 2 ** TIME_TAG_BITS
+TTTR_CLOCK_PERIOD = 100e-9
+
+event_dtype = np.dtype([('macrotime', np.int64), ('microtime', np.uint16), ('route', np.uint8)])
+
+
+def decode_t3r_records(records, overflows=0):
+    """Decode TimeHarp 200 T3R records into an array of events (with fields macrotime, microtime and route).
+
+    The macrotimes are unwrapped using the overflow records.  ``overflows`` is the number of overflows before this
+    block of records; the number after it is returned too, so that consecutive blocks can be decoded seamlessly.
+
+    Returns: events, overflows
+    """
+    records = np.asarray(records, dtype=np.uint32)
+    valid = (records >> 30) & 1 == 1
+    channel = (records >> 16) & 0xFFF
+    overflow = ~valid & (channel & 0x800 != 0)
+    overflow_count = overflows + np.cumsum(overflow)
+    events = np.empty(np.count_nonzero(valid), dtype=event_dtype)
+    events['macrotime'] = (records[valid] & 0xFFFF) + OVERFLOW_PERIOD * overflow_count[valid]
+    events['microtime'] = channel[valid]
+    events['route'] = (records[valid] >> 28) & 0x3
+    return events, overflows + int(np.count_nonzero(overflow))
+
+
+def encode_t3r_records(macrotimes, microtimes, routes=None):
+    """Pack events into T3R records, inserting overflow records as needed (the inverse of `decode_t3r_records`).
+
+    The macrotimes must be sorted, and start from zero."""
+    macrotimes = np.asarray(macrotimes, dtype=np.int64)
+    if routes is None:
+        routes = np.zeros(len(macrotimes), dtype=np.int64)
+    periods = macrotimes // OVERFLOW_PERIOD
+    # each event is preceded by the overflows since the previous one
+    overflows_before = np.diff(np.concatenate(([0], periods)))
+    positions = np.arange(len(macrotimes)) + np.cumsum(overflows_before)
+    records = np.full(len(macrotimes) + (periods[-1] if len(periods) else 0), 0x800 << 16, dtype=np.uint32)
+    records[positions] = ((1 << 30) | (np.asarray(routes, dtype=np.int64) << 28) |
+                          (np.asarray(microtimes, dtype=np.int64) << 16) | (macrotimes % OVERFLOW_PERIOD))
+    return records
+
+
+class MicrotimeHistogram(object):
+    """A consumer that accumulates the histogram of microtimes (i.e. the TCSPC decay curve) for each route."""
+    def __init__(self, n_bins=4096, n_routes=1):
+        self.counts = np.zeros((n_routes, n_bins), dtype=np.int64)
+
+    def __call__(self, records, events):
+        n_routes, n_bins = self.counts.shape
+        # bin route and microtime together, so one bincount does all the routes
+        index = events['route'].astype(np.int64) * n_bins + events['microtime']
+        self.counts += np.bincount(index, minlength=n_routes * n_bins)[:n_routes * n_bins].reshape(n_routes,
+                                                                                                   n_bins)
+
+
+class EventCorrelator(object):
+    """A consumer that builds the cross-correlation histogram of macrotimes between two routes (detectors).
+
+    The histogram counts pairs of events, one on route_a and one on route_b a time lag later, for lags from
+    -max_lag to max_lag (in macrotime units), in bins of bin_width.  Events from the end of each block are kept
+    so pairs spanning two blocks are counted.  If route_a == route_b, this is the autocorrelation, and each event
+    isn't paired with itself.
+    """
+    def __init__(self, route_a=0, route_b=1, max_lag=1000, bin_width=1):
+        self.route_a = route_a
+        self.route_b = route_b
+        self.max_lag = max_lag
+        self.bin_width = bin_width
+        self.n_bins = int(np.ceil(2.0 * max_lag / bin_width))
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.n_a = 0
+        self.n_b = 0
+        self.first_time = None
+        self.last_time = None
+        self._history_a = np.zeros(0, dtype=np.int64)
+        self._history_b = np.zeros(0, dtype=np.int64)
+
+    @property
+    def lags(self):
+        """The lag at the start of each bin, in macrotime units."""
+        return -self.max_lag + self.bin_width * np.arange(self.n_bins)
+
+    def _count_pairs(self, times_a, times_b):
+        """Add the lags between each event in times_a and the events in times_b within max_lag to the histogram."""
+        if len(times_a) == 0 or len(times_b) == 0:
+            return
+        low = np.searchsorted(times_b, times_a - self.max_lag, 'left')
+        high = np.searchsorted(times_b, times_a + self.max_lag, 'left')
+        n_pairs = high - low
+        a_index = np.repeat(np.arange(len(times_a)), n_pairs)
+        # the position of each pair within the run of pairs for its event in times_a
+        offsets = np.arange(len(a_index)) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+        lags = times_b[low[a_index] + offsets] - times_a[a_index]
+        self.counts += np.bincount((lags + self.max_lag) // self.bin_width,
+                                   minlength=self.n_bins)[:self.n_bins]
+
+    def __call__(self, records, events):
+        if len(events) == 0:
+            return
+        times = events['macrotime']
+        new_a = times[events['route'] == self.route_a]
+        new_b = times[events['route'] == self.route_b]
+        self._count_pairs(new_a, np.concatenate((self._history_b, new_b)))
+        self._count_pairs(self._history_a, new_b)
+        if self.route_a == self.route_b:
+            self.counts[self.max_lag // self.bin_width] -= len(new_a)  # don't pair events with themselves
+        self.n_a += len(new_a)
+        self.n_b += len(new_b)
+        if self.first_time is None:
+            self.first_time = times[0]
+        self.last_time = times[-1]
+        # only events within max_lag of the end can pair with events in later blocks
+        cutoff = self.last_time - self.max_lag
+        self._history_a = np.concatenate((self._history_a, new_a))
+        self._history_a = self._history_a[self._history_a >= cutoff]
+        self._history_b = np.concatenate((self._history_b, new_b))
+        self._history_b = self._history_b[self._history_b >= cutoff]
+
+    @property
+    def g2(self):
+        """The correlation histogram, normalised by the number of pairs expected for uncorrelated events."""
+        duration = self.last_time - self.first_time
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.counts * float(duration) / (float(self.n_a) * self.n_b * self.bin_width)
+
+
+class TTTRAcquisition(ThreadedAcquisition):
+    """Continuously read event records from a source, and pass them to consumers (see module docstring).
+
+    Each consumer is called as ``consumer(records, events)``, with the raw uint32 records and the decoded events,
+    in a separate thread from the reader.  If a consumer has a ``close`` method, it's called at the end.
+    """
+    def __init__(self, source, consumers=(), poll_interval=0.01, max_queued_blocks=64):
+        ThreadedAcquisition.__init__(self, source, consumers, max_queued_blocks, poll_interval)
+        self.records_read = 0
+        self.overflows = 0
+
+    @property
+    def finished(self):
+        return self.source.finished
+
+    def read_block(self):
+        records = self.source.read_records()
+        if len(records) == 0:
+            return None
+        events, self.overflows = decode_t3r_records(records, self.overflows)
+        self.records_read += len(records)
+        return records, events
+
+
+class SyntheticEventSource(object):
+    """A stand-in for a TCSPC card in TTTR mode, which gives out a fixed set of events in blocks.
+
+    The events are Poisson-distributed in time, at ``count_rate`` events per macrotime unit, spread over
+    ``n_routes`` routes, with exponentially distributed microtimes (a fluorescence decay of ``lifetime`` bins).
+    """
+    def __init__(self, n_events=100000, count_rate=0.01, n_routes=2, lifetime=200.0, n_bins=4096,
+                 block_size=5000, seed=0):
+        random = np.random.RandomState(seed)
+        self.macrotimes = np.cumsum(random.geometric(count_rate, size=n_events)) - 1
+        self.microtimes = np.minimum(random.exponential(lifetime, size=n_events).astype(np.int64), n_bins - 1)
+        self.routes = random.randint(0, n_routes, size=n_events)
+        self.records = encode_t3r_records(self.macrotimes, self.microtimes, self.routes)
+        self.block_size = block_size
+        self.finished = False
+        self._position = 0
+
+    def start(self):
+        self._position = 0
+        self.finished = False
+
+    def read_records(self):
+        records = self.records[self._position:self._position + self.block_size]
+        self._position += len(records)
+        self.finished = self._position >= len(self.records)
+        return records
+
+    def stop(self):
+        self.finished = True
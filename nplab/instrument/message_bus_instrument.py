@@ -13,6 +13,7 @@ import re
 import nplab.instrument
 from functools import partial
 import threading
+from nplab.utils.thread_utils import Future
 
 
 class MessageBusInstrument(nplab.instrument.Instrument):
@@ -124,6 +125,27 @@ class MessageBusInstrument(nplab.instrument.Instrument):
                 return self.read_multiline(termination_line)
             else:
                 return self.readline(timeout).strip() #question: should we strip the final newline?
+    def query_async(self, queryString, multiline=False, termination_line=None, timeout=None):
+        """Send a query, returning a `QueryFuture` that will hold the reply.
+
+        Instruments that can read the bus in the background (e.g. a
+        `SerialInstrument` with its reader thread running) return immediately,
+        so several queries can be outstanding at once.  This base
+        implementation simply performs the query (blocking) and returns a
+        future that has already completed, so code written against the
+        asynchronous interface works with every instrument.
+        """
+        future = QueryFuture(queryString, multiline=multiline,
+                             termination_line=termination_line,
+                             ignore_echo=self.ignore_echo)
+        try:
+            future.set_result(self.query(queryString, multiline=multiline,
+                                         termination_line=termination_line,
+                                         timeout=timeout))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
     def parsed_query_old(self, query_string, response_string=r"(\d+)", re_flags=0, parse_function=int, **kwargs):
         """
         Perform a query, then parse the result.
@@ -214,6 +236,49 @@ class MessageBusInstrument(nplab.instrument.Instrument):
     #    return property(fget=partial(get_func, get_cmd), fset=self.write, docstring=docstring)
 
 
+class QueryFuture(Future):
+    """The eventual reply to a query sent with `MessageBusInstrument.query_async`.
+
+    Use `done()` to check whether the reply has arrived and `result()` to wait
+    for it (see `nplab.utils.thread_utils.Future`).  Lines read from the bus
+    are passed in with `feed_line()`, which takes care of discarding echoed
+    commands and assembling multi-line replies.  `timeout` is how long to wait
+    for the reply once the query has been sent, and `deadline` is set to the
+    time when that runs out.  A query that has timed out may still be fed its
+    late reply, which is then discarded.
+    """
+    deadline = None
+
+    def __init__(self, query_string, multiline=False, termination_line=None, ignore_echo=False, timeout=None):
+        Future.__init__(self)
+        self.timeout = timeout
+        self.query_string = query_string
+        self.description = "a reply to '%s'" % query_string
+        self.termination_line = termination_line
+        self.multiline = multiline or termination_line is not None
+        self.ignore_echo = ignore_echo
+        self._lines = []
+
+    def feed_line(self, line):
+        """Supply a line read from the bus.  Returns True once the reply is complete."""
+        if self.ignore_echo and len(self._lines) == 0 and line.strip() == self.query_string:
+            self.ignore_echo = False # only the first line can be the echo
+            return False
+        self.ignore_echo = False
+        if not self.multiline:
+            self._reply_complete(line.strip())
+            return True
+        self._lines.append(line)
+        if self.termination_line in line:
+            self._reply_complete("".join(self._lines))
+            return True
+        return False
+
+    def _reply_complete(self, reply):
+        if not self.done(): # if we already timed out, nobody wants the reply
+            self.set_result(reply)
+
+
 class queried_property(object):
     """A Property interface that reads and writes from the instrument on the bus.
     
@@ -221,9 +286,14 @@ class queried_property(object):
     in a class definition just like a property.  The property it creates will
     interact with the instrument over the communication bus to set and retrieve
     its value.
+    
+    If `cache_ttl` is given, and the instrument's property cache is enabled
+    (see `Instrument.enable_property_cache`), values read from the instrument
+    are re-used for up to `cache_ttl` seconds.  Setting the property discards
+    the cached value.
     """
     def __init__(self, get_cmd=None, set_cmd=None, validate=None, valrange=None,
-                 fdel=None, doc=None, dtype='float'):
+                 fdel=None, doc=None, dtype='float', cache_ttl=None):
         self.dtype = dtype
         self.get_cmd = get_cmd
         self.set_cmd = set_cmd
@@ -231,6 +301,14 @@ class queried_property(object):
         self.valrange = valrange
         self.fdel = fdel
         self.__doc__ = doc
+        self.cache_ttl = cache_ttl
+        self._name = None
+
+    def _cache_name(self, obj):
+        """The name used for this property in the instrument's property cache."""
+        if self._name is None:
+            self._name = nplab.instrument.descriptor_name(self, obj)
+        return self._name
 
     # TODO: standardise the return (single value only vs parsed result), consider bool
     def __get__(self, obj, objtype=None):
@@ -239,6 +317,14 @@ class queried_property(object):
             return self
         if self.get_cmd is None:
             raise AttributeError("unreadable attribute")
+        if getattr(obj, 'property_cache', None) is not None:
+            return obj.cached_property_value(self._cache_name(obj),
+                                             partial(self._read, obj),
+                                             self.cache_ttl)
+        return self._read(obj)
+
+    def _read(self, obj):
+        """Query the instrument for the current value."""
         if self.dtype == 'float':
             getter = obj.float_query
         elif self.dtype == 'int':
@@ -266,6 +352,8 @@ class queried_property(object):
         elif '%' in message:
             message = message % value
         obj.write(message)
+        if getattr(obj, 'property_cache', None) is not None:
+            obj.invalidate_property_cache(self._cache_name(obj))
 
     def __delete__(self, obj):
         if self.fdel is None:
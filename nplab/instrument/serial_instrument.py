@@ -6,8 +6,11 @@ Serial Instrument interface
 """
 from traits.api import HasTraits, Bool, Int, Str, Button, Array, Enum, List
 import nplab
-from nplab.instrument.message_bus_instrument import MessageBusInstrument
+from nplab.instrument.message_bus_instrument import MessageBusInstrument, QueryFuture
 import threading
+import time
+import Queue
+import collections
 import serial
 import serial.tools.list_ports
 from serial import FIVEBITS, SIXBITS, SEVENBITS, EIGHTBITS
@@ -51,6 +54,15 @@ class SerialInstrument(MessageBusInstrument):
     
     _serial_port_lock = threading.Lock()
     
+    max_outstanding_queries = 1
+    """The number of queries that may be sent before their replies arrive, when
+    the reader thread is running.  Leave this at 1 unless the device accepts
+    pipelined commands (i.e. it queues commands and replies to them in order).
+    """
+    reader_poll_interval = 0.05 #: Read timeout (in seconds) used by the reader thread
+    default_query_timeout = 10 #: Reply timeout (in seconds) for queued queries if the port has none
+    _reader_thread = None
+    
     def __init__(self, port=None):
         """
         Set up the serial port and so on.
@@ -81,6 +93,7 @@ class SerialInstrument(MessageBusInstrument):
     
     def close(self):
         """Release the serial port"""
+        self.stop_reader_thread()
         with self.communications_lock:
             try:
                 self.ser.close()
@@ -103,11 +116,213 @@ class SerialInstrument(MessageBusInstrument):
     def flush_input_buffer(self):
         """Make sure there's nothing waiting to be read, and clear the buffer if there is."""
         with self.communications_lock:
+            if self.reader_thread_running:
+                # Lines belonging to outstanding queries are kept, but 
+                # anything unsolicited is thrown away.
+                while True:
+                    try:
+                        self._unsolicited_lines.get_nowait()
+                    except Queue.Empty:
+                        break
+                return
             if self.ser.inWaiting()>0: self.ser.flushInput()
     def readline(self, timeout=None):
         """Read one line from the serial port."""
+        if self.reader_thread_running:
+            # The reader thread owns the port: take the next line it read that
+            # wasn't a reply to an outstanding query.
+            try:
+                return self._unsolicited_lines.get(timeout=timeout)
+            except Queue.Empty:
+                return ""
         with self.communications_lock:
             return self.ser_io.readline().replace(self.termination_character,"\n")
+
+    def query(self, queryString, multiline=False, termination_line=None, timeout=None):
+        """Write a string to the instrument and return its response.
+        
+        If the reader thread is running, this is equivalent to waiting for the
+        result of `query_async` (so it times out in the same way).
+        """
+        if self.reader_thread_running:
+            return self.query_async(queryString, multiline=multiline,
+                                    termination_line=termination_line,
+                                    timeout=timeout).result()
+        return MessageBusInstrument.query(self, queryString, multiline=multiline,
+                                          termination_line=termination_line,
+                                          timeout=timeout)
+
+    def query_async(self, queryString, multiline=False, termination_line=None, timeout=None):
+        """Send a query without waiting for the reply, returning a `QueryFuture`.
+        
+        If the reader thread isn't running, this blocks and returns a completed
+        future.  Otherwise, the query is placed on a queue and sent as soon as
+        fewer than `max_outstanding_queries` replies are pending.  Replies are
+        matched to queries in the order the queries were sent, so it's only 
+        safe to pipeline queries on devices that reply in order.
+        
+        If no reply has arrived `timeout` seconds after the query was sent 
+        (by default, the port's timeout, or `default_query_timeout` if that is
+        None) the future fails with an IOError.  The query keeps its place in
+        the queue for another `timeout` seconds, so that a late reply is 
+        discarded rather than passed to the next query.  If nothing arrives
+        in that time either, the reply is assumed to be lost.
+        """
+        if not self.reader_thread_running:
+            return MessageBusInstrument.query_async(self, queryString, multiline=multiline,
+                                                    termination_line=termination_line,
+                                                    timeout=timeout)
+        if multiline and termination_line is None:
+            termination_line = self.termination_line
+            if termination_line is None:
+                raise ValueError("A multiline query needs a termination line, either through the termination_line keyword argument or the termination_line property.")
+        if timeout is None:
+            timeout = self._original_timeout
+        if timeout is None:
+            timeout = self.default_query_timeout
+        future = QueryFuture(queryString, multiline=multiline,
+                             termination_line=termination_line,
+                             ignore_echo=self.ignore_echo, timeout=timeout)
+        self._query_queue.put(future)
+        return future
+
+    @property
+    def reader_thread_running(self):
+        """Whether a background thread is currently reading from the port."""
+        return self._reader_thread is not None and self._reader_thread.is_alive()
+
+    def start_reader_thread(self):
+        """Start reading the serial port continuously in the background.
+        
+        While the reader thread runs, every line received is either passed to
+        the oldest outstanding `query_async` request or (if there isn't one)
+        queued up for `readline`.  This means a slow device doesn't hold the
+        communications lock while it thinks, and queries may be pipelined (see
+        `max_outstanding_queries`).
+        """
+        with self.communications_lock:
+            if self.reader_thread_running:
+                return
+            assert self.ser.isOpen(), "The serial port must be open before starting the reader thread."
+            self.flush_input_buffer()
+            self._unsolicited_lines = Queue.Queue()
+            self._query_queue = Queue.Queue()
+            self._pending_queries = collections.deque()
+            self._pending_lock = threading.Lock()
+            self._query_slots = threading.Semaphore(self.max_outstanding_queries)
+            self._stop_reader = threading.Event()
+            self._original_timeout = self.ser.timeout
+            self.ser.timeout = self.reader_poll_interval
+            self._reader_thread = threading.Thread(target=self._reader_loop)
+            self._reader_thread.daemon = True
+            self._writer_thread = threading.Thread(target=self._writer_loop)
+            self._writer_thread.daemon = True
+            self._reader_thread.start()
+            self._writer_thread.start()
+
+    def stop_reader_thread(self):
+        """Stop the background reader, failing any queries still waiting for a reply."""
+        if self._reader_thread is None:
+            return
+        self._stop_reader.set()
+        self._query_queue.put(None) # wake up the writer thread
+        for t in [self._reader_thread, self._writer_thread]:
+            if t is not threading.current_thread():
+                t.join()
+        self._reader_thread = None
+        with self._pending_lock:
+            while len(self._pending_queries) > 0:
+                self._pending_queries.popleft().set_exception(
+                        IOError("The reader thread stopped before a reply was received."))
+            while True:
+                try:
+                    future = self._query_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if future is not None:
+                    future.set_exception(IOError("The reader thread stopped before the query was sent."))
+            self.ser.timeout = self._original_timeout
+
+    def _writer_loop(self):
+        """Send queued queries, keeping at most `max_outstanding_queries` in flight."""
+        while not self._stop_reader.is_set():
+            future = self._query_queue.get()
+            if future is None or future.done(): # it may have failed already
+                continue
+            while not self._query_slots.acquire(False): # wait for a free slot
+                if self._stop_reader.wait(self.reader_poll_interval):
+                    future.set_exception(IOError("The reader thread stopped before the query was sent."))
+                    return
+            with self.communications_lock:
+                with self._pending_lock:
+                    if future.timeout is not None:
+                        future.deadline = time.time() + future.timeout
+                    self._pending_queries.append(future)
+                try:
+                    self.write(future.query_string)
+                except Exception as e:
+                    with self._pending_lock:
+                        self._pending_queries.remove(future)
+                    self._query_slots.release()
+                    future.set_exception(e)
+
+    def _reader_loop(self):
+        """Read from the port, splitting the data into lines and dispatching them."""
+        buffered = ""
+        while not self._stop_reader.is_set():
+            try:
+                data = self.ser.read(max(1, self.ser.inWaiting()))
+            except Exception as e:
+                self.log("The serial reader thread stopped because of an error: {0}".format(e), level='error')
+                self._stop_reader.set()
+                break
+            buffered += data
+            while self.termination_character in buffered:
+                line, buffered = buffered.split(self.termination_character, 1)
+                self._dispatch_line(line + "\n")
+            self._expire_queries()
+
+    def _dispatch_line(self, line):
+        """Pass a line to the oldest outstanding query, or queue it for readline.
+        
+        NB this runs in the reader thread, so callbacks added to the futures
+        must not block waiting for other replies.
+        """
+        with self._pending_lock:
+            if len(self._pending_queries) == 0:
+                self._unsolicited_lines.put(line)
+                return
+            future = self._pending_queries[0]
+            try:
+                complete = future.feed_line(line)
+            except Exception as e: # don't let a bad reply kill the reader thread
+                future.set_exception(e)
+                complete = True
+            if complete:
+                self._pending_queries.popleft()
+                self._query_slots.release()
+
+    def _expire_queries(self):
+        """Fail any queries whose replies haven't arrived in time.
+        
+        A query that times out stays in `_pending_queries` (and keeps its slot)
+        for another `timeout` seconds, so that if its reply turns up late it
+        is swallowed there, and doesn't end up paired with the next query.
+        After that, we assume the reply was lost and free the slot.
+        """
+        now = time.time()
+        with self._pending_lock:
+            for future in list(self._pending_queries):
+                if future.deadline is None or now <= future.deadline:
+                    continue
+                if not future.done():
+                    future.set_exception(IOError("Timed out waiting for %s" % future.description))
+                    future.deadline = now + future.timeout
+                else:
+                    self._pending_queries.remove(future)
+                    self._query_slots.release()
+                    self.log("Gave up waiting for a late reply to '{0}'.".format(future.query_string), level='warn')
+
     def test_communications(self):
         """Check if the device is available on the current port.  
         
@@ -4,25 +4,83 @@ import numpy as np
 import numpy.ma as ma
 from nplab.utils.gui import QtCore, QtGui, QtWidgets, get_qt_app, uic
 
-from collections import deque
 
 from nplab.ui.ui_tools import UiTools
 from nplab.datafile import DataFile
 from nplab.utils.notified_property import NotifiedProperty, DumbNotifiedProperty, register_for_property_changes
 import h5py
-from multiprocessing.pool import ThreadPool
 
 import time
+import threading
 
 import os
 import inspect
 import datetime
 from nplab.instrument import Instrument
+from nplab.instrument.spectrometer.averaging import SpectrumAverager
+from nplab.instrument.spectrometer.synchronised import SpectrometerWorker, stitch_indices
 import warnings
 import pyqtgraph as pg
 from weakref import WeakSet
 
 
+def process_spectra(spectra, integration_times, background=None, reference=None, background_constant=None,
+                    background_gradient=None, reference_int=None, variable_int_enabled=False,
+                    absorption_enabled=False):
+    """Subtract the background and divide by the reference, for a spectrum or a stack of spectra.
+
+    Arguments:
+    spectra : np.ndarray
+        A single spectrum, or an NxM array of N spectra.
+    integration_times : float or np.ndarray
+        The integration time of the spectra - either one value, or one per spectrum.  This is only used if
+        variable_int_enabled is True, when the background is scaled to each spectrum's integration time.
+    The remaining arguments are the spectrometer's processing settings, named as in `Spectrometer`.
+
+    All the spectra are processed in one go, which is much faster than processing them one at a time, but the
+    arithmetic is the same as `Spectrometer.process_spectrum`, so the results are identical.
+    """
+    spectra = np.asanyarray(spectra)
+    integration_times = np.asarray(integration_times)
+    if spectra.ndim > 1 and integration_times.ndim == 1:
+        integration_times = integration_times[:, np.newaxis] # one integration time per row
+    if background is not None:
+        if reference is not None:
+            old_error_settings = np.seterr(all='ignore')
+            if variable_int_enabled == True:
+                new_spectra = ((spectra-(background_constant+background_gradient*integration_times))
+                               /((reference-(background_constant+background_gradient*reference_int))*integration_times/reference_int))
+            else:
+                new_spectra = (spectra-background)/(reference-background)
+            np.seterr(**old_error_settings)
+            new_spectra[np.isinf(new_spectra)] = np.NaN #if the reference is nearly 0, we get infinities - just make them all NaNs.
+        else:
+            if variable_int_enabled == True:
+                new_spectra = spectra-(background_constant+background_gradient*integration_times)
+            else:
+                new_spectra = spectra-background
+    else:
+        new_spectra = spectra
+    if absorption_enabled == True:
+        return np.log10(1/new_spectra)
+    return new_spectra
+
+
+def process_saved_spectra(spectra, attrs, integration_times=None):
+    """Process raw spectra that were saved by a `Spectrometer`, using the settings saved in their metadata.
+
+    `spectra` may be a dataset holding one spectrum or a stack of them, and `attrs` the metadata saved with
+    them (e.g. ``dataset.attrs``).  If `integration_times` is not given, the saved integration time is used.
+    """
+    if integration_times is None:
+        integration_times = attrs['integration_time']
+    return process_spectra(np.asarray(spectra), integration_times,
+                           **dict((k, attrs.get(k, None)) for k in ['background', 'reference',
+                                                                    'background_constant', 'background_gradient',
+                                                                    'reference_int', 'variable_int_enabled',
+                                                                    'absorption_enabled']))
+
+
 class Spectrometer(Instrument):
 
     metadata_property_names = ('model_name', 'serial_number', 'integration_time',
@@ -30,6 +88,7 @@ class Spectrometer(Instrument):
                                'background_int', 'reference_int','variable_int_enabled',
                                'background_gradient','background_constant', 'averaging_enabled'
                                ,'absorption_enabled')
+    shared_metadata_min_size = 64 # wavelengths, reference and background are saved once per file
    
     variable_int_enabled = DumbNotifiedProperty(False)
     filename = DumbNotifiedProperty("spectrum")
@@ -48,7 +107,8 @@ class Spectrometer(Instrument):
         self.latest_raw_spectrum = None
         self.latest_spectrum = None
         self.averaging_enabled = False
-        self.spectra_deque = deque(maxlen = 1)
+        self.averager = SpectrumAverager(window=1) # window is the number of spectra to average
+        self._read_buffer = None
         self.absorption_enabled = False
         self._config_file = None
 
@@ -133,16 +193,33 @@ class Spectrometer(Instrument):
         self.latest_raw_spectrum = np.zeros(0)
         return self.bundle_metadata(self.latest_raw_spectrum, enable=bundle_metadata)
 
+    def read_spectrum_into(self, out):
+        """Acquire a new spectrum into an existing array, `out`, and return it.
+
+        Spectrometers that can write straight into an array (e.g. OceanOpticsSpectrometer) should override this,
+        so that repeated acquisitions don't need to allocate memory.  This default just copies the spectrum."""
+        out[...] = self.read_spectrum()
+        return out
+
+    def _read_spectrum_into_buffer(self):
+        """Acquire a spectrum into an array that is reused each time (so it's overwritten by the next call).
+
+        The array is reallocated if the spectra change shape, i.e. if there's no longer one point per wavelength."""
+        if self._read_buffer is None or self._read_buffer.shape != np.shape(self.wavelengths):
+            self._read_buffer = np.array(self.read_spectrum(), dtype=np.float64)
+            return self._read_buffer
+        return self.read_spectrum_into(self._read_buffer)
+
     def read_background(self):
         """Acquire a new spectrum and use it as a background measurement.
         This background should be less than 50% of the spectrometer saturation"""
         if self.averaging_enabled == True:
-            background_1 = np.average(self.read_averaged_spectrum(True,True),axis=0)
+            background_1 = self.read_averaged_spectrum(True)
         else:
             background_1 = self.read_spectrum()
         self.integration_time = 2.0*self.integration_time
         if self.averaging_enabled == True:
-            background_2 = np.average(self.read_averaged_spectrum(True,True),axis=0)
+            background_2 = self.read_averaged_spectrum(True)
         else:
             background_2 = self.read_spectrum()
         self.integration_time = self.integration_time/2.0
@@ -169,7 +246,7 @@ class Spectrometer(Instrument):
     def read_reference(self):
         """Acquire a new spectrum and use it as a reference."""
         if self.averaging_enabled == True:
-            self.reference = np.average(self.read_averaged_spectrum(True,True),axis=0)
+            self.reference = self.read_averaged_spectrum(True)
         else:
             self.reference = self.read_spectrum() 
         self.reference_int = self.integration_time
@@ -204,28 +281,25 @@ class Spectrometer(Instrument):
 
     def process_spectrum(self, spectrum):
         """Subtract the background and divide by the reference, if possible"""
-        if self.background is not None:
-            if self.reference is not None:
-                old_error_settings = np.seterr(all='ignore')
-           #     new_spectrum = (spectrum - (self.background-np.min(self.background))*self.integration_time/self.background_int+np.min(self.background))/(((self.reference-np.min(self.background))*self.integration_time/self.reference_int - (self.background-np.min(self.background))*self.integration_time/self.background_int)+np.min(self.background))
-                if self.variable_int_enabled == True:
-                    new_spectrum = ((spectrum-(self.background_constant+self.background_gradient*self.integration_time))
-                                    /((self.reference-(self.background_constant+self.background_gradient*self.reference_int))*self.integration_time/self.reference_int))
-                else:
-                    new_spectrum = (spectrum-self.background)/(self.reference-self.background)
-                np.seterr(**old_error_settings)
-                new_spectrum[np.isinf(new_spectrum)] = np.NaN #if the reference is nearly 0, we get infinities - just make them all NaNs.
-            else:
-                if self.variable_int_enabled == True:
-                    new_spectrum = spectrum-(self.background_constant+self.background_gradient*self.integration_time)
-                else:
-                    new_spectrum = spectrum-self.background
-                
-        else:
-            new_spectrum = spectrum
-        if self.absorption_enabled == True:
-            return np.log10(1/new_spectrum)
-        return new_spectrum
+        return self.process_spectra(spectrum)
+
+    def process_spectra(self, spectra, integration_times=None):
+        """Subtract the background and divide by the reference, for one spectrum or an NxM array of them.
+
+        `integration_times` may be a single value, or one per spectrum (it defaults to the current integration
+        time) - it only matters if `variable_int_enabled` is True.  See `process_spectra` (the module-level
+        function) for details: the result is the same as calling `process_spectrum` on each row.
+        """
+        if integration_times is None:
+            integration_times = self.integration_time
+        return process_spectra(spectra, integration_times,
+                               background=self.background,
+                               reference=self.reference,
+                               background_constant=self.background_constant,
+                               background_gradient=self.background_gradient,
+                               reference_int=self.reference_int,
+                               variable_int_enabled=self.variable_int_enabled,
+                               absorption_enabled=self.absorption_enabled)
 
     def read_processed_spectrum(self):
         """Acquire a new spectrum and return a processed (referenced/background-subtracted) spectrum.
@@ -233,7 +307,7 @@ class Spectrometer(Instrument):
         NB if saving data to file, it's best to save raw spectra along with metadata - this is a
         convenience method for display purposes."""
         if self.averaging_enabled == True:
-            spectrum = np.average(self.read_averaged_spectrum(fresh = True),axis=0)
+            spectrum = self.read_averaged_spectrum(fresh = True)
         else:
             spectrum = self.read_spectrum()
         self.latest_spectrum = self.process_spectrum(spectrum)
@@ -280,26 +354,36 @@ class Spectrometer(Instrument):
         
         If no spectrum is passed in, a new spectrum is taken.  The convention
         is to save raw spectra only, along with reference/background to allow
-        later processing.
+        later processing.  If averaging is enabled, the average is saved, along
+        with the number of spectra averaged and their standard deviation.
         
         The attrs dictionary allows extra metadata to be saved in the HDF5 file."""
+        metadata = self.metadata
         if self.averaging_enabled == True:
             spectrum = self.read_averaged_spectrum(new_deque = new_deque)
+            metadata['averaged_spectra'] = self.averager.effective_count
+            metadata['spectrum_std'] = self.averager.std
         else:
             spectrum = self.read_spectrum() if spectrum is None else spectrum
-        metadata = self.metadata
         metadata.update(attrs) #allow extra metadata to be passed in
-        self.create_dataset(self.filename, data=spectrum, attrs=metadata) 
+        self.create_dataset(self.filename, data=spectrum, attrs=metadata)
         #save data in the default place (see nplab.instrument.Instrument)
     def read_averaged_spectrum(self,new_deque = False,fresh = False):
-            if fresh == True:
-                self.spectra_deque.append(self.read_spectrum())
-            if new_deque == True:
-                self.spectra_deque.clear()
-            while len(self.spectra_deque) < self.spectra_deque.maxlen:
-                self.spectra_deque.append(self.read_spectrum())
-            return self.spectra_deque
-        
+        """Return the average of the last `averager.window` spectra.
+
+        Spectra are accumulated by `averager` (see `SpectrumAverager`), so
+        repeated calls with `fresh=True` add one new spectrum each time and
+        give a rolling average.  `new_deque=True` discards the spectra
+        averaged so far and starts again.
+        """
+        if new_deque == True:
+            self.averager.reset()
+        if fresh == True:
+            self.averager.add(self._read_spectrum_into_buffer())
+        while self.averager.effective_count < self.averager.window:
+            self.averager.add(self._read_spectrum_into_buffer())
+        return self.averager.mean
+
     def save_reference_to_file(self):
         pass
 
@@ -313,23 +397,38 @@ class Spectrometer(Instrument):
 
 
 class Spectrometers(Instrument):
-    def __init__(self, spectrometer_list):
+    """Several spectrometers, acquiring at the same time.
+
+    Each spectrometer has a worker thread (see `nplab.instrument.spectrometer.synchronised`), and acquisitions are
+    released together, so reading from all of them takes as long as the slowest one.  If the spectrometers are
+    waiting for a hardware trigger, pass a function that fires it as `trigger`.  The start and end time of each
+    acquisition is kept in `latest_timestamps`, and saved with the spectra.
+    """
+    trigger_delay = 0.01 # Time (in s) between starting the reads and firing the hardware trigger
+    def __init__(self, spectrometer_list, trigger=None):
         assert False not in [isinstance(s, Spectrometer) for s in spectrometer_list],\
             'an invalid spectrometer was supplied'
         super(Spectrometers, self).__init__()
         self.spectrometers = spectrometer_list
         self.num_spectrometers = len(spectrometer_list)
-        self._pool = ThreadPool(processes=self.num_spectrometers)
+        self.trigger = trigger
+        self.latest_timestamps = None
+        self._workers = [SpectrometerWorker(s) for s in spectrometer_list]
         self._wavelengths = None
+        self._stitch_indices = None
 
     def __del__(self):
-        self._pool.close()
+        for worker in self._workers:
+            worker.stop()
 
     def add_spectrometer(self, spectrometer):
         assert isinstance(spectrometer, Spectrometer), 'spectrometer must be an instance of Spectrometer'
         if spectrometer not in self.spectrometers:
             self.spectrometers.append(spectrometer)
+            self._workers.append(SpectrometerWorker(spectrometer))
             self.num_spectrometers = len(self.spectrometers)
+            self._wavelengths = None
+            self._stitch_indices = None
 
     def get_wavelengths(self):
         if self._wavelengths is None:
@@ -338,21 +437,55 @@ class Spectrometers(Instrument):
 
     wavelengths = property(get_wavelengths)
 
+    def acquire(self, function):
+        """Run `function(spectrometer)` on all the spectrometers at once, and return a list of the results.
+
+        The workers all wait until every one of them is ready, then start together.  If there's a `trigger`, it's
+        called once they have all started.  The start/end time of each acquisition is stored in
+        `latest_timestamps`.
+        """
+        start = threading.Event()
+        ready = threading.Semaphore(0)
+        futures = [w.submit(function, start_event=start, started=ready.release) for w in self._workers]
+        start.set()
+        if self.trigger is not None:
+            for f in futures:
+                ready.acquire() # wait for all the spectrometers to start reading
+            time.sleep(self.trigger_delay)
+            self.trigger()
+        results = [f.result() for f in futures]
+        self.latest_timestamps = [(f.start_time, f.end_time) for f in futures]
+        return results
+
     def read_spectra(self):
         """Acquire spectra from all spectrometers and return as a list."""
-        return self._pool.map(lambda s: s.read_spectrum(), self.spectrometers)
+        return self.acquire(lambda s: s.read_spectrum())
 
     def read_processed_spectra(self):
         """Acquire a list of processed (referenced, background subtracted) spectra."""
-        return self._pool.map(lambda s: s.read_processed_spectrum(), self.spectrometers)
+        return self.acquire(lambda s: s.read_processed_spectrum())
 
     def process_spectra(self, spectra):
-        pairs = zip(self.spectrometers, spectra)
-        return self._pool.map(lambda (s, spectrum): s.process_spectrum(spectrum), pairs)
+        return [s.process_spectrum(spectrum) for s, spectrum in zip(self.spectrometers, spectra)]
 
     def get_metadata_list(self):
         """Return a list of metadata for each spectrometer."""
-        return self._pool.map(lambda s: s.get_metadata(), self.spectrometers)
+        return [s.get_metadata() for s in self.spectrometers]
+
+    def stitch_spectra(self, spectra):
+        """Join a list of spectra (one per spectrometer) into one spectrum, in order of increasing wavelength.
+
+        Where spectrometers overlap, each is used up to the middle of the overlap.  The corresponding wavelengths
+        are `stitched_wavelengths`."""
+        if self._stitch_indices is None:
+            self._stitch_indices = stitch_indices(self.wavelengths)
+        indices, order = self._stitch_indices
+        return np.concatenate([np.asarray(spectra[i])[..., indices[i]] for i in order], axis=-1)
+
+    @property
+    def stitched_wavelengths(self):
+        """The wavelengths of the spectrum returned by `stitch_spectra`."""
+        return self.stitch_spectra(self.wavelengths)
 
     def mask_spectra(self, spectra, threshold):
         return [spectrometer.mask_spectrum(spectrum, threshold) for (spectrometer, spectrum) in zip(self.spectrometers, spectra)]
@@ -360,18 +493,32 @@ class Spectrometers(Instrument):
     def get_qt_ui(self):
         return SpectrometersUI(self)
 
-    def save_spectra(self, spectra=None, attrs={}):
+    def save_spectra(self, spectra=None, attrs={}, stitch=False):
         """Save spectra from all the spectrometers, in a folder in the current
         datafile, creating the file if needed.
 
         If no spectra are given, new ones are acquired - NB you should pass
-        raw spectra in - metadata will be saved along with the spectra.
+        raw spectra in - metadata will be saved along with the spectra.  If
+        stitch is True, the spectra are also joined together (see
+        `stitch_spectra`) and saved as "stitched_spectrum".
         """
-        spectra = self.read_spectra() if spectra is None else spectra
+        if spectra is None:
+            spectra = self.read_spectra()
+            timestamps = self.latest_timestamps
+        else:
+            timestamps = [(None, None)] * self.num_spectrometers
         metadata_list = self.get_metadata_list()
         g = self.create_data_group('spectra',attrs=attrs) # create a uniquely numbered group in the default place
-        for spectrum,metadata in zip(spectra,metadata_list):
-            g.create_dataset('spectrum_%d',data=spectrum,attrs=metadata)
+        for spectrometer,spectrum,metadata,(start,end) in zip(self.spectrometers,spectra,metadata_list,timestamps):
+            metadata.update({'acquisition_start': start, 'acquisition_end': end})
+            g.create_dataset('spectrum_%d',data=spectrum,attrs=metadata,autoflush=False,
+                             shared_attrs_min_size=spectrometer.shared_metadata_min_size)
+        if stitch:
+            g.create_dataset('stitched_spectrum', data=self.stitch_spectra(spectra), autoflush=False,
+                             attrs={'wavelengths': self.stitched_wavelengths},
+                             shared_attrs_min_size=self.spectrometers[0].shared_metadata_min_size)
+        g.file.flush() # write everything in one go
+        return g
             
     def get_metadata(self):
         """
@@ -438,7 +585,8 @@ class SpectrometerControlUI(QtWidgets.QWidget,UiTools):
                 pass
             
     def update_averages(self,*args,**kwargs):
-        self.spectrometer.spectra_deque = deque(maxlen = args[0])
+        self.spectrometer.averager.window = args[0]
+        self.spectrometer.averager.reset()
 
     def button_pressed(self, *args, **kwargs):
         sender = self.sender()
@@ -673,6 +821,11 @@ class SpectrometerDisplayUI(QtWidgets.QWidget,UiTools):
                     self.plotdata[spectrometer_nom].setData(x = self.spectrometer.wavelengths[spectrometer_nom],y= spectrum[spectrometer_nom])
             else:
                 self.plotdata[0].setData(x = self.spectrometer.wavelengths,y= spectrum)
+        if isinstance(self.spectrometer, Spectrometer) and self.spectrometer.averaging_enabled:
+            averager = self.spectrometer.averager
+            if averager.count > 1: # show the noise on the (raw) averaged spectrum
+                self.plots[0].setTitle("Average of {0} spectra, median noise {1:.3g}".format(
+                    averager.effective_count, np.median(averager.standard_error)))
 
     def filename_changed_ui(self):
         self.spectrometer.filename = self.filename_lineEdit.text()
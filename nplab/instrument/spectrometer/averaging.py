@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Spectrum averaging
+==================
+
+Averaging spectra by keeping a list of them and taking the mean needs memory for every spectrum and a second pass
+over them.  A `SpectrumAverager` instead updates a running mean and variance in place as each spectrum arrives
+(Welford's algorithm), so it uses a fixed amount of memory however many spectra are averaged.
+
+With ``window=None`` it averages everything it's given since it was last reset.  With a window of N, it averages
+the first N spectra exactly, and after that becomes an exponentially-weighted rolling average with a time constant
+of N spectra - this is what the live display uses, so it can show a rolling average and noise estimate forever.
+
+It can also take the median of each group of k spectra before averaging (robust to occasional bad spectra), and
+reject cosmic rays: points that are more than `cosmic_ray_threshold` standard deviations above the current mean are
+replaced by the mean before they're added.
+"""
+
+import numpy as np
+
+
+class SpectrumAverager(object):
+    """Average spectra as they arrive, keeping a running mean and variance.
+
+    Arguments:
+    window : int (optional, default None)
+        If None, average all the spectra added since the last `reset`.  Otherwise, after `window` spectra the
+        average becomes an exponentially-weighted rolling average with a time constant of `window` spectra.
+    median_of : int (optional, default 1)
+        If more than 1, spectra are collected in groups of this many, and the median of each group is averaged.
+    cosmic_ray_threshold : float (optional, default None)
+        If specified, points more than this many standard deviations above the mean are ignored (replaced by the
+        mean).  This only starts after a few spectra, when there is a reasonable estimate of the noise.
+    """
+    min_spectra_for_rejection = 10 # Don't reject cosmic rays until we have a noise estimate from this many spectra
+
+    def __init__(self, window=None, median_of=1, cosmic_ray_threshold=None):
+        self.window = window
+        self.median_of = median_of
+        self.cosmic_ray_threshold = cosmic_ray_threshold
+        self.reset()
+
+    def reset(self):
+        """Discard the current average."""
+        self.count = 0 # the number of samples averaged (each sample is the median of `median_of` spectra)
+        self.rejected_points = 0 # the number of points removed by cosmic ray rejection
+        self._mean = None
+        self._variance = None
+        self._buffer = None
+        self._buffered = 0
+
+    def _allocate(self, shape):
+        """Set up the arrays for spectra of a given shape."""
+        self._mean = np.zeros(shape, dtype=np.float64)
+        self._variance = np.zeros(shape, dtype=np.float64)
+        self._difference = np.zeros(shape, dtype=np.float64)
+        self._increment = np.zeros(shape, dtype=np.float64)
+        if self.median_of > 1:
+            self._buffer = np.zeros((self.median_of,) + shape, dtype=np.float64)
+
+    def add(self, spectrum):
+        """Add a spectrum to the average."""
+        spectrum = np.asarray(spectrum)
+        if self._mean is None or self._mean.shape != spectrum.shape:
+            self.reset()
+            self._allocate(spectrum.shape)
+        if self.median_of > 1:
+            self._buffer[self._buffered] = spectrum
+            self._buffered += 1
+            if self._buffered < self.median_of:
+                return
+            self._buffered = 0
+            spectrum = np.median(self._buffer, axis=0)
+        self._update(spectrum)
+
+    def add_spectra(self, spectra):
+        """Add each row of an array of spectra to the average."""
+        for spectrum in spectra:
+            self.add(spectrum)
+
+    def _update(self, sample):
+        """Update the mean and variance with a new sample (in place)."""
+        self.count += 1
+        difference = np.subtract(sample, self._mean, out=self._difference)
+        if self.cosmic_ray_threshold is not None and self.count > self.min_spectra_for_rejection:
+            cosmic_rays = difference > self.cosmic_ray_threshold * np.sqrt(self._variance)
+            difference[cosmic_rays] = 0 # this is equivalent to replacing the point with the mean
+            self.rejected_points += np.count_nonzero(cosmic_rays)
+        # alpha=1/n gives the exact mean & variance (Welford's algorithm); a constant alpha gives a rolling average.
+        alpha = 1.0 / self.count if self.window is None else 1.0 / min(self.count, self.window)
+        increment = np.multiply(difference, alpha, out=self._increment)
+        self._mean += increment
+        difference *= increment
+        self._variance += difference
+        self._variance *= 1 - alpha
+
+    @property
+    def mean(self):
+        """The average spectrum (a copy), or None if nothing has been added."""
+        return None if self._mean is None or self.count == 0 else self._mean.copy()
+
+    @property
+    def variance(self):
+        """The variance of the spectra averaged (a copy), or None if nothing has been added."""
+        return None if self._variance is None or self.count == 0 else self._variance.copy()
+
+    @property
+    def std(self):
+        """The standard deviation of the spectra averaged, i.e. the noise on a single spectrum."""
+        variance = self.variance
+        return None if variance is None else np.sqrt(variance)
+
+    @property
+    def effective_count(self):
+        """The number of samples that contribute to the average (at most `window`)."""
+        return self.count if self.window is None else min(self.count, self.window)
+
+    @property
+    def standard_error(self):
+        """An estimate of the noise on the mean spectrum."""
+        std = self.std
+        return None if std is None else std / np.sqrt(self.effective_count)
@@ -163,6 +163,7 @@ class OceanOpticsSpectrometer(Spectrometer, Instrument):
     def __init__(self, index):
         """Initialise the spectrometer"""
         self.index = index  # the spectrometer's ID, used by all seabreeze functions
+        self._spectrum_length = None
         self._comms_lock = threading.RLock()
         self._isOpen = False
         self._open()
@@ -334,16 +335,37 @@ class OceanOpticsSpectrometer(Spectrometer, Instrument):
 
     tec_temperature = property(get_tec_temperature, set_tec_temperature)
 
+    def get_spectrum_length(self):
+        """The number of pixels in a spectrum.
+
+        NB this caches the value so it's only retrieved from the spectrometer once."""
+        if self._spectrum_length is None:
+            with self._comms_lock:
+                e = ctypes.c_int()
+                N = seabreeze.seabreeze_get_formatted_spectrum_length(self.index, byref(e))
+            check_error(e)
+            self._spectrum_length = N
+        return self._spectrum_length
+
+    spectrum_length = property(get_spectrum_length)
+
+    def _check_buffer(self, out):
+        """Make sure an array can be passed to seabreeze to be filled with a spectrum, and return a pointer to it."""
+        if out.dtype != np.float64 or not out.flags.c_contiguous or not out.flags.writeable \
+                or out.size != self.spectrum_length:
+            raise ValueError("The array must be a writeable, contiguous float64 array with {0} elements".format(
+                self.spectrum_length))
+        return out.ctypes.data_as(ctypes.POINTER(c_double))
+
     def read_wavelengths(self):
         """get an array of the wavelengths in nm"""
-        self._comms_lock.acquire()
+        wavelengths = np.empty(self.spectrum_length, dtype=np.float64)
         e = ctypes.c_int()
-        N = seabreeze.seabreeze_get_formatted_spectrum_length(self.index, byref(e))
-        wavelengths_carray = (c_double * N)()  # this should create a c array of doubles, length N
-        seabreeze.seabreeze_get_wavelengths(self.index, byref(e), byref(wavelengths_carray), N)
-        self._comms_lock.release()
+        with self._comms_lock:
+            seabreeze.seabreeze_get_wavelengths(self.index, byref(e), self._check_buffer(wavelengths),
+                                                self.spectrum_length)
         check_error(e)
-        return np.array(list(wavelengths_carray))
+        return wavelengths
 
     def get_wavelengths(self):
         """Wavelength values for each pixel.  
@@ -355,18 +377,24 @@ class OceanOpticsSpectrometer(Spectrometer, Instrument):
 
     wavelengths = property(get_wavelengths)
 
+    def read_spectrum_into(self, out):
+        """Acquire a new spectrum, writing it straight into `out`, and return `out`.
+
+        `out` must be a contiguous float64 numpy array, with `spectrum_length` elements.  Nothing is allocated, so
+        this is the fastest way to acquire spectra continuously."""
+        pointer = self._check_buffer(out)
+        e = ctypes.c_int()
+        with self._comms_lock:
+            seabreeze.seabreeze_get_formatted_spectrum(self.index, byref(e), pointer, self.spectrum_length)
+        check_error(e)  # throw an exception if something went wrong
+        return out
+
     def read_spectrum(self, bundle_metadata=False):
         """Get the current reading from the spectrometer's sensor.
         
         Acquire a new spectrum and return it.  If bundle_metadata is true, this will be
         returned as an ArrayWithAttrs, including the current metadata."""
-        e = ctypes.c_int()
-        N = seabreeze.seabreeze_get_formatted_spectrum_length(self.index, byref(e))
-        with self._comms_lock:
-            spectrum_carray = (c_double * N)()  # this should create a c array of doubles, length N
-            seabreeze.seabreeze_get_formatted_spectrum(self.index, byref(e), byref(spectrum_carray), N)
-        check_error(e)  # throw an exception if something went wrong
-        new_spectrum = np.array(list(spectrum_carray))
+        new_spectrum = self.read_spectrum_into(np.empty(self.spectrum_length, dtype=np.float64))
         if bundle_metadata:
             return ArrayWithAttrs(new_spectrum, attrs=self.metadata)
         else:
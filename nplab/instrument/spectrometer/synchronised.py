@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Synchronised acquisition
+========================
+
+`Spectrometers` reads from several spectrometers at once.  Each spectrometer has its own `SpectrometerWorker`, a
+thread that lives as long as the `Spectrometers` object does, so starting an acquisition doesn't mean starting new
+threads.  All the workers are given a job first, and then released together by a `threading.Event`, so the
+acquisitions start as close to simultaneously as Python allows - and take as long as the slowest spectrometer.
+
+If the spectrometers are set up to wait for a hardware trigger, pass a `trigger` function: it's called once every
+worker has started reading, and should fire the trigger (e.g. a TTL pulse from a DAQ card).
+
+This module also has `stitch_indices`, which works out how to join spectra from spectrometers covering different
+wavelength ranges into one spectrum.
+"""
+
+import threading
+import time
+import Queue
+import numpy as np
+from nplab.utils.thread_utils import Future
+
+
+class AcquisitionFuture(Future):
+    """The result of an acquisition by a `SpectrometerWorker`.
+
+    Once it's done, `start_time` and `end_time` hold the times (from `time.time()`) that the worker started and
+    finished the acquisition."""
+    description = "the spectrometer acquisition"
+    start_time = None
+    end_time = None
+
+
+class SpectrometerWorker(object):
+    """A thread that runs acquisitions on one spectrometer, when asked to."""
+    def __init__(self, spectrometer):
+        self.spectrometer = spectrometer
+        self._jobs = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, function, start_event=None, started=None):
+        """Run `function(spectrometer)` in the worker thread, returning an `AcquisitionFuture`.
+
+        If `start_event` is given (a `threading.Event`), we wait for it to be set before starting.  If `started` is
+        given, it's called (from the worker thread) just before `function`."""
+        future = AcquisitionFuture()
+        self._jobs.put((function, start_event, started, future))
+        return future
+
+    def stop(self):
+        """Stop the worker thread, once it's finished any jobs it's been given."""
+        self._jobs.put(None)
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            function, start_event, started, future = job
+            try:
+                if start_event is not None:
+                    start_event.wait()
+                if started is not None:
+                    started()
+                future.start_time = time.time()
+                result = function(self.spectrometer)
+                future.end_time = time.time()
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+
+
+def stitch_indices(wavelengths):
+    """Work out which pixels of each spectrometer to use, to join their spectra into one.
+
+    Arguments:
+    wavelengths : list of np.ndarray
+        The wavelengths of each spectrometer's pixels.
+
+    Returns a list with an array of pixel indices for each spectrometer, and the order of the spectrometers by
+    increasing wavelength.  Concatenating ``spectrum[indices]`` for each spectrometer, in that order, gives the
+    stitched spectrum.  Where two spectrometers overlap, each one is used up to the middle of the overlap.
+    """
+    ranges = [(np.min(w), np.max(w)) for w in wavelengths]
+    order = np.argsort([r[0] for r in ranges])
+    lower = [-np.infty] * len(wavelengths)
+    upper = [np.infty] * len(wavelengths)
+    for i, j in zip(order[:-1], order[1:]):
+        if ranges[j][0] <= ranges[i][1]:  # they overlap: cut in the middle
+            upper[i] = lower[j] = (ranges[j][0] + ranges[i][1]) / 2.0
+    indices = []
+    for w, low, high in zip(wavelengths, lower, upper):
+        w = np.asarray(w)
+        selected = np.nonzero((w >= low) & (w < high))[0]
+        indices.append(selected[np.argsort(w[selected])])
+    return indices, order
@@ -369,6 +369,30 @@ class SMC100(SerialInstrument, Stage):
             # is included.
             self._wait_states((STATE_READY_FROM_MOVING, STATE_READY_FROM_HOMING))
 
+    def start_move(self, pos, axis=None, relative=False):
+        """Send the move command(s) without waiting for the stage to arrive."""
+        self.move(pos, axis=axis, relative=relative, waitStop=False)
+
+    def move_finished(self, axes=None):
+        """Returns True once every controller is ready, using the state from TS.
+
+        As in `_wait_states`, a disabled state raises an exception rather than
+        waiting for ever.  NB the SMC100 reports the state of every controller
+        at once, so `axes` is ignored.
+        """
+        disabledstates = [
+            STATE_DISABLE_FROM_READY,
+            STATE_DISABLE_FROM_JOGGING,
+            STATE_DISABLE_FROM_MOVING]
+        states = [state for errors, state in self.get_status()]
+        for state in states:
+            if state in disabledstates:
+                raise SMC100DisabledStateException(state)
+        return all(state in (STATE_READY_FROM_MOVING, STATE_READY_FROM_HOMING) for state in states)
+
+    def is_moving(self, axes=None):
+        return not self.move_finished(axes)
+
     def move_referenced(self, position_mm, **kwargs):
         """
         Moves to an absolute position referenced from the software home
@@ -10,6 +10,7 @@ import itertools
 from nplab.instrument import Instrument
 import time
 import threading
+from nplab.utils.thread_utils import Future
 from nplab.utils.gui import *
 from nplab.utils.gui import uic
 from nplab.ui.ui_tools import UiTools
@@ -85,10 +86,102 @@ class Stage(Instrument):
         """Returns True if any of the specified axes are in motion."""
         raise NotImplementedError("The is_moving method must be subclassed and implemented before it's any use!")
 
-    def wait_until_stopped(self, axes=None):
-        """Block until the stage is no longer moving."""
-        while self.is_moving(axes=axes):
-            time.sleep(0.01)
+    def start_move(self, pos, axis=None, relative=False):
+        """Start a move and return immediately, without waiting for it to finish.
+
+        Stages that can do this should override it, along with `move_finished`,
+        so that `move_async` doesn't need a thread for each move.
+        """
+        raise NotImplementedError("This stage can't start a move without waiting for it.")
+
+    def move_finished(self, axes=None):
+        """Returns True once the specified axes have finished moving.
+
+        By default this is just `not self.is_moving(axes)`; drivers that read
+        the state of a move from the controller (e.g. a status register)
+        override this instead.  Errors raised here (e.g. if the controller
+        reports a fault) are passed on to whoever is waiting for the move.
+        """
+        return not self.is_moving(axes=axes)
+
+    @property
+    def can_start_move(self):
+        """Whether this stage implements `start_move` (i.e. can move without blocking)."""
+        return type(self).start_move.__func__ is not Stage.start_move.__func__
+
+    def follow_trajectory(self, positions, axes=None):
+        """Move through a list of positions, using the controller's motion buffer.
+
+        This should be a generator: `positions` is an array with one row per
+        point and one column per axis (in `axes`), and the index of each
+        point is yielded once the stage has arrived there.  Closing the
+        generator early should stop the stage.
+
+        Only stages that can queue up a list of moves in the controller (or
+        otherwise step through them faster than separate `move` calls) need to
+        implement this; scans that find it unimplemented move point by point.
+        """
+        raise NotImplementedError("This stage doesn't have a motion buffer.")
+
+    @property
+    def can_follow_trajectory(self):
+        """Whether this stage implements `follow_trajectory`."""
+        return type(self).follow_trajectory.__func__ is not Stage.follow_trajectory.__func__
+
+    def move_async(self, pos, axis=None, relative=False):
+        """Start a move, returning a `MoveFuture` that completes when it has finished.
+
+        If the stage implements `start_move`, the move is started here and the
+        shared `motion_poller` checks `move_finished` until it's done.  If not,
+        the blocking `move` method runs in a background thread.  Either way,
+        you can do other things (e.g. read out a detector) while the stage
+        moves, and then call `result()` on the returned future.
+        """
+        future = MoveFuture(self, axis)
+        if not hasattr(self, '_moves_in_progress'):
+            self._moves_in_progress = []
+        self._moves_in_progress.append(future)
+        future.add_done_callback(self._moves_in_progress.remove)
+        if self.can_start_move:
+            try:
+                self.start_move(pos, axis=axis, relative=relative)
+            except Exception as e:
+                future.set_exception(e)
+                return future
+            motion_poller.watch(future, partial(self.move_finished, axis))
+        else:
+            def run_move():
+                try:
+                    self.move(pos, axis=axis, relative=relative)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+            t = threading.Thread(target=run_move)
+            t.daemon = True
+            future.thread = t # so that a move() which waits for itself doesn't deadlock
+            t.start()
+        return future
+
+    def wait_until_stopped(self, axes=None, timeout=None):
+        """Block until the stage is no longer moving.
+
+        If moves of the specified axes were started with `move_async`, this
+        waits for them to finish.  Otherwise, it waits until `move_finished`
+        returns True (checked by the shared `motion_poller`, so many stages
+        don't need many polling loops).  Moves running `move` in the calling
+        thread are ignored, so `move` can call this to wait for itself.
+        """
+        current_thread = threading.current_thread()
+        moves = [future for future in list(getattr(self, '_moves_in_progress', []))
+                 if future.thread is not current_thread and _axes_overlap(future.axes, axes)]
+        if len(moves) > 0:
+            for future in moves:
+                future.result(timeout)
+        else:
+            future = MoveFuture(self, axes)
+            motion_poller.watch(future, partial(self.move_finished, axes))
+            future.result(timeout)
 
     def get_qt_ui(self):
         if self.unit =='m':
@@ -121,6 +214,77 @@ class Stage(Instrument):
     # TODO: stored dictionary of 'bookmarked' locations for fast travel
 
 
+def _axes_overlap(axes_a, axes_b):
+    """Whether two axis specifications (an axis name, a list of names, or None for all axes) share an axis."""
+    if axes_a is None or axes_b is None:
+        return True
+    axes_a = set([axes_a]) if isinstance(axes_a, basestring) else set(axes_a)
+    axes_b = set([axes_b]) if isinstance(axes_b, basestring) else set(axes_b)
+    return len(axes_a & axes_b) > 0
+
+
+class MoveFuture(Future):
+    """The completion of a stage move, returned by `Stage.move_async`.
+
+    `result()` blocks until the move has finished, and re-raises any error
+    from the stage.
+    """
+    thread = None # the thread running the move, if the stage can't start a move without waiting for it
+
+    def __init__(self, stage, axes=None):
+        Future.__init__(self)
+        self.stage = stage
+        self.axes = axes
+        self.description = "{0} to stop moving".format(stage.__class__.__name__)
+
+
+class MotionPoller(object):
+    """Checks whether moves have finished, using one thread for every stage.
+
+    Each watched move has a function that returns True once it is finished;
+    these are polled every `poll_interval` seconds in a background thread,
+    which runs only while there are moves to watch.  The `motion_poller`
+    instance in this module is shared by all stages.
+    """
+    poll_interval = 0.01
+
+    def __init__(self):
+        self._watched = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, future, finished):
+        """Complete `future` once `finished()` returns True (or raises an exception)."""
+        with self._lock:
+            self._watched.append((future, finished))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll)
+                self._thread.daemon = True
+                self._thread.start()
+        return future
+
+    def _poll(self):
+        while True:
+            with self._lock:
+                if len(self._watched) == 0:
+                    self._thread = None
+                    return
+                watched = list(self._watched)
+            for future, finished in watched:
+                try:
+                    if not finished():
+                        continue
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+                with self._lock:
+                    self._watched.remove((future, finished))
+            time.sleep(self.poll_interval)
+
+motion_poller = MotionPoller()
+
+
 class PiezoStage(Stage):
 
     def __init__(self):
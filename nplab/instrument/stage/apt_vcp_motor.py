@@ -128,6 +128,25 @@ class APT_VCP_motor(APT_VCP, Stage):
                 status = self.get_status_update(axis = dest)
           #      print status
 
+    def start_move(self, pos, axis=None, relative=False, channel_number=None):
+        """Send the move command, without waiting for the stage to stop """
+        self.move(pos, axis=axis, relative=relative, channel_number=channel_number, block=False)
+
+    def move_finished(self, axes=None):
+        """Returns True when no axis reports 'in motion' in its status update """
+        if axes == None:
+            destination_ids = self.destination.keys()
+        else:
+            destination_ids = tuple(axes)
+        for dest in destination_ids:
+            status = self.get_status_update(axis = dest)
+            if any(map(lambda x: 'in motion' in x[1], status)):
+                return False
+        return True
+
+    def is_moving(self, axes=None):
+        return not self.move_finished(axes)
+
     def home(self,axis = None):
         """Rehome the stage with an axis input """
         if axis == None:
@@ -7,6 +7,7 @@ Created on Wed Jun 11 17:20:36 2014
 import nplab.instrument.camera
 import nplab.instrument.stage
 from nplab.instrument import Instrument
+from nplab.utils.mosaic import Mosaic
 import cv2
 from scipy import ndimage
 from traits.api import HasTraits, Button, Float, Int, Property, Range, Array, on_trait_change, Instance
@@ -230,7 +231,8 @@ class CameraStageMapper(Instrument, HasTraits):
 
     ######## Image Tiling ############
     def acquire_tiled_image(self, n_images=(3,3), dest=None, overlap=0.33,
-                            autofocus_args={},live_plot=False, downsample=8):
+                            autofocus_args={},live_plot=False, downsample=8,
+                            stitch=False, mosaic_args={}):
         """Raster-scan the stage and take images, which we can later tile.
 
         Arguments:
@@ -244,6 +246,10 @@ class CameraStageMapper(Instrument, HasTraits):
         @param: autofocus_args: A dictionary of keyword arguments for the
         autofocus that occurs before each image is taken.  Set to None to
         disable autofocusing.
+        @param: stitch: If True, stitch the tiles together as they arrive, in
+        a "mosaic" group within dest (see nplab.utils.mosaic).  The mosaic's
+        pixel_to_sample_matrix is in units of pixels of the central tile.
+        @param: mosaic_args: A dictionary of keyword arguments for the Mosaic.
         """
         reset_interactive_mode = live_plot and not matplotlib.is_interactive()
         if live_plot:
@@ -258,6 +264,7 @@ class CameraStageMapper(Instrument, HasTraits):
             centre_position = self.camera_centre_position()[0:2] #only 2D
             x_indices = np.arange(n_images[0]) - (n_images[0] - 1)/2.0
             y_indices = np.arange(n_images[1]) - (n_images[1] - 1)/2.0
+            mosaic = None
             for y_index in y_indices:
                 for x_index in x_indices:
                     position = centre_position + self.camera_point_displacement_to_sample(np.array([x_index, y_index]) * (1-overlap))
@@ -265,9 +272,18 @@ class CameraStageMapper(Instrument, HasTraits):
                     if autofocus_args is not None:
                         self.autofocus(**autofocus_args)
                     self.flush_camera_and_wait() #wait for the camera to be ready/stage to settle
+                    image = self.camera.color_image()
                     tile = dest.create_dataset("tile_%d", 
-                                               data=self.camera.color_image(),
+                                               data=image,
                                                attrs=self.camera.metadata)
+                    if stitch:
+                        tile_step = (1-overlap)*np.array(image.shape[:2])
+                        if mosaic is None:
+                            tile_offsets = [np.array([x, y])*tile_step for y in y_indices for x in x_indices]
+                            mosaic = Mosaic.for_tiles(image, tile_offsets,
+                                                      dest=dest.create_group("mosaic"),
+                                                      **mosaic_args)
+                        mosaic.add_tile(image, mosaic.location_to_pixel(np.array([x_index, y_index])*tile_step))
                     tile.attrs.create("stage_position",self.stage.position)
                     tile.attrs.create("camera_centre_position",self.camera_centre_position())
                     if live_plot:
@@ -280,6 +296,8 @@ class CameraStageMapper(Instrument, HasTraits):
                 x_indices = x_indices[::-1] #reverse the X positions, so we do a snake-scan
             dest.attrs.set("camera_to_sample",self.camera_to_sample)
             dest.attrs.set("camera_centre",self.camera_centre)
+            if mosaic is not None:
+                mosaic.build_pyramid()
             self.move_to_sample_position(centre_position) #go back to the start point
         if reset_interactive_mode:
             plt.ioff()
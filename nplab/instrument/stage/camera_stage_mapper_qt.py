@@ -8,6 +8,8 @@ Created on Tue Apr 11 11:26:55 2017
 import nplab.instrument.camera
 import nplab.instrument.stage
 from nplab.instrument import Instrument
+from nplab.utils.mosaic import Mosaic
+from nplab.instrument.camera.calibration_cache import CalibrationCache, calibration_error
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
@@ -66,6 +68,7 @@ class CameraStageMapper(Instrument):
         self.disable_live_view = True
         self._action_lock = threading.Lock() #prevent us from doing two things involving motion at once!
         self.filter_images = False
+        self._auto_load_calibration()
     
     ############ Coordinate Conversion ##################
     def camera_pixel_to_point(self, p):
@@ -194,54 +197,120 @@ class CameraStageMapper(Instrument):
         try:
             with self._action_lock:
                 if dx is None or dx is False: dx=self.calibration_distance #use a sensible default
-                here = self.camera_centre_position()
-                if len(self.stage.axis_names)==2:
-                    pos = [np.array([i,j]) for i in [-dx,dx] for j in [-dx,dx]]
-                elif len(self.stage.axis_names)==3:
-                    pos = [np.array([i,j,0]) for i in [-dx,dx] for j in [-dx,dx]]
+                pos = [np.array([i,j]) for i in [-dx,dx] for j in [-dx,dx]]
                 print pos, dx
-                camera_pos = []
-                self.camera.update_latest_frame() # make sure we've got a fresh image
-                if self.filter_images==True and self.camera.filter_function != None:
-                    initial_image = self.camera.filter_function(self.camera.raw_image())
-                else:
-                    initial_image = self.camera.gray_image()
-                w, h, = initial_image.shape
-                template = initial_image[w/4:3*w/4,h/4:3*h/4] #.astype(np.float)
-                #template -= cv2.blur(template, (21,21), borderType=cv2.BORDER_REPLICATE)
-        #        self.calibration_template = template
-        #        self.calibration_images = []
-                camera_live_view = self.camera.live_view
-                if self.disable_live_view:
-                    self.camera.live_view = False
-                for p in pos:
-                    self.move_to_sample_position(here + p)
-                    self.flush_camera_and_wait()
-                    if self.filter_images==True and self.camera.filter_function != None:
-                        current_image = self.camera.filter_function(self.camera.raw_image())
-                    else:
-                        current_image = self.camera.gray_image()
-                    corr = cv2.matchTemplate(current_image,template,cv2.TM_SQDIFF_NORMED)
-                    corr *= -1. #invert the image
-                    corr += (corr.max()-corr.min())*0.1 - corr.max() ##
-                    corr = cv2.threshold(corr, 0, 0, cv2.THRESH_TOZERO)[1]
-        #            peak = np.unravel_index(corr.argmin(),corr.shape)
-                    peak = ndimage.measurements.center_of_mass(corr)
-                    camera_pos.append(peak - (np.array(current_image.shape) - \
-                                                           np.array(template.shape))/2)
-        #            self.calibration_images.append({"image":current_image,"correlation":corr,"pos":p,"peak":peak})
-                self.move_to_sample_position(here)
-                self.flush_camera_and_wait()#otherwise we get a worrying "jump" when enabling live view...
-                self.camera.live_view = camera_live_view
-                #camera_pos now contains the displacements in pixels for each move
-                sample_displacement = np.array([-p[0:2] for p in pos]) #nb need to convert to 2D, and the stage positioning is flipped from sample coords
-                camera_displacement = np.array([self.camera_pixel_to_point(p) for p in camera_pos])
+                sample_displacement, camera_displacement = self._measure_displacements(pos)
                 print "sample was moved (in um):\n",sample_displacement
                 print "the image shifted (in fractions-of-a-camera):\n",camera_displacement
                 A, res, rank, s = np.linalg.lstsq(camera_displacement, sample_displacement)
                 self.camera_to_sample = A
+                self.calibration_cache.save(A, self.calibration_hardware(),
+                                            residuals=calibration_error(camera_displacement, sample_displacement, A),
+                                            attrs={'calibration_distance': dx})
         except Exception as e:
             print 'Calibration failed because', e
+
+    def _measure_displacements(self, pos):
+        """Move the stage to each of a list of 2D positions (relative to here) and measure the image shift.
+
+        Returns the sample displacements (in um) and the shifts of the image (in fractions-of-a-camera).  The stage is
+        moved back to where it started afterwards."""
+        here = self.camera_centre_position()
+        camera_pos = []
+        self.camera.update_latest_frame() # make sure we've got a fresh image
+        if self.filter_images==True and self.camera.filter_function != None:
+            initial_image = self.camera.filter_function(self.camera.raw_image())
+        else:
+            initial_image = self.camera.gray_image()
+        w, h, = initial_image.shape
+        template = initial_image[w/4:3*w/4,h/4:3*h/4] #.astype(np.float)
+        #template -= cv2.blur(template, (21,21), borderType=cv2.BORDER_REPLICATE)
+#        self.calibration_template = template
+#        self.calibration_images = []
+        camera_live_view = self.camera.live_view
+        if self.disable_live_view:
+            self.camera.live_view = False
+        for p in pos:
+            self.move_to_sample_position(here + np.append(p, np.zeros(len(here) - len(p))))
+            self.flush_camera_and_wait()
+            if self.filter_images==True and self.camera.filter_function != None:
+                current_image = self.camera.filter_function(self.camera.raw_image())
+            else:
+                current_image = self.camera.gray_image()
+            corr = cv2.matchTemplate(current_image,template,cv2.TM_SQDIFF_NORMED)
+            corr *= -1. #invert the image
+            corr += (corr.max()-corr.min())*0.1 - corr.max() ##
+            corr = cv2.threshold(corr, 0, 0, cv2.THRESH_TOZERO)[1]
+#            peak = np.unravel_index(corr.argmin(),corr.shape)
+            peak = ndimage.measurements.center_of_mass(corr)
+            camera_pos.append(peak - (np.array(current_image.shape) - \
+                                                   np.array(template.shape))/2)
+#            self.calibration_images.append({"image":current_image,"correlation":corr,"pos":p,"peak":peak})
+        self.move_to_sample_position(here)
+        self.flush_camera_and_wait()#otherwise we get a worrying "jump" when enabling live view...
+        self.camera.live_view = camera_live_view
+        #camera_pos now contains the displacements in pixels for each move
+        sample_displacement = np.array([-np.array(p[0:2]) for p in pos]) #nb need to convert to 2D, and the stage positioning is flipped from sample coords
+        camera_displacement = np.array([self.camera_pixel_to_point(p) for p in camera_pos])
+        return sample_displacement, camera_displacement
+
+    _calibration_cache = None
+    @property
+    def calibration_cache(self):
+        """The `CalibrationCache` where calibrations are kept (by default, in the config file)."""
+        if self._calibration_cache is None:
+            self._calibration_cache = CalibrationCache(self.config_file.require_group("calibrations"))
+        return self._calibration_cache
+
+    @calibration_cache.setter
+    def calibration_cache(self, cache):
+        self._calibration_cache = cache
+
+    def calibration_hardware(self):
+        """Describe the hardware configuration that the calibration depends on, as a dictionary."""
+        return {'objective': getattr(self, 'objective', ""),
+                'camera': self.camera.__class__.__name__,
+                'binning': getattr(self.camera, 'binning', None),
+                'stage': self.stage.__class__.__name__}
+
+    def load_calibration(self):
+        """Load the most recent calibration for the current hardware, returning its record (or None)."""
+        record = self.calibration_cache.latest(self.calibration_hardware())
+        if record is not None:
+            self.camera_to_sample = np.array(record)
+        return record
+
+    def _auto_load_calibration(self):
+        """Load a stored calibration matching the current hardware, if there is one (called on creation)."""
+        try:
+            if self.load_calibration() is None:
+                self.log("No stored calibration matches the current hardware", level="warn")
+        except Exception as e:
+            self.log("Couldn't load a stored calibration: {0}".format(e), level="warn")
+
+    def check_calibration(self, dx=None, tolerance=0.05):
+        """Move the stage twice to check the calibration, and return the fractional error.
+
+        This is much quicker than `calibrate`, so it's a good way of checking that a stored calibration is still
+        valid - if the error is more than `tolerance`, a warning is printed."""
+        with self._action_lock:
+            if dx is None or dx is False: dx=self.calibration_distance
+            sample_displacement, camera_displacement = self._measure_displacements([np.array([dx, 0]),
+                                                                                    np.array([0, dx])])
+        error = calibration_error(camera_displacement, sample_displacement, self.camera_to_sample)
+        if error > tolerance:
+            print "Warning: the calibration is out by %.1f%%" % (error*100)
+        return error
+
+    def ensure_calibrated(self, tolerance=0.05):
+        """Use the stored calibration if it passes `check_calibration`, otherwise recalibrate.
+
+        Returns True if the stored calibration was used."""
+        if self.load_calibration() is not None and self.check_calibration(tolerance=tolerance) < tolerance:
+            return True
+        self.calibrate()
+        return False
+
     def flush_camera_and_wait(self):
         """take and discard a number of images from the camera to make sure the image is fresh
         
@@ -252,7 +321,8 @@ class CameraStageMapper(Instrument):
 
     ######## Image Tiling ############
     def acquire_tiled_image(self, n_images=(3,3), dest=None, overlap=0.33,
-                            autofocus_args={},live_plot=False, downsample=8):
+                            autofocus_args={},live_plot=False, downsample=8,
+                            stitch=False, mosaic_args={}):
         """Raster-scan the stage and take images, which we can later tile.
 
         Arguments:
@@ -266,6 +336,10 @@ class CameraStageMapper(Instrument):
         @param: autofocus_args: A dictionary of keyword arguments for the
         autofocus that occurs before each image is taken.  Set to None to
         disable autofocusing.
+        @param: stitch: If True, stitch the tiles together as they arrive, in
+        a "mosaic" group within dest (see nplab.utils.mosaic).  The mosaic's
+        pixel_to_sample_matrix is in units of pixels of the central tile.
+        @param: mosaic_args: A dictionary of keyword arguments for the Mosaic.
         """
         reset_interactive_mode = live_plot and not matplotlib.is_interactive()
         if live_plot:
@@ -280,6 +354,7 @@ class CameraStageMapper(Instrument):
             centre_position = self.camera_centre_position()[0:2] #only 2D
             x_indices = np.arange(n_images[0]) - (n_images[0] - 1)/2.0
             y_indices = np.arange(n_images[1]) - (n_images[1] - 1)/2.0
+            mosaic = None
             for y_index in y_indices:
                 for x_index in x_indices:
                     position = centre_position + self.camera_point_displacement_to_sample(np.array([x_index, y_index]) * (1-overlap))
@@ -287,9 +362,18 @@ class CameraStageMapper(Instrument):
                     if autofocus_args is not None:
                         self.autofocus(**autofocus_args)
                     self.flush_camera_and_wait() #wait for the camera to be ready/stage to settle
+                    image = self.camera.color_image()
                     tile = dest.create_dataset("tile_%d", 
-                                               data=self.camera.color_image(),
+                                               data=image,
                                                attrs=self.camera.metadata)
+                    if stitch:
+                        tile_step = (1-overlap)*np.array(image.shape[:2])
+                        if mosaic is None:
+                            tile_offsets = [np.array([x, y])*tile_step for y in y_indices for x in x_indices]
+                            mosaic = Mosaic.for_tiles(image, tile_offsets,
+                                                      dest=dest.create_group("mosaic"),
+                                                      **mosaic_args)
+                        mosaic.add_tile(image, mosaic.location_to_pixel(np.array([x_index, y_index])*tile_step))
                     tile.attrs.create("stage_position",self.stage.position)
                     tile.attrs.create("camera_centre_position",self.camera_centre_position())
                     if live_plot:
@@ -302,6 +386,8 @@ class CameraStageMapper(Instrument):
                 x_indices = x_indices[::-1] #reverse the X positions, so we do a snake-scan
             dest.attrs.set("camera_to_sample",self.camera_to_sample)
             dest.attrs.set("camera_centre",self.camera_centre)
+            if mosaic is not None:
+                mosaic.build_pyramid()
             self.move_to_sample_position(centre_position) #go back to the start point
         if reset_interactive_mode:
             plt.ioff()
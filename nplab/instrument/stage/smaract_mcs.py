@@ -401,6 +401,18 @@ class SmaractMCS(PiezoStage):
         :param relative:
         :return:
         """
+        self.start_move(position, axis, relative=relative)
+        self.wait_until_stopped(c_int(int(axis)))
+
+    def start_move(self, position, axis, relative=False):
+        """
+        Send the stage towards the requested position without waiting for it
+        to arrive (see move() and move_finished()).
+        :param position: units of m (SI units, converted to nm in the method)
+        :param axis: integer channel index
+        :param relative:
+        :return:
+        """
         if axis not in self.axis_names:
             raise ValueError("{0} is not a valid axis, must be one of {1}".format(axis, self.axis_names))
         position *= 1e9
@@ -411,7 +423,17 @@ class SmaractMCS(PiezoStage):
             self.check_status(mcsc.SA_GotoPositionRelative_S(self.handle, ch, position, c_int(0)))
         else:
             self.check_status(mcsc.SA_GotoPositionAbsolute_S(self.handle, ch, position, c_int(0)))
-        self.wait_until_stopped(ch)
+
+    def move_finished(self, axes=None):
+        """
+        Returns True once the channel status of all the given axes is
+        SA_STOPPED_STATUS.
+        """
+        if axes is None:
+            axes = self.axis_names
+        elif not isinstance(axes, (list, tuple)):
+            axes = [axes]
+        return all(self.get_channel_status(int(axis)) == SA_STOPPED_STATUS.value for axis in axes)
 
     def stop(self, axis=None):
         """
@@ -1064,6 +1086,23 @@ class SmaractMCSSerial(SerialInstrument,PiezoStage):
             return self.query(send_string)
         self.wait_until_stopped(axis)
 
+    def start_move(self, position, axis, relative=False):
+        """
+        The MPA/MPR commands return as soon as the move has started, so this
+        is just move(); use move_finished() to find out when it's done.
+        """
+        return self.move(position, axis, relative=relative)
+
+    def move_finished(self, axes=None):
+        """
+        Returns True once the status (GS) of all the given axes is 0 (stopped).
+        """
+        if axes is None:
+            axes = self.axis_names
+        elif not isinstance(axes, (list, tuple)):
+            axes = [axes]
+        return all(self.check_status(axis) == 0 for axis in axes)
+
     def stop(self, axis=None):
         """
         stops any ongoing movement of the positioner
@@ -1,6 +1,7 @@
 __author__ = 'alansanders'
 
 import numpy as np
+from scipy.signal import lfilter
 
 
 def software_lockin(t, signal, reference, harmonic=1, trigger=None, smoothing=None, basis='cartesian'):
@@ -23,25 +24,166 @@ def software_lockin(t, signal, reference, harmonic=1, trigger=None, smoothing=No
     assert len(signal) == len(t) and len(reference) == len(t), 'all arrays must be the same length.'
     if type(t) != np.ndarray:
         t = np.array(t)  # casting t to numpy array for boolean slicing
+    omega_r, phi_r = fit_reference(t, reference)
+    ref = np.exp(-1j*harmonic*(omega_r*t + phi_r))  # construct the reference waveform
+    cmplx = 2j*np.mean(signal*ref)  # multiply signal with reference
+    x = cmplx.real
+    y = cmplx.imag
+    if basis == 'cartesian':
+        return x, y
+    elif basis == 'polar':
+        return cart2pol(x, y)
+
+
+def fit_reference(t, reference):
+    """
+    Find the angular frequency and phase of a reference signal, from its rising zero crossings,
+    such that the reference is in phase with sin(omega_r*t + phi_r).
+
+    :param t: a numpy array of time values
+    :param reference: the reference signal
+    :return: omega_r, phi_r
+    """
+    reference = np.asarray(reference)
     # find the zero crossings of the reference signal to determine its frequency and phase.
     # a rising edge is used only
     cond1 = reference[:-1] < np.mean(reference)
     cond2 = reference[1:] >= np.mean(reference)
-    zero_crossings = t[cond1 & cond2]  # these are the points in time that are zero
+    zero_crossings = t[:-1][cond1 & cond2]  # these are the points in time that are zero
     # fit a line to the zero crossing
     n = np.arange(zero_crossings.size)  # number of rising triggers
     p = np.polyfit(n, zero_crossings, 1)  # result is p[0]*t + p[1]
     # extract the frequency and phase of the reference wave
     omega_r = 2*np.pi/p[0]
     phi_r = -omega_r*p[1]  # if the phase is not between 0 and 2pi its ok since its put into an exp
-    ref = np.exp(-1j*harmonic*(omega_r*t + phi_r))  # construct the reference waveform
-    cmplx = 2j*np.mean(signal*ref)  # multiply signal with reference
-    x = cmplx.real
-    y = cmplx.imag
-    if basis == 'cartesian':
-        return x, y
-    elif basis == 'polar':
-        return cart2pol(x, y)
+    return omega_r, phi_r
+
+
+class StreamingLockin(object):
+    """
+    A software lock-in amplifier that demodulates a continuous stream of data, block by block.
+
+    Each block is multiplied by the reference at every harmonic, and low-pass filtered by a
+    cascade of first-order IIR filters (like the 6/12/18/24 dB/octave settings of a hardware
+    lock-in).  The reference phase and the filter states are kept between blocks, so splitting
+    the data into blocks gives the same output as processing it all at once.  All the channels
+    and harmonics are demodulated together, as arrays of shape (channels, harmonics, samples).
+
+    The output x + iy is A*exp(i*delta) for a signal A*sin(h*(omega*t + phi) + delta), as for
+    software_lockin.
+
+    A StreamingLockin can be used directly as a consumer for a streaming acquisition, e.g.
+    Adlink9812.stream or daq_streaming.StreamingAcquisition: each block is demodulated, the
+    most recent output is kept in `latest`, and the demodulated (complex) block is passed on to
+    each of the consumers.  Captures from an oscilloscope can be passed to process() too, but
+    the gaps between captures mean the reference phase must be set (e.g. with from_reference)
+    for each one.
+    """
+    def __init__(self, sample_rate, frequency, harmonics=(1,), time_constant=0.1, filter_order=4,
+                 phase=0.0, decimation=1, consumers=()):
+        """
+        :param sample_rate: the sampling frequency of the data
+        :param frequency: the reference frequency (in Hz)
+        :param harmonics: the harmonics of the reference to demodulate at
+        :param time_constant: the time constant of each low-pass filter stage (in seconds)
+        :param filter_order: the number of cascaded low-pass filter stages
+        :param phase: the phase of the reference at the first sample (in radians)
+        :param decimation: output every n-th filtered sample
+        :param consumers: callables that are given each demodulated block
+        """
+        self.sample_rate = float(sample_rate)
+        self.frequency = frequency
+        self.harmonics = np.atleast_1d(harmonics)
+        self.time_constant = time_constant
+        self.filter_order = filter_order
+        self.phase = phase
+        self.decimation = decimation
+        self.consumers = list(consumers)
+        self.reset()
+
+    @classmethod
+    def from_reference(cls, t, reference, **kwargs):
+        """Create a lock-in using the frequency and phase (at t[0]) of a captured reference signal."""
+        t = np.asarray(t)
+        omega_r, phi_r = fit_reference(t, reference)
+        sample_rate = (len(t) - 1)/(t[-1] - t[0])
+        return cls(sample_rate, omega_r/(2*np.pi), phase=omega_r*t[0] + phi_r, **kwargs)
+
+    def reset(self):
+        """Restart the reference at its initial phase, and clear the filters."""
+        self.samples_processed = 0
+        self._phase = self.phase
+        self._filter_states = None
+        self.latest = None
+
+    @property
+    def filter_coefficient(self):
+        """The fraction of the difference between input and output that each stage moves per sample."""
+        return 1 - np.exp(-1/(self.sample_rate*self.time_constant))
+
+    def process(self, block, basis='complex'):
+        """
+        Demodulate a block of data, continuing from the previous block.
+
+        :param block: an array of shape (channels, samples), or (samples,) for a single channel
+        :param basis: complex (x + iy), cartesian (x, y) or polar (r, theta) return
+        :return: arrays of shape (channels, harmonics, output samples)
+        """
+        block = np.atleast_2d(np.asarray(block, dtype=np.float64))
+        n = block.shape[1]
+        omega = 2*np.pi*self.frequency/self.sample_rate  # reference phase per sample
+        phase = self._phase + omega*np.arange(n)
+        ref = np.exp(-1j*self.harmonics[:, np.newaxis]*phase[np.newaxis, :])
+        mixed = block[:, np.newaxis, :]*ref[np.newaxis, :, :]
+        filtered = self._low_pass(mixed)
+        # outputs are taken at samples whose overall index is a multiple of the decimation
+        first = -self.samples_processed % self.decimation
+        z = 2j*filtered[:, :, first::self.decimation]
+        self.samples_processed += n
+        self._phase = (self._phase + omega*n) % (2*np.pi)
+        if n > 0:
+            self.latest = 2j*filtered[:, :, -1]
+        if basis == 'complex':
+            return z
+        elif basis == 'cartesian':
+            return z.real, z.imag
+        elif basis == 'polar':
+            return cart2pol(z.real, z.imag)
+
+    def _low_pass(self, mixed):
+        """Apply the cascade of first-order filters along the last axis, keeping their states."""
+        a = self.filter_coefficient
+        if self._filter_states is None:
+            self._filter_states = [np.zeros(mixed.shape[:-1] + (1,), dtype=np.complex128)
+                                   for i in range(self.filter_order)]
+        for i in range(self.filter_order):
+            mixed, self._filter_states[i] = lfilter([a], [1, a - 1], mixed, axis=-1, zi=self._filter_states[i])
+        return mixed
+
+    def __call__(self, block):
+        z = self.process(block)
+        for consumer in self.consumers:
+            consumer(z)
+
+    @property
+    def x(self):
+        """The latest in-phase output, for each channel and harmonic."""
+        return self.latest.real
+
+    @property
+    def y(self):
+        """The latest quadrature output, for each channel and harmonic."""
+        return self.latest.imag
+
+    @property
+    def r(self):
+        """The latest amplitude, for each channel and harmonic."""
+        return np.abs(self.latest)
+
+    @property
+    def theta(self):
+        """The latest phase, for each channel and harmonic."""
+        return np.angle(self.latest)
 
 
 def cart2pol(x, y):
@@ -711,7 +711,7 @@ class SpectrumRenderer(FigureRendererPG):
     control/shift as used in most windows apps.
     """
     def display_data(self):
-        if type(self.h5object) == h5py.Dataset:
+        if isinstance(self.h5object, h5py.Dataset):
             self.h5object = {self.h5object.name : self.h5object}
         #Perform averaging
         h5list = {}
@@ -1528,8 +1528,14 @@ class AutocorrelationRenderer(FigureRendererPG):
                 Xdata,Xlabel = AutocorrelationRenderer.make_Xdata(dataset, len(Ydata))
 
             #Final transform prior to plotting:
-            xs = np.log10(Xdata[1:])
-            ys = AutocorrelationRenderer.autocorrelation(Ydata)[1:]
+            if dataset.attrs.get("datatype", None) == "autocorrelation":
+                #already correlated (e.g. by a MultiTauCorrelator) - plot it as it is
+                finite = np.isfinite(Ydata) & (Xdata > 0)
+                xs = np.log10(Xdata[finite])
+                ys = Ydata[finite]
+            else:
+                xs = np.log10(Xdata[1:])
+                ys = AutocorrelationRenderer.autocorrelation(Ydata)[1:]
             #plot
             self.figureWidget.plot(x = xs, y = ys,name = dataset.name, pen =(icolour,len(self.h5object)))
             icolour = icolour + 1
@@ -9,6 +9,7 @@ Created on Tue Jul 25 10:18:49 2017
 from numpy.lib.stride_tricks import as_strided
 import cv2
 import numpy as np
+from scipy import ndimage
 from nplab.utils.notified_property import DumbNotifiedProperty, NotifiedProperty, register_for_property_changes
 from nplab.instrument import Instrument
 from nplab.ui.ui_tools import QuickControlBox
@@ -63,6 +64,12 @@ class Image_Filter_box(Instrument):
                                            return_original_with_particles = self.return_original_with_particles,return_centers = return_centers)
         except Exception as e:
             self.log('Image processing has failed due to: '+str(e),level = 'WARN')
+    def detect_particles(self,g,max_elongation = None):
+        """Find particles using the current settings, returning their statistics (see detect_particles)."""
+        return detect_particles(g, bin_fac= self.bin_fac,
+                                bilat_size = self.bilat_size, bilat_height = self.bilat_height,
+                                threshold =self.threshold,min_size = self.min_size,max_size = self.max_size,
+                                morph_kernel_size = self.morph_kernel_size, max_elongation = max_elongation)
     def strided_rescale(self,g):
         try:
             return strided_rescale(g, bin_fac= self.bin_fac)
@@ -110,46 +117,187 @@ class Camera_filter_Control_ui(QuickControlBox):
 
             
 def strided_rescale(g, bin_fac= 4):
+    """Sum an image (colour or monochrome) in bin_fac x bin_fac blocks, rescale it to 8 bits and expand it back to size."""
     try:
         attrs = g.attrs
         return_image_with_loc = True
     except:
         return_image_with_loc = False
-    g = g.sum(axis=2)
-    try:
-        strided = as_strided(g,
-            shape=(g.shape[0]//bin_fac, g.shape[1]//bin_fac, bin_fac, bin_fac),
-            strides=((g.strides[0]*bin_fac, g.strides[1]*bin_fac)+g.strides))
-        strided = strided.sum(axis=-1).sum(axis=-1)
-        strided = np.uint8((strided-np.min(strided))*254.0/(np.max(strided)-np.min(strided)))
-        strided=strided.repeat(bin_fac,0)
-        strided=strided.repeat(bin_fac,1)
-        if return_image_with_loc==True:
-            return ImageWithLocation(np.copy(strided),attrs = attrs)
-        else:
-            return np.copy(strided)
-    except Exception as e:
-        print e
+    g = np.asarray(g)
+    if g.ndim == 3:
+        g = g.sum(axis=2) # sum the colour channels
+    strided = as_strided(g,
+        shape=(g.shape[0]//bin_fac, g.shape[1]//bin_fac, bin_fac, bin_fac),
+        strides=((g.strides[0]*bin_fac, g.strides[1]*bin_fac)+g.strides))
+    strided = strided.sum(axis=-1).sum(axis=-1)
+    strided = np.uint8((strided-np.min(strided))*254.0/(np.max(strided)-np.min(strided)))
+    strided=strided.repeat(bin_fac,0)
+    strided=strided.repeat(bin_fac,1)
+    if return_image_with_loc==True:
+        return ImageWithLocation(np.copy(strided),attrs = attrs)
+    else:
+        return np.copy(strided)
         
 def StrBiThresOpen(g, bin_fac= 4,threshold =40,bilat_size = 3,bilat_height = 40,morph_kernel_size = 3):
-    try:
-        strided = strided_rescale(g,bin_fac = bin_fac)
-        strided = cv2.bilateralFilter(np.uint8(strided),bilat_size,bilat_size,50)
-    #    strided[strided<threshold]=1
-      #  strided = cv2.adaptiveThreshold(strided,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,\
-     #       cv2.THRESH_BINARY,3,2)
-        strided = cv2.adaptiveThreshold(strided,255,cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY,101,-1*threshold)
-        
-        strided = cv2.bilateralFilter(np.uint8(strided),bilat_size,bilat_height/4,50)
-      #  strided[strided>threshold]-=threshold
-        kernel = np.ones((morph_kernel_size,morph_kernel_size),np.uint8)
-        strided =cv2.morphologyEx(strided, cv2.MORPH_OPEN, kernel)
-        strided = cv2.morphologyEx(strided, cv2.MORPH_CLOSE, kernel)
-        strided[strided!=0]=255
-        return np.copy(strided)
-    except Exception as e:
-        print e
+    """Bin, smooth and adaptively threshold an image, returning a binary (0 or 255) image of the particles.
+    
+    Errors are raised rather than printed, so callers never get None instead of an image."""
+    strided = strided_rescale(g,bin_fac = bin_fac)
+    strided = cv2.bilateralFilter(np.uint8(strided),bilat_size,bilat_size,50)
+#    strided[strided<threshold]=1
+  #  strided = cv2.adaptiveThreshold(strided,255,cv2.ADAPTIVE_THRESH_GAUSSIAN_C,\
+ #       cv2.THRESH_BINARY,3,2)
+    strided = cv2.adaptiveThreshold(strided,255,cv2.ADAPTIVE_THRESH_MEAN_C,cv2.THRESH_BINARY,101,-1*threshold)
+    
+    strided = cv2.bilateralFilter(np.uint8(strided),bilat_size,bilat_height/4,50)
+  #  strided[strided>threshold]-=threshold
+    kernel = np.ones((morph_kernel_size,morph_kernel_size),np.uint8)
+    strided =cv2.morphologyEx(strided, cv2.MORPH_OPEN, kernel)
+    strided = cv2.morphologyEx(strided, cv2.MORPH_CLOSE, kernel)
+    strided[strided!=0]=255
+    return np.copy(strided)
         
+PARTICLE_DTYPE = np.dtype([('label', np.int64), ('frame', np.int64), ('centroid', np.float64, (2,)),
+                           ('area', np.int64), ('radius', np.float64), ('elongation', np.float64),
+                           ('intensity', np.float64), ('mean_intensity', np.float64)])
+"""The fields of the structured arrays returned by particle_statistics.
+
+centroid is (row, column); radius is the distance from the centroid to the
+furthest pixel in the particle (similar to cv2.minEnclosingCircle); and 
+elongation is the ratio of the long to short axes of the particle (1 for a 
+circle).  frame is the index of the image in a stack (0 for single images)."""
+
+def particle_statistics(binary, intensity=None, stack=False, return_labels=False):
+    """Find the connected regions in a binary image, and measure them all at once.
+    
+    This labels the image with scipy.ndimage.label (regions touching diagonally
+    are connected, as with cv2.findContours) and then works out the statistics
+    of every region using np.bincount, rather than looping over them in Python.
+    
+    binary : the thresholded image (anything nonzero is part of a particle).
+    intensity : an image (the same shape as binary, or with an extra colour 
+        axis that's summed over) used for the particles' intensities.  If it's
+        None, the binary image is used.
+    stack : if True, binary is a stack of images (the first axis is the frame
+        number), which are all processed in one go.  Particles don't connect
+        between frames.
+    return_labels : if True, also return the label image (particle i is the
+        region labelled particles['label'][i]).
+    
+    Returns a structured array with one row per particle (see PARTICLE_DTYPE).
+    """
+    binary = np.asarray(binary) != 0
+    structure = ndimage.generate_binary_structure(2, 2)
+    if stack:
+        structure = np.array([np.zeros_like(structure), structure, np.zeros_like(structure)])
+    labels, n = ndimage.label(binary, structure=structure)
+    if intensity is None:
+        intensity = binary
+    intensity = np.asarray(intensity, dtype=np.float64)
+    if intensity.ndim == binary.ndim + 1:
+        intensity = intensity.sum(axis=-1)
+    coordinates = np.nonzero(labels) # only look at the pixels in particles
+    pixel_labels = labels[coordinates]
+    pixel_intensities = intensity[coordinates]
+    
+    particles = np.zeros(n, dtype=PARTICLE_DTYPE)
+    particles['label'] = np.arange(1, n + 1)
+    area = np.bincount(pixel_labels, minlength=n + 1)[1:]
+    particles['area'] = area
+    if n == 0:
+        return (particles, labels) if return_labels else particles
+    if stack:
+        # every pixel of a particle is in the same frame, so we can just scatter the frame numbers
+        frame = np.zeros(n + 1, dtype=np.int64)
+        frame[pixel_labels] = coordinates[0]
+        particles['frame'] = frame[1:]
+    coordinates = coordinates[-2:] # row and column
+    centroid = np.zeros((n + 1, 2))
+    second_moments = np.zeros((n + 1, 3))
+    for axis in range(2):
+        centroid[1:, axis] = np.bincount(pixel_labels, coordinates[axis], n + 1)[1:] / area
+    displacement = [coordinates[axis] - centroid[pixel_labels, axis] for axis in range(2)]
+    for i, (a, b) in enumerate([(0, 0), (1, 1), (0, 1)]):
+        second_moments[1:, i] = np.bincount(pixel_labels, displacement[a] * displacement[b], n + 1)[1:] / area
+    particles['centroid'] = centroid[1:]
+    
+    # The radius is the largest distance from the centroid: sort pixels by label, then distance, and take the last
+    distance_squared = displacement[0] ** 2 + displacement[1] ** 2
+    order = np.lexsort((distance_squared, pixel_labels))
+    last_pixel = np.searchsorted(pixel_labels[order], np.arange(1, n + 1), side='right') - 1
+    particles['radius'] = np.sqrt(distance_squared[order][last_pixel])
+    
+    # The elongation comes from the eigenvalues of the covariance matrix (each pixel adds 1/12 to the variance)
+    rr, cc, rc = [second_moments[1:, i] for i in range(3)]
+    rr, cc = rr + 1/12.0, cc + 1/12.0
+    mean, difference = (rr + cc) / 2, np.sqrt(((rr - cc) / 2) ** 2 + rc ** 2)
+    particles['elongation'] = np.sqrt((mean + difference) / (mean - difference))
+    
+    particles['intensity'] = np.bincount(pixel_labels, pixel_intensities, n + 1)[1:]
+    particles['mean_intensity'] = particles['intensity'] / area
+    return (particles, labels) if return_labels else particles
+
+def particle_size_filter(particles, min_size=None, max_size=None, min_area=None, 
+                         max_area=None, max_elongation=None):
+    """Return a boolean mask of the particles that meet the size and shape criteria.
+    
+    min_size and max_size limit the radius of the particles (as in 
+    STBOC_with_size_filter), min_area and max_area limit their area in pixels,
+    and max_elongation limits the ratio of their long and short axes.  Any 
+    criterion that's None is ignored."""
+    keep = np.ones(len(particles), dtype=bool)
+    for field, low, high in [('radius', min_size, max_size), ('area', min_area, max_area),
+                             ('elongation', None, max_elongation)]:
+        if low is not None:
+            keep &= particles[field] >= low
+        if high is not None:
+            keep &= particles[field] <= high
+    return keep
+
+def detect_particles(g, bin_fac= 4,bilat_size = 3, bilat_height = 40,
+                     threshold =20,min_size = 2,max_size = 6,morph_kernel_size = 3,
+                     max_elongation = None, return_labels = False):
+    """Find particles in an image and return their statistics (see particle_statistics).
+    
+    The image is thresholded in the same way as STBOC_with_size_filter (using 
+    StrBiThresOpen), and particles whose radius is outside the range min_size
+    to max_size (or that are more elongated than max_elongation) are dropped.
+    Intensities are measured on the original image.  If return_labels is True,
+    the label image is also returned (with rejected particles set to 0).
+    """
+    binary = StrBiThresOpen(g, bin_fac,threshold,bilat_size,bilat_height,morph_kernel_size)
+    particles, labels = particle_statistics(binary, intensity=_binned_shape(g, bin_fac), return_labels=True)
+    keep = particle_size_filter(particles, min_size, max_size, max_elongation=max_elongation)
+    if return_labels:
+        lookup = np.zeros(len(particles) + 1, dtype=labels.dtype)
+        lookup[particles['label'][keep]] = particles['label'][keep]
+        return particles[keep], lookup[labels]
+    return particles[keep]
+
+def detect_particles_in_stack(images, **kwargs):
+    """Find particles in each image of a stack, returning one array of particles with their frame numbers.
+    
+    Each image is thresholded separately (as in detect_particles, which takes
+    the same keyword arguments), but they are labelled and measured together."""
+    # the defaults are those of detect_particles
+    binning_arguments = dict(bin_fac=4, threshold=20, bilat_size=3, bilat_height=40, morph_kernel_size=3)
+    filter_arguments = dict(min_size=2, max_size=6, max_elongation=None)
+    for k, v in kwargs.items():
+        if k in binning_arguments:
+            binning_arguments[k] = v
+        elif k in filter_arguments:
+            filter_arguments[k] = v
+        else:
+            raise TypeError("detect_particles_in_stack got an unexpected keyword argument '{0}'".format(k))
+    binary = np.array([StrBiThresOpen(g, **binning_arguments) for g in images])
+    intensity = np.array([_binned_shape(g, binning_arguments['bin_fac']) for g in images])
+    particles = particle_statistics(binary, intensity=intensity, stack=True)
+    return particles[particle_size_filter(particles, **filter_arguments)]
+
+def _binned_shape(g, bin_fac):
+    """Crop an image to the size of the output of strided_rescale, so intensities line up with it."""
+    return np.asarray(g)[:g.shape[0]//bin_fac*bin_fac, :g.shape[1]//bin_fac*bin_fac, ...]
+
 def STBOC_with_size_filter(g, bin_fac= 4,bilat_size = 3, bilat_height = 40,
                            threshold =20,min_size = 2,max_size = 6,morph_kernel_size = 3,
                            show_particles = False, return_original_with_particles = False,
@@ -157,29 +305,21 @@ def STBOC_with_size_filter(g, bin_fac= 4,bilat_size = 3, bilat_height = 40,
     try:
         g = np.copy(g)
         strided = StrBiThresOpen(g, bin_fac,threshold,bilat_size,bilat_height,morph_kernel_size)
-        strided, contours, hierarchy = cv2.findContours(strided,cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-        centers = []
-        radi = []
-        for cnt in contours:
-            (x,y),radius = cv2.minEnclosingCircle(cnt)
-        #    center = (int(x),int(y))
-            center = (int(x),int(y))
-      #      radius = int(radius)+2
-            if radius>max_size or radius<min_size:
-                radius = int(radius)+2
-                strided[center[1]-radius:center[1]+radius,center[0]-radius:center[0]+radius] = 0
-            else:
-                M = cv2.moments(cnt,binaryImage = True)
-                center = (int(M['m10']/M['m00']),int(M['m01']/M['m00']))
-                centers.append(center)
-                radi.append(radius)
+        particles, labels = particle_statistics(strided, return_labels=True)
+        keep = particle_size_filter(particles, min_size, max_size)
+        # remove the particles that are too big or too small from the image
+        keep_label = np.zeros(len(particles) + 1, dtype=bool)
+        keep_label[particles['label'][keep]] = True
+        strided[~keep_label[labels]] = 0
+        centers = particles['centroid'][keep].astype(int) # (row, column)
+        radi = particles['radius'][keep]
         if return_centers==True:
-            return np.array(centers)[:,::-1]
+            return centers
         elif return_original_with_particles == True:
       #      g = cv2.cvtColor(g,cv2.COLOR_GRAY2RGB)
        #     g = g#/255.0
             for cnt,radius in zip(centers,radi):
-                cv2.circle(g, cnt, int(radius*2), (255, 0, 0), 2)
+                cv2.circle(g, (cnt[1], cnt[0]), int(radius*2), (255, 0, 0), 2)
             return g
         elif show_particles==True:
 
@@ -190,7 +330,7 @@ def STBOC_with_size_filter(g, bin_fac= 4,bilat_size = 3, bilat_height = 40,
         #    strided=strided/255.0
             for cnt,radius in zip(centers,radi):
           #      print np.shape(strided_copy),  center
-                cv2.circle(strided, cnt, int(radius*2), (255,0,0), 2)
+                cv2.circle(strided, (cnt[1], cnt[0]), int(radius*2), (255,0,0), 2)
 
         strided[strided!=0]=255
         return strided
@@ -252,4 +252,48 @@ def locate_feature_in_image(image, feature, margin=0, restrict=False):
     assert np.sum(corr) > 0, "Error: the correlation image doesn't have any nonzero pixels."
     peak = ndimage.measurements.center_of_mass(corr)  # take the centroid (NB this is of grayscale values, not binary)
     pos = np.array(peak) + image_shift + datum_pixel(feature) # return the position of the feature's datum point.
-    return pos
\ No newline at end of file
+    return pos
+
+def phase_correlation(reference, image, window=True):
+    """Find the shift between two images of the same size, using FFT phase correlation.
+
+    reference, image : numpy.ndarray
+        The two images to compare - colour images are converted to grayscale.
+    window : bool (optional, default True)
+        Multiply both images by a Hann window first, which stops the edges of the images dominating the correlation.
+
+    Returns a tuple of ``(shift, peak)``.  ``shift`` is the displacement (in pixels, with subpixel precision from a
+    parabolic fit to the correlation peak) of features in `image` relative to their positions in `reference`, i.e.
+    ``image[p + shift]`` matches ``reference[p]``.  ``peak`` is the height of the normalised correlation peak: it's 1
+    for identical (shifted) images and close to 0 if the images don't match.  Shifts larger than half the image size
+    wrap around, so can't be distinguished from smaller shifts in the opposite direction.
+    """
+    assert reference.shape[:2] == image.shape[:2], "The images must be the same size!"
+    images = []
+    for im in [reference, image]:
+        im = np.asarray(im, dtype=np.float32)
+        if len(im.shape) == 3:
+            im = np.mean(im, axis=2)
+        im = im - np.mean(im)
+        if window:
+            im = im * np.outer(np.hanning(im.shape[0]), np.hanning(im.shape[1])).astype(np.float32)
+        images.append(im)
+    cross_power = np.fft.fft2(images[1]) * np.conj(np.fft.fft2(images[0]))
+    cross_power /= np.abs(cross_power) + 1e-12  # keep only the phase
+    corr = np.fft.ifft2(cross_power).real
+    peak_index = np.unravel_index(np.argmax(corr), corr.shape)
+    shift = np.zeros(2)
+    for axis in range(2):
+        # Fit a parabola through the peak and its neighbours (which may wrap around) along this axis
+        n = corr.shape[axis]
+        neighbours = []
+        for d in [-1, 0, 1]:
+            index = list(peak_index)
+            index[axis] = (index[axis] + d) % n
+            neighbours.append(corr[tuple(index)])
+        below, centre, above = neighbours
+        curvature = below - 2 * centre + above
+        fraction = 0.5 * (below - above) / curvature if curvature < 0 else 0
+        position = peak_index[axis] + fraction
+        shift[axis] = position - n if position > n / 2.0 else position
+    return shift, corr[peak_index]
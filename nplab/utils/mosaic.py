@@ -0,0 +1,262 @@
+"""
+Mosaic
+======
+
+Stitch tiles (usually `ImageWithLocation` objects from a `CameraWithLocation`) into one big image as they are
+acquired, rather than saving the tiles and stitching them afterwards.
+
+A `Mosaic` has a canvas, which is either a numpy array or (if a destination group is given) a chunked HDF5 dataset,
+so that mosaics bigger than memory are only ever loaded a tile at a time.  The canvas has its own
+`pixel_to_sample_matrix` (see the note on coordinate systems in `nplab.utils.image_with_location`), and each tile is
+placed on it according to its own metadata.  Stage positioning is never perfect, so where a new tile overlaps tiles
+that are already on the canvas, its position is refined using FFT phase correlation.  Overlapping tiles are blended
+with weights that fall off towards the edges of each tile, which hides the seams.
+
+Once all the tiles are in, `build_pyramid` makes successively 2x-downsampled copies of the canvas, so that big mosaics
+can be browsed without loading them at full resolution.
+"""
+
+import numpy as np
+from nplab.utils.image_with_location import ImageWithLocation, ensure_3d, datum_pixel, phase_correlation
+
+
+class Mosaic(object):
+    """A big image, built up from overlapping tiles.
+
+    Arguments:
+    shape : tuple
+        The size of the canvas: (rows, columns) or (rows, columns, channels).
+    pixel_to_sample_matrix : numpy.ndarray (optional)
+        The 4x4 matrix relating pixels on the canvas to positions in the sample.  If it's not given, tiles must be
+        placed with explicit pixel positions.
+    dtype : numpy.dtype (optional, default uint8)
+        The data type of the canvas (and the tiles).
+    dest : nplab.datafile.Group (optional)
+        If this is given, the canvas and pyramid are stored as chunked datasets in this group, rather than in memory.
+    refine : bool (optional, default True)
+        Whether to correct the position of each tile by phase correlation with the tiles it overlaps.
+    max_shift : float (optional)
+        Corrections larger than this many pixels are assumed to be mistakes, and ignored.
+    min_overlap : int (optional)
+        Tiles are only refined if they overlap the existing image by at least this many pixels in both directions.
+    min_correlation : float (optional)
+        Corrections are ignored if the phase correlation peak is lower than this (see `phase_correlation`).
+    feather : bool (optional, default True)
+        Weight each tile's pixels by their distance from the edge of the tile when blending.  If False, overlapping
+        tiles are simply averaged.
+    """
+    def __init__(self, shape, pixel_to_sample_matrix=None, dtype=np.uint8, dest=None, refine=True, max_shift=50,
+                 min_overlap=32, min_correlation=0.05, feather=True, chunks=(256, 256)):
+        shape = tuple(int(s) for s in shape)
+        if pixel_to_sample_matrix is None:
+            pixel_to_sample_matrix = np.identity(4)
+        self.pixel_to_sample_matrix = np.array(pixel_to_sample_matrix, dtype=np.float)
+        self.refine = refine
+        self.max_shift = max_shift
+        self.min_overlap = min_overlap
+        self.min_correlation = min_correlation
+        self.feather = feather
+        self.dest = dest
+        self.tile_positions = []  # the position on the canvas of pixel [0,0] of each tile
+        self.tile_corrections = []  # the amount each tile was moved by phase correlation
+        self.pyramid = None
+        self._tile_weights = {}
+        if dest is None:
+            self.canvas = np.zeros(shape, dtype=dtype)
+            self.weights = np.zeros(shape[:2], dtype=np.float32)
+        else:
+            chunks = tuple(min(c, s) for c, s in zip(chunks, shape[:2]))
+            self.canvas = dest.create_dataset("level_0", auto_increment=False, shape=shape, dtype=dtype,
+                                              chunks=chunks + shape[2:], fillvalue=0,
+                                              attrs={'pixel_to_sample_matrix': self.pixel_to_sample_matrix})
+            self.weights = dest.create_dataset("weights", auto_increment=False, shape=shape[:2], dtype=np.float32,
+                                               chunks=chunks, fillvalue=0)
+
+    @classmethod
+    def for_tiles(cls, reference, tile_offsets, tile_shape=None, margin=None, **kwargs):
+        """Make a mosaic that's big enough to hold tiles at the given positions.
+
+        reference : ImageWithLocation or numpy.ndarray
+            An image, usually the first tile, that defines the coordinate system of the canvas.
+        tile_offsets : numpy.ndarray
+            An Nx2 array of the positions of the [0,0] pixels of the tiles, in `reference`'s pixel coordinates.
+        tile_shape : tuple (optional)
+            The size of each tile, by default the same as `reference`.
+        margin : int (optional)
+            Extra space around the edge of the canvas, to allow for tiles being further out than expected.  Defaults
+            to `max_shift` (which may be specified as a keyword argument).
+
+        Other keyword arguments are passed to the constructor.
+        """
+        if tile_shape is None:
+            tile_shape = reference.shape
+        if margin is None:
+            margin = kwargs.get('max_shift', 50)
+        tile_offsets = np.array(tile_offsets, dtype=np.float)
+        corner = np.floor(tile_offsets.min(axis=0)) - margin
+        far_corner = np.ceil(tile_offsets.max(axis=0)) + np.array(tile_shape[:2]) + margin
+        shape = tuple((far_corner - corner).astype(int)) + tuple(tile_shape[2:])
+        try:
+            M = np.array(reference.pixel_to_sample_matrix, dtype=np.float)
+            M[3, :3] += np.dot(ensure_3d(corner), M[:3, :3])  # canvas pixel [0,0] is at `corner` in the reference
+        except (AttributeError, KeyError):
+            M = np.identity(4)
+            M[3, :2] = corner
+        kwargs.setdefault('dtype', reference.dtype)
+        return cls(shape, M, **kwargs)
+
+    @property
+    def shape(self):
+        return self.canvas.shape
+
+    def location_to_pixel(self, location):
+        """Convert a position in the sample to a pixel position on the canvas."""
+        M = self.pixel_to_sample_matrix
+        return np.dot(ensure_3d(location)[:2] - M[3, :2], np.linalg.inv(M[:2, :2]))
+
+    def tile_position(self, image):
+        """The nominal position on the canvas of pixel [0,0] of an `ImageWithLocation`, from its metadata."""
+        return self.location_to_pixel(image.pixel_to_location([0, 0]))
+
+    def _weights_for(self, shape):
+        """A weight for each pixel of a tile - higher in the middle if we're feathering the edges."""
+        if shape not in self._tile_weights:
+            if self.feather:
+                rows = np.minimum(np.arange(shape[0]) + 1, shape[0] - np.arange(shape[0]))
+                cols = np.minimum(np.arange(shape[1]) + 1, shape[1] - np.arange(shape[1]))
+                self._tile_weights[shape] = np.minimum.outer(rows, cols).astype(np.float32)
+            else:
+                self._tile_weights[shape] = np.ones(shape, dtype=np.float32)
+        return self._tile_weights[shape]
+
+    def _footprint(self, offset, tile_shape):
+        """Return the slices of the canvas and of the tile where a tile at `offset` overlaps the canvas."""
+        start = np.maximum(offset, 0)
+        stop = np.minimum(offset + np.array(tile_shape[:2]), self.shape[:2])
+        if np.any(stop <= start):
+            return None, None
+        canvas_slice = (slice(start[0], stop[0]), slice(start[1], stop[1]))
+        tile_slice = (slice(start[0] - offset[0], stop[0] - offset[0]),
+                      slice(start[1] - offset[1], stop[1] - offset[1]))
+        return canvas_slice, tile_slice
+
+    def _correction(self, image, offset):
+        """Work out how far the tile should move to line up with what's already on the canvas."""
+        canvas_slice, tile_slice = self._footprint(offset, image.shape)
+        if canvas_slice is None:
+            return np.zeros(2)
+        covered = np.asarray(self.weights[canvas_slice]) > 0
+        rows, cols = np.nonzero(np.any(covered, axis=1))[0], np.nonzero(np.any(covered, axis=0))[0]
+        if len(rows) < self.min_overlap or len(cols) < self.min_overlap:
+            return np.zeros(2)
+        bounding_box = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        covered = covered[bounding_box]
+        # Correlate the biggest rectangle of the overlap that spans its bounding box: that's all of it if it's
+        # rectangular, or a strip along one edge if it's L-shaped.  NB we can't just mask out the uncovered part
+        # of an L-shaped overlap, as the edge of the mask would correlate with itself and pull the shift to zero.
+        candidates = []
+        for axis in range(2):
+            full = np.nonzero(np.all(covered, axis=1 - axis))[0]  # rows (or columns) that are completely covered
+            if len(full) >= self.min_overlap and covered.shape[1 - axis] >= self.min_overlap:
+                strip = [slice(None), slice(None)]
+                strip[axis] = slice(full[0], full[-1] + 1)
+                candidates.append((len(full) * covered.shape[1 - axis], tuple(strip)))
+        if len(candidates) == 0:
+            return np.zeros(2)
+        overlap = max(candidates)[1]
+        if not np.all(covered[overlap]):
+            return np.zeros(2)  # the covered rows (or columns) weren't contiguous
+        existing = np.asarray(self.canvas[canvas_slice])[bounding_box][overlap]
+        new = np.asarray(image)[tile_slice][bounding_box][overlap]
+        shift, peak = phase_correlation(existing, new)
+        if peak < self.min_correlation or np.any(np.abs(shift) > self.max_shift):
+            return np.zeros(2)
+        return -shift  # features in the tile appear `shift` pixels from where they are on the canvas
+
+    def add_tile(self, image, position=None):
+        """Add an image to the mosaic, and return its (refined) position on the canvas.
+
+        image : ImageWithLocation or numpy.ndarray
+            The tile to add.
+        position : numpy.ndarray (optional)
+            The position on the canvas of the tile's [0,0] pixel.  If this is not specified, it's worked out from the
+            image's `pixel_to_sample_matrix`.
+        """
+        if position is None:
+            position = self.tile_position(image)
+        position = np.array(position, dtype=np.float)
+        correction = np.zeros(2)
+        if self.refine:
+            correction = self._correction(image, np.round(position).astype(int))
+        position += correction
+        offset = np.round(position).astype(int)
+        canvas_slice, tile_slice = self._footprint(offset, image.shape)
+        self.tile_positions.append(position)
+        self.tile_corrections.append(correction)
+        if canvas_slice is None:
+            return position  # the tile is entirely off the canvas
+        # Blend the new tile with the existing image, as a weighted running average
+        tile = np.asarray(image)[tile_slice].astype(np.float32)
+        tile_weights = self._weights_for(image.shape[:2])[tile_slice]
+        old_weights = np.asarray(self.weights[canvas_slice])
+        new_weights = old_weights + tile_weights
+        fraction = tile_weights / new_weights
+        if len(tile.shape) == 3:
+            fraction = fraction[:, :, np.newaxis]
+        old = np.asarray(self.canvas[canvas_slice]).astype(np.float32)
+        blended = old + (tile - old) * fraction
+        if self.canvas.dtype.kind in 'iub':
+            blended = np.round(blended)
+        self.canvas[canvas_slice] = blended.astype(self.canvas.dtype)
+        self.weights[canvas_slice] = new_weights
+        return position
+
+    @property
+    def image(self):
+        """The whole canvas as an `ImageWithLocation` (NB this loads it into memory, if it's in a file)."""
+        image = ImageWithLocation(np.asarray(self.canvas[...]))
+        image.pixel_to_sample_matrix = self.pixel_to_sample_matrix
+        image.datum_pixel = datum_pixel(image)
+        return image
+
+    def build_pyramid(self, min_size=256, rows_per_block=1024):
+        """Make a series of copies of the canvas, each downsampled by a factor of 2 from the last.
+
+        Each level is made by averaging 2x2 blocks of the one above it, stopping before the image would be smaller
+        than `min_size` in either direction.  The levels are returned as a list (starting with the canvas itself), and
+        stored as `pyramid`.  If the mosaic is in a file, the levels are datasets "level_1", "level_2", etc. and
+        they're processed `rows_per_block` rows at a time, so the full-resolution mosaic is never loaded at once.
+        Each level has its own `pixel_to_sample_matrix` attribute.
+        """
+        levels = [self.canvas]
+        matrices = []
+        M = self.pixel_to_sample_matrix
+        rows_per_block = max(rows_per_block // 2 * 2, 2)
+        while min(levels[-1].shape[:2]) >= 2 * min_size:
+            previous = levels[-1]
+            shape = (previous.shape[0] // 2, previous.shape[1] // 2) + previous.shape[2:]
+            # Each new pixel is the average of 2x2 old pixels, so it's centred half an old pixel in from the corner
+            M = M.copy()
+            M[3, :3] += 0.5 * (M[0, :3] + M[1, :3])
+            M[:2, :3] *= 2
+            if self.dest is None:
+                level = np.zeros(shape, dtype=self.canvas.dtype)
+            else:
+                level = self.dest.create_dataset("level_%d" % len(levels), auto_increment=False, shape=shape,
+                                                 dtype=self.canvas.dtype, chunks=True,
+                                                 attrs={'pixel_to_sample_matrix': M})
+            for start in range(0, 2 * shape[0], rows_per_block):
+                stop = min(start + rows_per_block, 2 * shape[0])
+                block = np.asarray(previous[start:stop, :2 * shape[1], ...]).astype(np.float32)
+                binned = block.reshape((block.shape[0] // 2, 2, shape[1], 2) + shape[2:]).mean(axis=3).mean(axis=1)
+                if self.canvas.dtype.kind in 'iub':
+                    binned = np.round(binned)
+                level[start // 2:stop // 2, ...] = binned.astype(self.canvas.dtype)
+            levels.append(level)
+            matrices.append(M)
+        if self.dest is None:
+            levels = [levels[0]] + [ImageWithLocation(l) for l in levels[1:]]
+            for level, M in zip(levels[1:], matrices):
+                level.pixel_to_sample_matrix = M
+        self.pyramid = levels
+        return levels
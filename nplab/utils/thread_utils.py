@@ -112,6 +112,74 @@ def background_actions_running(obj):
             return True
     return False
 
+class Future(object):
+    """The result of an operation that finishes in the background.
+
+    This mimics the interface of `concurrent.futures.Future` (which isn't
+    available in Python 2): use `done()` to check whether the operation has
+    finished and `result()` to wait for it.  Whoever is doing the work calls
+    `set_result()` or `set_exception()` exactly once.
+    """
+    description = "the operation" #: used in the message raised on timeout
+
+    def __init__(self):
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def done(self):
+        """Return True if the operation has finished (or failed)."""
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the operation to finish, returning False if we timed out."""
+        return self._finished.wait(timeout)
+
+    def result(self, timeout=None):
+        """Wait for the operation to finish and return its result (re-raising any error)."""
+        if not self._finished.wait(timeout):
+            raise IOError("Timed out waiting for %s" % self.description)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the operation to finish and return its exception (or None)."""
+        if not self._finished.wait(timeout):
+            raise IOError("Timed out waiting for %s" % self.description)
+        return self._exception
+
+    def add_done_callback(self, function):
+        """Call `function(future)` once the operation finishes (immediately if it has)."""
+        with self._callbacks_lock:
+            if not self.done():
+                self._callbacks.append(function)
+                return
+        function(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._callbacks_lock:
+            self._finished.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for function in callbacks:
+            function(self)
+
+def completed_future(result=None):
+    """Return a `Future` that has already finished with the given result."""
+    future = Future()
+    future.set_result(result)
+    return future
+
 if __file__ == "__main__":
     import time
     
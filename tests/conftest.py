@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated instruments shared by several tests.
+"""
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from nplab.instrument.stage import Stage
+from nplab.instrument.camera import DummyCamera
+
+
+class XYZStage(Stage):
+    def __init__(self):
+        Stage.__init__(self)
+        self._position = np.zeros(3)
+
+    def move(self, pos, axis=None, relative=False):
+        self._position = np.array(pos, dtype=float) + (self._position if relative else 0)
+
+    def get_position(self, axis=None):
+        return self._position.copy()
+
+
+class DriftingCamera(DummyCamera):
+    """Images of a texture that moves by `drift` pixels (in the sample), as seen from the stage position.
+
+    The camera is calibrated so that one pixel is one stage unit."""
+    def __init__(self, stage):
+        self.stage = stage
+        self.drift = np.zeros(2)
+        texture = np.random.RandomState(0).random_sample((128, 128))
+        self.texture_ft = np.fft.fft2(ndimage.gaussian_filter(texture, 2))
+        super(DriftingCamera, self).__init__()
+
+    def raw_snapshot(self):
+        shift = self.drift - self.stage.position[:2]
+        image = np.fft.ifft2(ndimage.fourier_shift(self.texture_ft, shift)).real
+        image = (image - image.min()) / (image.max() - image.min()) * 255
+        return True, np.dstack((image.astype(np.uint8),) * 3)
+
+
+@pytest.fixture
+def drifting_camera():
+    """A `DriftingCamera` on an `XYZStage` (the stage is ``camera.stage``)."""
+    camera = DriftingCamera(XYZStage())
+    yield camera
+    camera.close()
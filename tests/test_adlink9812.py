@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for streaming acquisition from the Adlink9812, using its debug mode (which generates random data).
+"""
+import numpy as np
+import pytest
+
+from nplab.instrument.electronics.adlink9812 import Adlink9812
+
+
+@pytest.fixture
+def card():
+    return Adlink9812(dll_path="no_such_dll.dll", debug=True)
+
+
+def test_stream_delivers_all_samples_in_blocks(card):
+    blocks = []
+    n = card.stream(sample_freq=1e6, sample_count=2500, consumer=blocks.append, card_buffer_size=1000)
+    assert n == 2500
+    assert [len(b) for b in blocks] == [500, 500, 500, 500, 500]
+    assert all(np.all(np.abs(b) <= 1) for b in blocks)
+
+
+def test_stream_truncates_last_block(card):
+    blocks = []
+    card.stream(sample_freq=1e6, sample_count=1200, consumer=blocks.append, card_buffer_size=1000)
+    assert [len(b) for b in blocks] == [500, 500, 200]
+
+
+def test_consumer_errors_are_raised(card):
+    def fail(block):
+        raise ValueError("consumer failed")
+    with pytest.raises(ValueError):
+        card.stream(sample_freq=1e6, sample_count=5000, consumer=fail, card_buffer_size=1000)
+
+
+def test_get_times():
+    assert np.allclose(Adlink9812.get_times(0.5, 4), [0, 0.5, 1.0, 1.5])
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the Agilent DSO binary transfer and preamble caching, using a fake VISA resource.
+"""
+import numpy as np
+import pytest
+
+from nplab.instrument.electronics.agilent_dsox2000_dso import AgilentDSO, WaveformPreamble, parse_ieee_block
+
+PREAMBLE = "+0,+0,+4,+1,+1.0E-06,-2.0E-06,+0,+1.0E-02,+0.0E+00,+128\n"
+
+
+class FakeScope(object):
+    """Records the commands sent to it, and answers the queries the DSO class makes."""
+    read_termination = '\n'
+
+    def __init__(self):
+        self.commands = []
+        self.preamble = PREAMBLE
+        self.data = np.array([128, 129, 130, 127], dtype=np.uint8)
+
+    def write(self, command):
+        self.commands.append(command)
+
+    def query(self, command):
+        self.commands.append(command)
+        return {':waveform:preamble?': self.preamble, ':acquire:points?': str(self.data.size)}[command]
+
+    def read_raw(self):
+        return b'#1{0}'.format(self.data.size) + self.data.tostring()
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def dso():
+    dso = AgilentDSO.__new__(AgilentDSO)  # bypass VISA
+    dso.instr = FakeScope()
+    dso.channel_names = (1, 2)
+    dso._waveform_dtype = np.dtype('u1')
+    dso.invalidate_preambles()
+    return dso
+
+
+def test_parse_ieee_block():
+    data = np.arange(5, dtype='>u2')
+    block = b'#210' + data.tostring() + b'\n'
+    assert np.array_equal(parse_ieee_block(block, '>u2'), data)
+    assert np.array_equal(parse_ieee_block(block, '<u2'), data.byteswap())
+    with pytest.raises(ValueError):
+        parse_ieee_block(block[:8], '>u2')
+    with pytest.raises(ValueError):
+        parse_ieee_block(data.tostring(), '>u2')
+
+
+def test_preamble_scaling():
+    preamble = WaveformPreamble(PREAMBLE)
+    assert preamble.format == 'byte'
+    assert preamble.points == 4
+    assert np.allclose(preamble.times(), [-2e-6, -1e-6, 0, 1e-6])
+    assert np.allclose(preamble.scale([128, 129, 228]), [0, 0.01, 1.0])
+
+
+def test_repeated_reads_reuse_the_preamble(dso):
+    for i in range(3):
+        time, trace = dso.read_trace(1)
+    assert np.allclose(trace, [0, 0.01, 0.02, -0.01])
+    assert dso.instr.commands.count(':waveform:preamble?') == 1
+    assert dso.instr.commands.count(':waveform:points 4') == 1
+    dso.write(':timebase:scale 1e-3')
+    dso.read_trace(1)
+    assert dso.instr.commands.count(':waveform:preamble?') == 2
+
+
+def test_preamble_is_requeried_if_the_record_length_changes(dso):
+    dso.read_trace(1)
+    # e.g. the scope stopped, so the whole record is available
+    dso.instr.preamble = "+0,+0,+8,+1,+5.0E-07,-2.0E-06,+0,+1.0E-02,+0.0E+00,+128\n"
+    dso.instr.data = np.full(8, 129, dtype=np.uint8)
+    time, traces = dso.read_traces(channels=[1], capture=False)
+    assert dso.instr.commands.count(':waveform:preamble?') == 2
+    assert traces.shape == (1, 8)
+    assert np.allclose(time, -2e-6 + 5e-7 * np.arange(8))
+    dso.stop()
+    dso.read_trace(1)
+    assert dso.instr.commands.count(':waveform:preamble?') == 3
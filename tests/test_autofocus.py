@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the autofocus strategies, using a simulated camera whose image blurs as the stage moves out of focus.
+"""
+import time
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from nplab.instrument.stage import Stage
+from nplab.instrument.camera import DummyCamera
+from nplab.instrument.camera.camera_with_location import CameraWithLocation
+from nplab.instrument.camera.autofocus import (GoldenSectionAutofocus, ContinuousAutofocus, roi_merit,
+                                               af_merit_laplacian_variance, af_merit_brenner, af_merit_fft_band)
+
+
+class MovingStage(Stage):
+    """A stage that moves at a finite speed, and reports its position while it moves."""
+    speed = 50.0  # units per second
+
+    def __init__(self):
+        Stage.__init__(self)
+        self._start = np.zeros(3)
+        self._target = np.zeros(3)
+        self._start_time = 0
+        self._duration = 0
+
+    def start_move(self, pos, axis=None, relative=False):
+        self._start = self.get_position()
+        self._target = np.array(pos, dtype=float)
+        self._start_time = time.time()
+        self._duration = np.max(np.abs(self._target - self._start)) / self.speed
+
+    def move(self, pos, axis=None, relative=False):
+        self.start_move(pos, axis, relative)
+        self.wait_until_stopped()
+
+    def is_moving(self, axes=None):
+        return time.time() < self._start_time + self._duration
+
+    def get_position(self, axis=None):
+        if self._duration == 0:
+            return self._target.copy()
+        fraction = min((time.time() - self._start_time) / self._duration, 1)
+        return self._start + (self._target - self._start) * fraction
+
+
+class FocusCamera(DummyCamera):
+    """A camera looking at a random texture, which is in focus when the stage is at `focus_z`."""
+    focus_z = 0.7
+
+    def __init__(self, stage):
+        self.stage = stage
+        texture = np.random.RandomState(0).random_sample((120, 160))
+        self.texture = ndimage.gaussian_filter(texture, 1) * 255
+        super(FocusCamera, self).__init__()
+
+    def raw_snapshot(self):
+        time.sleep(0.002)
+        blur = 0.5 + 1.5 * abs(self.stage.position[2] - self.focus_z)
+        image = np.clip(ndimage.gaussian_filter(self.texture, blur), 0, 255).astype(np.uint8)
+        return True, np.dstack((image,) * 3)
+
+
+@pytest.fixture
+def cwl():
+    stage = MovingStage()
+    camera = FocusCamera(stage)
+    cwl = CameraWithLocation(camera, stage)
+    cwl.frames_to_discard = 0
+    yield cwl
+    camera.close()
+
+
+@pytest.mark.parametrize("merit_function", [af_merit_laplacian_variance, af_merit_brenner, af_merit_fft_band,
+                                            roi_merit(af_merit_laplacian_variance, 0.5, downsample=2)])
+def test_merit_functions_peak_at_focus(cwl, merit_function):
+    merits = []
+    for z in [-1, 0.7, 2]:
+        cwl.move([0, 0, z])
+        merits.append(merit_function(cwl.color_image()))
+    assert np.argmax(merits) == 1
+
+
+def test_golden_section_autofocus(cwl):
+    result = cwl.run_autofocus(GoldenSectionAutofocus(search_range=3, coarse_steps=7, tolerance=0.05))
+    assert abs(cwl.stage.position[2] - FocusCamera.focus_z) < 0.1
+    assert result.frames == len(result.merits)
+    assert result.frames < 20
+    assert result.elapsed > 0
+
+
+def test_continuous_autofocus(cwl):
+    result = cwl.run_autofocus(ContinuousAutofocus(search_range=3), roi=0.5)
+    assert result.frames > 10
+    assert abs(result.position[2] - FocusCamera.focus_z) < 0.3
+
+
+def test_compare_autofocus_strategies(cwl):
+    cwl.move([0, 0, FocusCamera.focus_z])
+    summary = cwl.compare_autofocus_strategies([GoldenSectionAutofocus(3, 7, 0.05),
+                                                (GoldenSectionAutofocus(3, 7, 0.5), af_merit_brenner)],
+                                               defocus=[-1, 1.5], tolerance=0.1)
+    assert len(summary) == 2
+    assert summary[0]['elapsed'] <= summary[1]['elapsed']
+    precise = [row for row in summary if row['strategy'].endswith('tolerance=0.05)')][0]
+    assert precise['meets_tolerance']
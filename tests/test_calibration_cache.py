@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the calibration cache used by CameraWithLocation and CameraStageMapper.
+"""
+import numpy as np
+import pytest
+
+import nplab.datafile as df
+from nplab.instrument.camera.calibration_cache import CalibrationCache, calibration_error
+
+
+@pytest.fixture
+def cache(tmpdir):
+    f = df.DataFile(str(tmpdir.join("calibrations.h5")), mode="w")
+    yield CalibrationCache(f.require_group("calibrations"))
+    f.close()
+
+
+def test_latest_matching_calibration_is_returned(cache):
+    hardware_10x = {'objective': '10x', 'binning': (1, 1), 'stage': 'PI'}
+    hardware_100x = {'objective': '100x', 'binning': (1, 1), 'stage': 'PI'}
+    assert cache.latest(hardware_10x) is None
+    cache.save(np.identity(3), hardware_10x, residuals=0.01)
+    cache.save(np.identity(3) * 0.1, hardware_100x, residuals=0.02)
+    cache.save(np.identity(3) * 2, hardware_10x, residuals=0.03, attrs={'pixel_shifts': np.ones((4, 2))})
+
+    record = cache.latest(hardware_10x)
+    assert np.all(np.array(record) == np.identity(3) * 2)
+    assert record.attrs['residuals'] == 0.03
+    assert record.attrs['hardware_objective'] == '10x'
+    assert np.all(record.attrs['pixel_shifts'] == 1)
+    assert np.all(np.array(cache.latest(hardware_100x)) == np.identity(3) * 0.1)
+    assert len(cache.records(hardware_10x)) == 2
+    assert len(cache.records()) == 3
+
+
+def test_different_hardware_does_not_match(cache):
+    cache.save(np.identity(3), {'objective': '10x', 'binning': (1, 1)})
+    assert cache.latest({'objective': '10x', 'binning': (2, 2)}) is None
+    assert cache.latest({'objective': '10x'}) is None
+    assert cache.latest({'objective': '10x', 'binning': (1, 1), 'stage': 'PI'}) is None
+    assert cache.latest({'objective': '10x', 'binning': np.array([1, 1])}) is not None
+
+
+def test_old_format_is_ignored(cache):
+    hardware = {'objective': '10x'}
+    record = cache.save(np.identity(3), hardware)
+    record.attrs['calibration_version'] = 0
+    assert cache.latest(hardware) is None
+
+
+def test_calibration_error():
+    pixel_to_sample = np.array([[0.1, 0.02], [-0.02, 0.1]])
+    pixel_shifts = np.array([[50.0, 0], [0, 50.0]])
+    location_shifts = np.dot(pixel_shifts, pixel_to_sample)
+    assert calibration_error(pixel_shifts, location_shifts, pixel_to_sample) < 1e-10
+    assert np.isclose(calibration_error(pixel_shifts, location_shifts * 1.1, pixel_to_sample), 0.1 / 1.1)
+
+
+def test_matching_calibration_is_loaded_when_the_objective_changes(cache, drifting_camera):
+    from nplab.instrument.camera.camera_with_location import CameraWithLocation
+    cwl = CameraWithLocation(drifting_camera, drifting_camera.stage)
+    cwl.calibration_cache = cache
+    hardware = cwl.calibration_hardware()
+    hardware['objective'] = '100x'
+    cache.save(np.identity(3) * 0.1, hardware)
+    cwl.objective = '100x'
+    assert np.all(cwl.pixel_to_sample_displacement == np.identity(3) * 0.1)
+    # there's no calibration for this objective, so the last one is kept (not the one in the config file)
+    cwl.objective = '10x'
+    assert np.all(cwl.pixel_to_sample_displacement == np.identity(3) * 0.1)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the downsampling and rate limiting used by camera preview widgets.
+"""
+import time
+import numpy as np
+import pytest
+
+from nplab.instrument.camera.preview import decimation_factor, downsample, detach, PreviewWorker
+
+
+def test_decimation_factor():
+    assert decimation_factor((2048, 2048), (500, 600)) == 3
+    assert decimation_factor((2048, 2048, 3), (2000, 2000)) == 1
+    assert decimation_factor((100, 100), (500, 500)) == 1
+    assert decimation_factor((100, 100), None) == 1
+
+
+def test_downsample_keeps_dtype():
+    frame = np.arange(8 * 6, dtype=np.uint16).reshape(8, 6)
+    strided = downsample(frame, 2)
+    assert np.may_share_memory(strided, frame)  # a view, not a copy
+    assert np.all(strided == frame[::2, ::2])
+    binned = downsample(frame, 2, method='bin')
+    assert binned.dtype == np.uint16
+    assert binned.shape == (4, 3)
+    assert binned[0, 0] == int(np.mean(frame[:2, :2]))
+    colour = downsample(np.ones((9, 9, 3), dtype=np.uint8), 4, method='bin')
+    assert colour.shape == (2, 2, 3)
+    with pytest.raises(ValueError):
+        downsample(frame, 2, method='nearest')
+
+
+class FakeWidget(object):
+    def __init__(self):
+        self.images = []
+        self.update_pending = False
+
+    def downsample(self, frame):
+        return downsample(frame, 4)
+
+    def update_image(self, image, full_shape=None):
+        self.images.append((image, full_shape))
+
+
+class FakeCamera(object):
+    filter_function = None
+
+    def __init__(self):
+        self._preview_widgets = [FakeWidget()]
+
+
+def test_preview_worker_rate_limits_and_filters():
+    camera = FakeCamera()
+    camera.filter_function = lambda frame: frame + 1
+    worker = PreviewWorker(camera, max_rate=20)
+    try:
+        start = time.time()
+        while time.time() - start < 0.5:
+            worker.submit(np.zeros((64, 48), dtype=np.uint16))
+            time.sleep(0.001)
+        time.sleep(0.1)
+    finally:
+        worker.stop()
+    images = camera._preview_widgets[0].images
+    assert 2 <= len(images) <= 12
+    assert worker.frames_submitted > len(images)
+    image, full_shape = images[-1]
+    assert image.shape == (16, 12)
+    assert full_shape == (64, 48)
+    assert np.all(image == 1)
+
+
+def test_widgets_get_images_independent_of_the_frame():
+    frame = np.arange(64 * 48, dtype=np.uint16).reshape(64, 48)
+    image = detach(downsample(frame, 4), frame)
+    assert not np.may_share_memory(image, frame)
+    assert image.flags['C_CONTIGUOUS']
+    assert np.array_equal(image, frame[::4, ::4])
+    filtered = frame + 1
+    assert detach(filtered, frame) is filtered  # already a new array, so not copied again
+    camera = FakeCamera()
+    worker = PreviewWorker(camera, max_rate=0)
+    try:
+        worker.submit(frame)
+        time.sleep(0.1)
+    finally:
+        worker.stop()
+    image, full_shape = camera._preview_widgets[0].images[-1]
+    assert not np.may_share_memory(image, frame)
+
+
+def test_live_view_does_not_filter_on_the_acquisition_thread():
+    from nplab.instrument.camera import DummyCamera
+    cam = DummyCamera()
+    filtered = []
+    cam.filter_function = lambda frame: filtered.append(frame) or frame
+    cam.live_view_interval = 0
+    cam.live_view = True
+    try:
+        time.sleep(0.2)
+    finally:
+        cam.live_view = False
+        cam.close()
+    assert cam.frame_buffer.latest_seq > 0
+    assert len(filtered) == 0  # there are no preview widgets, so nothing needs filtering
+
+
+def test_camera_parameters_are_listed_without_reading_them():
+    from nplab.instrument.camera import DummyCamera, CameraParameter
+
+    class PartialCamera(DummyCamera):
+        """A camera that doesn't support one of its parameters, and counts the reads."""
+        shutter = CameraParameter("shutter")
+        reads = 0
+
+        def get_camera_parameter(self, name):
+            self.reads += 1
+            return DummyCamera.get_camera_parameter(self, name)
+
+    cam = PartialCamera()
+    try:
+        assert cam.reads == 0
+        assert set(cam.camera_parameter_names()) == {'exposure', 'gain', 'shutter'}
+        assert cam.reads == 0
+        assert 'shutter' in cam.metadata_property_names
+        metadata = cam.get_metadata()  # probes the parameters once, leaving out the unsupported one
+        assert 'gain' in metadata and 'shutter' not in metadata
+        reads = cam.reads
+        assert sorted(cam.available_camera_parameter_names()) == ['exposure', 'gain']
+        assert cam.reads == reads
+    finally:
+        cam.close()
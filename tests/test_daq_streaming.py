@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for continuous DAQ acquisition, using the simulated device.
+"""
+import numpy as np
+import pytest
+
+import nplab.datafile as df
+from nplab.instrument.electronics.daq_streaming import (RingBuffer, StreamingAcquisition, HDF5StreamWriter,
+                                                        SimulatedDAQ)
+
+
+def ramp(t):
+    return np.vstack((t, -t))
+
+
+def test_ring_buffer_keeps_latest_samples():
+    ring = RingBuffer(2, 10)
+    t = np.arange(27.0)
+    for block in np.array_split(ramp(t), [3, 4, 15, 20], axis=1):
+        ring.write(block)
+    assert ring.total_written == 27
+    assert np.array_equal(ring.latest(), ramp(t[-10:]))
+    assert np.array_equal(ring.latest(4), ramp(t[-4:]))
+
+
+def test_finite_acquisition_streams_to_disk(tmpdir):
+    f = df.DataFile(str(tmpdir.join("stream.h5")), mode="w")
+    daq = SimulatedDAQ(2, 1000.0, signal=ramp, realtime=False)
+    writer = HDF5StreamWriter(f, 2, attrs={"sample_rate": daq.sample_rate})
+    blocks = []
+    acquisition = StreamingAcquisition(daq, 100, consumers=[writer, blocks.append], sample_count=1050,
+                                       ring_capacity=300)
+    acquisition.start()
+    assert acquisition.wait(timeout=10)
+    assert [b.shape[1] for b in blocks] == [100] * 10 + [50]
+    expected = ramp(np.arange(1050) / 1000.0)
+    assert np.allclose(writer.dataset[...], expected)
+    assert np.allclose(acquisition.ring_buffer.latest(), expected[:, -300:])
+    assert not daq.running
+    f.close()
+
+
+def test_continuous_acquisition_runs_until_stopped():
+    daq = SimulatedDAQ(1, 10000.0)
+    acquisition = StreamingAcquisition(daq, 100).start()
+    assert acquisition.running
+    acquisition.stop()
+    assert not acquisition.running
+    assert acquisition.samples_read > 0
+
+
+def test_consumer_errors_are_raised():
+    def fail(block):
+        raise ValueError("consumer failed")
+    acquisition = StreamingAcquisition(SimulatedDAQ(1, 1000.0, realtime=False), 10, consumers=[fail],
+                                       sample_count=1000)
+    acquisition.start()
+    with pytest.raises(ValueError):
+        acquisition.wait(timeout=10)
+
+
+def test_ao_waveform_is_looped_back():
+    daq = SimulatedDAQ(3, 1000.0, signal=lambda t: np.zeros((3, len(t))), realtime=False)
+    waveform = np.array([np.linspace(0, 1, 40), np.linspace(1, 0, 40)])
+    daq.write_ao_waveform(waveform)
+    blocks = []
+    StreamingAcquisition(daq, 30, consumers=[blocks.append], sample_count=80).start().wait()
+    data = np.hstack(blocks)
+    assert np.array_equal(data[:2], np.hstack((waveform, waveform)))
+    assert np.all(data[2] == 0)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for nplab.datafile, in particular shared (deduplicated) attributes.
+"""
+import numpy as np
+import h5py
+import nplab.datafile as df
+
+
+def test_shared_attributes(tmpdir):
+    f = df.DataFile(str(tmpdir.join("shared_attrs.h5")), mode="w")
+    wavelengths = np.linspace(400, 1000, 2048)
+    for i in range(5):
+        f.create_dataset("spectrum_%d", data=np.zeros(2048),
+                         attrs={'wavelengths': wavelengths, 'integration_time': 10},
+                         shared_attrs_min_size=64)
+    # the array should have been stored only once
+    assert len(f[df.SHARED_ATTRIBUTES_GROUP]) == 1
+    for dset in f.numbered_items("spectrum"):
+        assert np.all(dset.attrs['wavelengths'] == wavelengths)
+        assert dset.attrs['integration_time'] == 10
+        assert np.all(dict(dset.attrs.items())['wavelengths'] == wavelengths)
+    # small arrays, or files without the option, are stored as usual
+    d = f.create_dataset("unshared", data=np.zeros(3), attrs={'wavelengths': wavelengths})
+    assert isinstance(h5py.Dataset(d.id).attrs['wavelengths'], np.ndarray)
+    assert np.all(d.attrs['wavelengths'] == wavelengths)
+    f.close()
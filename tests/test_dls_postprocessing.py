@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests for the vectorised DLS post-processing, against the original loop implementation.
+"""
+import numpy as np
+
+from nplab.experiment.dynamic_light_scattering import dls_signal_postprocessing as dls
+
+
+def loop_signal_diff(voltages):
+    rounded_voltages = voltages - np.min(voltages)
+    rounded_voltages = np.rint(rounded_voltages / np.max(rounded_voltages))
+    return rounded_voltages[0:-1] - rounded_voltages[1:]
+
+
+def loop_binning(thresholded, index_bin_width):
+    outp_len = dls.binned_data_len(len(thresholded), index_bin_width)
+    output = np.zeros(outp_len)
+    for i in range(outp_len):
+        output[i] = np.sum(np.absolute(thresholded[i * index_bin_width:(i + 1) * index_bin_width]))
+    return output
+
+
+def pulse_train(n=100003, seed=0):
+    """A noisy voltage trace with randomly placed pulses."""
+    random = np.random.RandomState(seed)
+    voltages = -0.5 * (random.uniform(size=n) < 0.05)
+    return voltages + random.normal(0, 0.05, n)
+
+
+def test_signal_diff():
+    voltages = pulse_train()
+    expected = loop_signal_diff(voltages)
+    assert np.array_equal(dls.signal_diff(voltages), expected)
+    out = np.empty(len(voltages) - 1)
+    dls.signal_diff(voltages.copy(), out=out, overwrite_input=True)
+    assert np.array_equal(out, expected)
+
+
+def test_threshold():
+    voltages = pulse_train()
+    assert np.array_equal(dls.threshold(voltages), np.absolute(np.sign(loop_signal_diff(voltages))))
+
+
+def test_threshold_level_changes_counts():
+    # pulses of two heights: only the tall ones cross a high threshold
+    voltages = np.zeros(100)
+    voltages[10:15] = 1.0
+    voltages[40:45] = 0.4
+    voltages[70:75] = 0.4
+    assert np.sum(dls.threshold(voltages, count_threshold=0.3)) == 6
+    assert np.sum(dls.threshold(voltages, count_threshold=0.7)) == 2
+
+
+def test_binning():
+    diff = loop_signal_diff(pulse_train())
+    for width in [1, 7, 20, 1000, len(diff), len(diff) + 5]:
+        assert np.array_equal(dls.binning(diff, width), loop_binning(diff, width))
+    assert len(dls.binning(np.zeros(0), 10)) == 0
+
+
+def test_chunked_postprocess():
+    voltages = pulse_train()
+    expected = loop_binning(np.absolute(loop_signal_diff(voltages)), 20)
+    for chunk_size in [10, 1000, 4099, 2 ** 22]:
+        assert np.array_equal(dls.postprocess(voltages, 20, chunk_size=chunk_size), expected)
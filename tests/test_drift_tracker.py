@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for drift tracking, using a simulated camera that sees a texture shifted by a known amount.
+"""
+import time
+import numpy as np
+import pytest
+
+from nplab.instrument.camera.camera_with_location import CameraWithLocation
+
+
+@pytest.fixture
+def cwl(drifting_camera):
+    cwl = CameraWithLocation(drifting_camera, drifting_camera.stage)
+    cwl.pixel_to_sample_displacement = np.identity(3)
+    yield cwl
+    cwl.stop_drift_tracking()
+
+
+def test_drift_is_measured(cwl):
+    from nplab.instrument.camera.drift_tracker import DriftTracker
+    tracker = DriftTracker(cwl, roi=0.75)
+    tracker.set_reference()
+    for drift in [(0, 0), (1.5, -2.25), (3, -4.5), (-2.2, 0.6)]:
+        cwl.camera.drift = np.array(drift)
+        record = tracker.measure()
+        assert np.all(np.abs(record['pixel_shift'] - drift) < 0.15)
+        assert np.all(np.abs(record['drift'][:2] - drift) < 0.15)
+    assert np.all(cwl.stage.position == 0)
+    assert tracker.drift_trace['drift'].shape == (4, 3)
+
+
+def test_drift_is_compensated_at_a_bounded_rate(cwl):
+    from nplab.instrument.camera.drift_tracker import DriftTracker
+    tracker = DriftTracker(cwl, compensate=True, max_step=2, max_correction_rate=1000)
+    tracker.set_reference()
+    cwl.camera.drift = np.array([3.0, -4.0])
+    first = tracker.measure()
+    assert np.allclose(np.sqrt(np.sum(first['correction'] ** 2)), 2)  # limited by max_step
+    time.sleep(0.002)
+    tracker.measure()
+    time.sleep(0.002)
+    last = tracker.measure()
+    assert np.all(np.abs(cwl.stage.position[:2] - [3, -4]) < 0.15)
+    assert np.all(np.abs(last['drift'][:2] - [3, -4]) < 0.15)
+
+    slow_tracker = DriftTracker(cwl, compensate=True, max_correction_rate=0.01)  # one correction per 100s
+    slow_tracker.set_reference()
+    cwl.camera.drift = np.array([5.0, -4.0])
+    assert np.all(np.abs(slow_tracker.measure()['correction'][:2] - [2, 0]) < 0.15)
+    cwl.camera.drift = np.array([7.0, -4.0])
+    assert np.all(slow_tracker.measure()['correction'] == 0)
+
+
+def test_background_tracking(cwl):
+    tracker = cwl.start_drift_tracking(interval=0.01)
+    time.sleep(0.1)
+    cwl.camera.drift = np.array([0, 2.0])
+    time.sleep(0.1)
+    cwl.stop_drift_tracking()
+    assert not tracker.running
+    drift = tracker.drift_trace['drift']
+    assert len(drift) > 3
+    assert np.all(np.abs(drift[-1, :2] - [0, 2]) < 0.15)
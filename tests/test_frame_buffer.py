@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the camera frame ring buffer, including a quick benchmark of live
+view with DummyCamera.
+"""
+import time
+import threading
+import numpy as np
+import pytest
+
+from nplab.instrument.camera.frame_buffer import FrameRingBuffer, FrameOverwrittenError
+
+
+def test_sequence_numbers_and_overwriting():
+    buf = FrameRingBuffer(4)
+    for i in range(6):
+        assert buf.push(np.full((3, 2), i, dtype=np.uint16)) == i
+    assert buf.latest_seq == 5
+    assert buf.oldest_seq == 2
+    assert np.all(buf.get() == 5)
+    assert np.all(buf.get(2) == 2)
+    with pytest.raises(FrameOverwrittenError):
+        buf.get(1)
+    with pytest.raises(IndexError):
+        buf.get(6)
+
+
+def test_views_and_last_frames():
+    buf = FrameRingBuffer(4)
+    for i in range(3):
+        buf.push(np.full((2, 2), i))
+    view = buf.get(0, copy=False)
+    frames, seqs = buf.last_frames(2)
+    assert seqs.tolist() == [1, 2]
+    assert frames.shape == (2, 2, 2)
+    assert np.all(frames[0] == 1) and np.all(frames[1] == 2)
+    for i in range(3, 5):
+        buf.push(np.full((2, 2), i))
+    assert not buf.is_valid(0) # the view has now been overwritten
+    assert np.all(view == 4)
+
+
+def test_writing_into_claimed_slot():
+    buf = FrameRingBuffer(2)
+    buf.push(np.zeros((2, 2)))
+    slot = buf.claim_slot()
+    slot[...] = 7
+    assert buf.latest_seq == 0
+    assert buf.push(slot) == 1 # no copy needed
+    assert np.all(buf.get() == 7)
+
+
+def test_reader_counts_dropped_frames():
+    buf = FrameRingBuffer(4)
+    reader = buf.reader()
+    buf.push(np.zeros(1))
+    assert reader.read(timeout=1)[0] == 0
+    for i in range(1, 10):
+        buf.push(np.full(1, i))
+    assert reader.read(timeout=1)[0] == 6 # frames 1-5 were overwritten
+    assert reader.dropped == 5
+    threading.Timer(0.05, buf.push, [np.full(1, 10)]).start()
+    reader.read()
+    reader.read()
+    reader.read()
+    assert reader.read(timeout=1)[0] == 10
+    with pytest.raises(IOError):
+        reader.read(timeout=0.01)
+
+
+def test_dummy_camera_live_view_benchmark():
+    from nplab.instrument.camera import DummyCamera
+    cam = DummyCamera()
+    cam.live_view_interval = 0
+    reader = cam.frame_reader()
+    cam.live_view = True
+    try:
+        start = time.time()
+        frames_read = 0
+        while time.time() - start < 0.5:
+            reader.read(timeout=1, copy=False)
+            frames_read += 1
+        frames_acquired = cam.frame_buffer.latest_seq + 1
+        elapsed = time.time() - start
+        assert cam.get_next_frame(timeout=1).shape == (100, 100, 3)
+        frames, seqs = cam.last_frames(5)
+        assert frames.shape == (5, 100, 100, 3)
+        assert np.all(np.diff(seqs) == 1)
+    finally:
+        cam.live_view = False
+        cam.close()
+    acquired_rate = frames_acquired / elapsed
+    read_rate = frames_read / elapsed
+    assert frames_read + reader.dropped <= frames_acquired
+    assert acquired_rate > 200  # frames/s
+    assert read_rate > 100
@@ -0,0 +1,72 @@
+"""
+Tests for the vectorised particle statistics used by the image filter box.
+"""
+import numpy as np
+import pytest
+
+from nplab.utils.image_filter_box import (particle_statistics, particle_size_filter, detect_particles,
+                                          detect_particles_in_stack)
+
+
+def disk_image(shape, disks):
+    """A binary image with a filled disk for each (row, column, radius)."""
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    image = np.zeros(shape, dtype=np.uint8)
+    for r, c, radius in disks:
+        image[(rows - r) ** 2 + (cols - c) ** 2 <= radius ** 2] = 255
+    return image
+
+
+def test_particle_statistics_measures_disks():
+    disks = [(20, 30, 3), (50, 60, 6), (80, 15, 10)]
+    image = disk_image((100, 100), disks)
+    image[5:7, 75:85] = 255  # a line, which is very elongated
+    particles = particle_statistics(image)
+    assert len(particles) == 4
+    order = np.argsort(particles['area'])
+    line, small, medium, large = particles[order]
+    for p, (r, c, radius) in zip([small, medium, large], disks):
+        assert np.allclose(p['centroid'], [r, c])
+        assert abs(p['radius'] - radius) < 0.5
+        assert abs(p['area'] - np.pi * radius ** 2) < 2 * np.pi * radius
+        assert p['elongation'] < 1.2
+    assert np.allclose(line['centroid'], [5.5, 79.5])
+    assert abs(line['elongation'] - 5) < 0.01  # 10 by 2 pixels
+    keep = particle_size_filter(particles, min_size=2.5, max_size=7, max_elongation=2)
+    assert sorted(particles['area'][keep]) == [small['area'], medium['area']]
+
+
+def test_particle_statistics_for_a_stack():
+    stack = np.array([disk_image((40, 40), [(10, 10, 3)]),
+                      disk_image((40, 40), [(10, 10, 3), (30, 25, 4)])])
+    intensity = stack.astype(np.float) * 2
+    particles = particle_statistics(stack, intensity=intensity, stack=True)
+    assert len(particles) == 3  # the disks at (10, 10) are not joined between frames
+    assert list(particles['frame']) == [0, 1, 1]
+    assert np.allclose(particles['centroid'], [[10, 10], [10, 10], [30, 25]])
+    assert np.allclose(particles['mean_intensity'], 510)
+    single = particle_statistics(stack[1])
+    assert np.all(single['area'] == particles['area'][1:])
+    assert np.allclose(single['radius'], particles['radius'][1:])
+
+
+def test_particle_statistics_with_no_particles():
+    particles, labels = particle_statistics(np.zeros((10, 10)), return_labels=True)
+    assert len(particles) == 0
+    assert np.all(labels == 0)
+
+
+def test_detect_particles_in_stack_matches_single_images():
+    # the (binned) radius of the larger disk is outside the default size range
+    images = [disk_image((200, 200), [(40, 40, 4), (120, 150, 5)]),
+              disk_image((200, 200), [(100, 60, 4)])]
+    particles = detect_particles_in_stack(images)
+    assert list(particles['frame']) == [0, 1]
+    for i, g in enumerate(images):
+        single = detect_particles(g)
+        assert np.allclose(particles[particles['frame'] == i]['centroid'], single['centroid'])
+        colour = detect_particles(np.dstack((g,) * 3))
+        assert np.allclose(colour['centroid'], single['centroid'])
+    assert len(detect_particles_in_stack(images, max_size=10)) == 3
+    with pytest.raises(TypeError):
+        detect_particles_in_stack(images, no_such_argument=1)
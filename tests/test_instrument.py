@@ -137,3 +137,49 @@ def test_saving(capsys, tmpdir):
     
     df.close()
 
+
+########################## Test the property cache #############################
+
+class CountingInstrument(Instrument):
+    """An instrument that counts how many times its property is read."""
+    metadata_property_names = ('value',)
+    def __init__(self):
+        super(CountingInstrument, self).__init__()
+        self.reads = 0
+        self._value = 1
+    @property
+    def value(self):
+        self.reads += 1
+        return self._value
+    @value.setter
+    def value(self, v):
+        self._value = v
+
+def test_property_cache():
+    c = CountingInstrument()
+    c.get_metadata()
+    c.get_metadata()
+    assert c.reads == 2, "Values shouldn't be cached unless the cache is enabled"
+    
+    c.enable_property_cache(value=float('inf'))
+    assert c.get_metadata() == {'value': 1}
+    assert c.get_metadata() == {'value': 1}
+    assert c.reads == 3, "The second read should have come from the cache"
+    
+    c.value = 5 # setting the property must invalidate the cache
+    assert c.get_metadata() == {'value': 5}
+    assert c.reads == 4
+    
+    c.disable_property_cache()
+    c.get_metadata()
+    assert c.reads == 5
+
+def test_snapshot_metadata():
+    c = CountingInstrument()
+    assert c.snapshot_metadata() == {'value': 1}
+    for i in range(10):
+        assert c.get_metadata() == {'value': 1}
+    assert c.reads == 1, "Metadata was re-read after a snapshot"
+    c.invalidate_property_cache('value')
+    c.get_metadata()
+    assert c.reads == 2
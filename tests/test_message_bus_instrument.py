@@ -17,4 +17,23 @@ def test_parsing():
     assert e.parsed_query("tell me 0x17","tell me %x") == 23
     assert e.parsed_query("tell me 010","%i") == 8
     assert e.parsed_query("tell me 010","%o") == 8
-    
\ No newline at end of file
+    
+def test_queried_property_cache():
+    from nplab.instrument.message_bus_instrument import queried_property
+    class CountingEchoInstrument(EchoInstrument):
+        x = queried_property('7', 'set {0}', dtype='int', cache_ttl=float('inf'))
+        queries = 0
+        def query(self, *args, **kwargs):
+            self.queries += 1
+            return EchoInstrument.query(self, *args, **kwargs)
+    e = CountingEchoInstrument()
+    assert e.x == 7
+    assert e.x == 7
+    assert e.queries == 2, "Values shouldn't be cached unless the cache is enabled"
+    e.enable_property_cache()
+    assert e.x == 7
+    assert e.x == 7
+    assert e.queries == 3
+    e.x = 9 # writing should invalidate the cached value
+    assert e.x == 7
+    assert e.queries == 4
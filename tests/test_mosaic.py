@@ -0,0 +1,68 @@
+"""
+Tests for phase correlation and stitching tiles into a mosaic.
+"""
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from nplab.utils.image_with_location import ImageWithLocation, phase_correlation
+from nplab.utils.mosaic import Mosaic
+
+
+def make_sample(shape=(300, 400), seed=0):
+    """A smooth random texture, scaled to fill the range of a uint8."""
+    sample = ndimage.gaussian_filter(np.random.RandomState(seed).random_sample(shape), 3)
+    sample -= sample.min()
+    return (sample / sample.max() * 255).astype(np.uint8)
+
+
+def test_phase_correlation_finds_subpixel_shifts():
+    sample = make_sample((128, 128)).astype(np.float)
+    for true_shift in [(3, -7), (0.5, 2.25), (-10.4, 0)]:
+        shifted = np.fft.ifft2(ndimage.fourier_shift(np.fft.fft2(sample), true_shift)).real
+        shift, peak = phase_correlation(sample, shifted, window=False)
+        assert np.all(np.abs(shift - true_shift) < 0.2), "found {}, expected {}".format(shift, true_shift)
+        assert peak > 0.3
+
+
+def make_tile(sample, corner, shape, metadata_error=(0, 0)):
+    """Cut a tile out of the sample, with its position recorded (perhaps wrongly) in the metadata."""
+    tile = ImageWithLocation(sample[corner[0]:corner[0] + shape[0], corner[1]:corner[1] + shape[1]])
+    M = np.identity(4)
+    M[3, :2] = np.array(corner) + np.array(metadata_error)  # pixels in the sample are our unit of distance
+    tile.pixel_to_sample_matrix = M
+    return tile
+
+
+def test_mosaic_places_and_refines_tiles():
+    sample = make_sample()
+    tile_shape = (128, 160)
+    corners = [(r, c) for r in [0, 90, 172] for c in [0, 120, 240]]
+    errors = np.random.RandomState(1).randint(-6, 7, size=(len(corners), 2))
+    errors[0] = 0  # the first tile sets the position of everything else
+    mosaic = Mosaic((300, 400), np.identity(4), max_shift=20)
+    for corner, error in zip(corners, errors):
+        position = mosaic.add_tile(make_tile(sample, corner, tile_shape, error))
+        assert np.all(np.abs(position - corner) < 1), "tile at {} was placed at {}".format(corner, position)
+    assert np.all(mosaic.weights[...] > 0)
+    assert np.mean(np.abs(mosaic.image.astype(np.float) - sample)) < 1
+
+    levels = mosaic.build_pyramid(min_size=100)
+    assert [l.shape for l in levels] == [(300, 400), (150, 200)]
+    assert np.allclose(levels[1].pixel_to_location([0, 0])[:2], [0.5, 0.5])
+    assert abs(float(levels[1][10, 10]) - np.mean(sample[20:22, 20:22])) < 2
+
+
+def test_mosaic_for_tiles_without_refinement():
+    sample = make_sample()
+    first = make_tile(sample, (100, 100), (64, 64))
+    offsets = [(0, 0), (0, 50), (50, 0), (50, 50)]
+    mosaic = Mosaic.for_tiles(first, offsets, margin=5, refine=False)
+    assert mosaic.shape == (124, 124)
+    assert mosaic.canvas.dtype == np.uint8
+    for offset in offsets:
+        corner = np.array(offset) + 100
+        mosaic.add_tile(make_tile(sample, corner, (64, 64)))
+    image = mosaic.image
+    assert np.all(image[5:-5, 5:-5] == sample[100:214, 100:214])
+    assert np.allclose(image.pixel_to_location([5, 5])[:2], [100, 100])
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the streaming multi-tau correlator, against the batch FFT autocorrelation.
+"""
+import numpy as np
+
+from nplab.experiment.dynamic_light_scattering.dls_signal_postprocessing import autocorrelation
+from nplab.experiment.dynamic_light_scattering.multitau import MultiTauCorrelator
+
+
+def synthetic_counts(n=2 ** 16, correlation_time=50.0, seed=0):
+    """Photon counts from a fluctuating intensity with an exponential autocorrelation."""
+    random = np.random.RandomState(seed)
+    a = np.exp(-1.0 / correlation_time)
+    noise = random.normal(size=n) * np.sqrt(1 - a ** 2)
+    fluctuation = np.zeros(n)
+    for i in range(1, n):
+        fluctuation[i] = a * fluctuation[i - 1] + noise[i]
+    return random.poisson(20 * (1 + 0.5 * np.clip(fluctuation, -1.9, 1.9)))
+
+
+def test_matches_batch_autocorrelation():
+    counts = synthetic_counts()
+    correlator = MultiTauCorrelator(channels_per_level=16, n_levels=10)
+    correlator.add(counts)
+    batch = autocorrelation(counts)
+    lags = correlator.lags
+    g2 = correlator.g2
+    # level 0 is calculated exactly as in the batch calculation
+    assert np.allclose(g2[:16], batch[:16])
+    # higher levels are binned, so they are only approximately the same
+    usable = lags < len(counts) / 20
+    assert np.allclose(g2[usable], batch[lags[usable]], rtol=0.01)
+
+
+def test_blocks_give_the_same_result():
+    counts = synthetic_counts(n=10000)
+    whole = MultiTauCorrelator(n_levels=8)
+    whole.add(counts)
+    blocks = MultiTauCorrelator(n_levels=8)
+    for block in np.array_split(counts, [7, 100, 101, 3333, 5000, 9999]):
+        blocks.add(block)
+    assert blocks.sample_count == len(counts)
+    assert np.allclose(whole.g2, blocks.g2, equal_nan=True)
+
+
+def test_correlation_omits_missing_lags():
+    correlator = MultiTauCorrelator(n_levels=20, dt=0.1)
+    correlator.add(np.ones(100))
+    times, g2 = correlator.correlation()
+    assert np.all(g2 == 1)
+    assert times[0] == 0.1
+    assert times[-1] < 10
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the background reader thread of SerialInstrument.
+
+A pseudo-terminal stands in for the device: a thread on the master side reads
+commands and replies to each one after a short delay, in order.
+"""
+import os
+import time
+import threading
+import Queue
+import pytest
+
+pty = pytest.importorskip("pty")
+pytest.importorskip("serial")
+
+from nplab.instrument.serial_instrument import SerialInstrument
+
+
+class LoopbackDevice(object):
+    """Replies "reply:<command>" to every line except "silent", after `delay` seconds.
+    
+    Commands starting with "slow" are replied to after `slow_delay` seconds.
+    """
+    slow_delay = 0.5
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.master, slave = pty.openpty()
+        self.port = os.ttyname(slave)
+        self.received = []
+        self._to_reply = Queue.Queue()
+        self._stop = False
+        for target in [self._read, self._reply]:
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def _read(self):
+        buffered = ""
+        while not self._stop:
+            try:
+                buffered += os.read(self.master, 1024)
+            except OSError:
+                break
+            lines = buffered.split("\n")
+            buffered = lines.pop()
+            self.received.extend(lines)
+            for line in lines:
+                self._to_reply.put(line)
+
+    def _reply(self):
+        while not self._stop:
+            line = self._to_reply.get()
+            if line == "silent":
+                continue
+            time.sleep(self.slow_delay if line.startswith("slow") else self.delay)
+            os.write(self.master, "reply:" + line + "\n")
+
+    def close(self):
+        self._stop = True
+
+
+class LoopbackInstrument(SerialInstrument):
+    port_settings = {'baudrate': 115200, 'timeout': 1}
+
+
+def test_reader_thread_matches_replies():
+    device = LoopbackDevice()
+    instr = LoopbackInstrument(device.port)
+    try:
+        assert instr.query("a") == "reply:a"
+        instr.start_reader_thread()
+        futures = [instr.query_async(c) for c in "bcd"]
+        assert [f.result(2) for f in futures] == ["reply:b", "reply:c", "reply:d"]
+        assert instr.query("e", timeout=2) == "reply:e"
+    finally:
+        instr.close()
+        device.close()
+
+
+def test_pipelined_queries_overlap():
+    device = LoopbackDevice(delay=0.2)
+    instr = LoopbackInstrument(device.port)
+    instr.max_outstanding_queries = 3
+    try:
+        instr.start_reader_thread()
+        futures = [instr.query_async(c) for c in "xyz"]
+        time.sleep(0.1)
+        # all three commands were sent before the first reply came back
+        assert device.received == ["x", "y", "z"]
+        assert not futures[0].done()
+        assert futures[2].result(2) == "reply:z"
+    finally:
+        instr.close()
+        device.close()
+
+
+def test_timed_out_query_frees_its_slot():
+    device = LoopbackDevice()
+    instr = LoopbackInstrument(device.port)
+    try:
+        instr.start_reader_thread()
+        with pytest.raises(IOError):
+            instr.query("silent", timeout=0.3)
+        # the next reply goes to the next query, not the one that timed out
+        assert instr.query("f") == "reply:f"
+        with pytest.raises(IOError):
+            instr.query_async("silent", timeout=0.3).result(2)
+        assert instr.query_async("g").result(2) == "reply:g"
+    finally:
+        instr.close()
+        device.close()
+
+
+def test_late_reply_is_not_passed_to_the_next_query():
+    device = LoopbackDevice()
+    instr = LoopbackInstrument(device.port)
+    instr.max_outstanding_queries = 3
+    try:
+        instr.start_reader_thread()
+        with pytest.raises(IOError):
+            instr.query("slow1", timeout=0.3)
+        assert instr.query("i", timeout=2) == "reply:i"
+        # queries sent behind the one that times out still get their own replies
+        futures = [instr.query_async("slow2", timeout=0.3)]
+        futures += [instr.query_async(c, timeout=2) for c in "jk"]
+        with pytest.raises(IOError):
+            futures[0].result(2)
+        assert [f.result(2) for f in futures[1:]] == ["reply:j", "reply:k"]
+    finally:
+        instr.close()
+        device.close()
+
+
+def test_multiline_query_needs_termination_line():
+    device = LoopbackDevice()
+    instr = LoopbackInstrument(device.port)
+    try:
+        instr.start_reader_thread()
+        with pytest.raises(ValueError):
+            instr.query_async("h", multiline=True)
+    finally:
+        instr.close()
+        device.close()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the streaming software lock-in.
+"""
+import numpy as np
+
+from nplab.techniques.software_lockin import software_lockin, StreamingLockin
+
+
+fs = 10000.0
+f = 100.0
+
+
+def two_channel_signal(n=20000):
+    t = np.arange(n) / fs
+    signals = np.vstack((0.5 * np.sin(2 * np.pi * f * t + 0.3) + 0.2 * np.sin(2 * 2 * np.pi * f * t - 1.0),
+                         1.5 * np.sin(2 * np.pi * f * t - 0.7)))
+    return t, signals
+
+
+def test_amplitude_and_phase_of_harmonics():
+    t, signals = two_channel_signal()
+    lockin = StreamingLockin(fs, f, harmonics=[1, 2], time_constant=0.01)
+    lockin.process(signals)
+    assert np.allclose(lockin.r, [[0.5, 0.2], [1.5, 0]], atol=0.01)
+    assert np.allclose(lockin.theta[:, 0], [0.3, -0.7], atol=0.01)
+    assert np.isclose(lockin.theta[0, 1], -1.0, atol=0.01)
+
+
+def test_blocks_give_the_same_result():
+    t, signals = two_channel_signal(5000)
+    whole = StreamingLockin(fs, f, harmonics=[1, 3], time_constant=0.005, decimation=7)
+    expected = whole.process(signals)
+    blocks = StreamingLockin(fs, f, harmonics=[1, 3], time_constant=0.005, decimation=7)
+    outputs = []
+    for block in np.array_split(signals, [1, 100, 101, 2500, 4999], axis=1):
+        outputs.append(blocks.process(block))
+    assert np.allclose(np.concatenate(outputs, axis=2), expected)
+    assert np.allclose(blocks.latest, whole.latest)
+
+
+def test_matches_one_shot_lockin():
+    t, signals = two_channel_signal()
+    reference = np.sin(2 * np.pi * f * t + 0.4)
+    lockin = StreamingLockin.from_reference(t, reference, time_constant=0.01)
+    received = []
+    lockin.consumers.append(received.append)
+    lockin(signals[1])
+    x, y = software_lockin(t, signals[1], reference)
+    assert np.allclose([lockin.x[0, 0], lockin.y[0, 0]], [x, y], atol=0.01)
+    assert received[0].shape == (1, 1, len(t))
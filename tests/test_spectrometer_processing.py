@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Tests that processing a stack of spectra in one go gives the same answer as processing them one at a time.
+"""
+import numpy as np
+import pytest
+
+from nplab.instrument.spectrometer import DummySpectrometer, process_saved_spectra
+
+
+@pytest.fixture
+def spectrometer():
+    s = DummySpectrometer()
+    random = np.random.RandomState(0)
+    n = len(s.wavelengths)
+    s.background = random.random_sample(n)
+    s.background_constant = random.random_sample(n) * 0.1
+    s.background_gradient = random.random_sample(n) * 0.01
+    s.background_int = 10
+    s.reference = s.background + 1 + random.random_sample(n)
+    s.reference_int = 20
+    return s
+
+
+def stack(s, n=5):
+    return np.random.RandomState(1).random_sample((n, len(s.wavelengths))) * 2
+
+
+@pytest.mark.parametrize("variable_int", [False, True])
+@pytest.mark.parametrize("absorption", [False, True])
+@pytest.mark.parametrize("referenced", [False, True])
+def test_stack_matches_single_spectra(spectrometer, variable_int, absorption, referenced):
+    s = spectrometer
+    s.variable_int_enabled = variable_int
+    s.absorption_enabled = absorption
+    if not referenced:
+        s.reference = None
+    spectra = stack(s)
+    integration_times = np.array([5, 10, 15, 20, 25])
+    processed = s.process_spectra(spectra, integration_times)
+    assert processed.shape == spectra.shape
+    for spectrum, t, result in zip(spectra, integration_times, processed):
+        s.integration_time = t
+        np.testing.assert_array_equal(s.process_spectrum(spectrum), result)
+
+
+def test_unprocessed_spectra_are_unchanged(spectrometer):
+    spectrometer.background = None
+    spectra = stack(spectrometer)
+    assert spectrometer.process_spectra(spectra) is spectra
+
+
+def test_reprocessing_saved_spectra(spectrometer):
+    spectrometer.variable_int_enabled = True
+    spectra = stack(spectrometer)
+    attrs = dict((k, getattr(spectrometer, k)) for k in ['background', 'reference', 'background_constant',
+                                                         'background_gradient', 'reference_int',
+                                                         'variable_int_enabled', 'absorption_enabled'])
+    attrs['integration_time'] = 15
+    spectrometer.integration_time = 15
+    np.testing.assert_array_equal(process_saved_spectra(spectra, attrs), spectrometer.process_spectra(spectra))
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for synchronised acquisition from several spectrometers.
+"""
+import time
+import numpy as np
+
+from nplab.instrument.spectrometer import Spectrometers, DummySpectrometer
+from nplab.instrument.spectrometer.synchronised import stitch_indices
+
+
+class SlowSpectrometer(DummySpectrometer):
+    def __init__(self, wavelengths, read_time):
+        super(SlowSpectrometer, self).__init__()
+        self._wavelengths = np.array(wavelengths, dtype=float)
+        self.read_time = read_time
+
+    def get_wavelengths(self):
+        return self._wavelengths
+
+    wavelengths = property(get_wavelengths)
+
+    def read_spectrum(self, bundle_metadata=False):
+        time.sleep(self.read_time)
+        return self._wavelengths.copy()
+
+
+def test_acquisitions_run_in_parallel():
+    spectrometers = Spectrometers([SlowSpectrometer(np.arange(10), 0.2), SlowSpectrometer(np.arange(10, 20), 0.1)])
+    for i in range(2):  # the workers should be reusable
+        t0 = time.time()
+        spectra = spectrometers.read_spectra()
+        assert time.time() - t0 < 0.28
+        assert np.all(spectra[1] == np.arange(10, 20))
+    starts = [start for start, end in spectrometers.latest_timestamps]
+    assert abs(starts[0] - starts[1]) < 0.05
+    assert all(end > start for start, end in spectrometers.latest_timestamps)
+
+
+def test_trigger_is_fired_once_all_have_started():
+    fired = []
+    spectrometers = Spectrometers([SlowSpectrometer(np.arange(10), 0.05) for i in range(3)],
+                                  trigger=lambda: fired.append(time.time()))
+    spectrometers.read_spectra()
+    assert len(fired) == 1
+    assert all(start <= fired[0] for start, end in spectrometers.latest_timestamps)
+
+
+def test_stitching():
+    indices, order = stitch_indices([np.arange(500, 1000, 10.0), np.arange(300, 600, 10.0)])
+    assert list(order) == [1, 0]
+    spectrometers = Spectrometers([SlowSpectrometer(np.arange(500, 1000, 10.0), 0),
+                                   SlowSpectrometer(np.arange(300, 600, 10.0), 0)])
+    wavelengths = spectrometers.stitched_wavelengths
+    assert np.all(np.diff(wavelengths) > 0)
+    assert wavelengths[0] == 300 and wavelengths[-1] == 990
+    assert np.all(spectrometers.stitch_spectra(spectrometers.read_spectra()) == wavelengths)
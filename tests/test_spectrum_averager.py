@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the in-place spectrum averager.
+"""
+import numpy as np
+
+from nplab.instrument.spectrometer.averaging import SpectrumAverager
+
+
+def random_spectra(n=20, m=50):
+    return np.random.RandomState(0).normal(10, 2, (n, m))
+
+
+def test_mean_and_variance_match_numpy():
+    spectra = random_spectra()
+    averager = SpectrumAverager()
+    averager.add_spectra(spectra)
+    assert averager.count == len(spectra)
+    np.testing.assert_allclose(averager.mean, np.mean(spectra, axis=0))
+    np.testing.assert_allclose(averager.variance, np.var(spectra, axis=0))
+    np.testing.assert_allclose(averager.standard_error, np.std(spectra, axis=0) / np.sqrt(len(spectra)))
+
+
+def test_window_is_exact_then_rolling():
+    spectra = random_spectra()
+    averager = SpectrumAverager(window=5)
+    averager.add_spectra(spectra[:5])
+    np.testing.assert_allclose(averager.mean, np.mean(spectra[:5], axis=0))
+    for i in range(30):
+        averager.add(np.ones(spectra.shape[1]) * 100)
+    assert averager.effective_count == 5
+    np.testing.assert_allclose(averager.mean, 100, rtol=0.01)  # old spectra decay away
+
+
+def test_reset_and_change_of_shape():
+    averager = SpectrumAverager()
+    averager.add(np.ones(10))
+    averager.reset()
+    assert averager.mean is None
+    averager.add(np.ones(10))
+    averager.add(np.zeros(20))
+    assert averager.count == 1
+    assert averager.mean.shape == (20,)
+
+
+def test_median_of_k():
+    averager = SpectrumAverager(median_of=3)
+    averager.add(np.zeros(4))
+    averager.add(np.array([0, 0, 0, 1000.0]))
+    assert averager.mean is None
+    averager.add(np.ones(4))
+    assert averager.count == 1
+    np.testing.assert_array_equal(averager.mean, [0, 0, 0, 1])
+
+
+def test_cosmic_ray_rejection():
+    spectra = random_spectra()
+    spectra[15, 7] = 1000
+    averager = SpectrumAverager(cosmic_ray_threshold=10)
+    averager.add_spectra(spectra)
+    assert averager.rejected_points == 1
+    assert averager.mean[7] < 20
+
+
+def test_spectrometer_averages_into_a_reused_buffer():
+    from nplab.instrument.spectrometer import DummySpectrometer
+    spectrometer = DummySpectrometer()
+    spectrometer.integration_time = 1
+    spectrometer.averager.window = 3
+    average = spectrometer.read_averaged_spectrum(new_deque=True)
+    buffer = spectrometer._read_buffer
+    assert average.shape == spectrometer.wavelengths.shape
+    assert spectrometer.averager.count == 3
+    spectrometer.read_averaged_spectrum(fresh=True)
+    assert spectrometer._read_buffer is buffer
+    out = np.zeros(len(spectrometer.wavelengths))
+    assert spectrometer.read_spectrum_into(out) is out
+
+
+def test_read_buffer_follows_the_number_of_wavelengths():
+    from nplab.instrument.spectrometer import DummySpectrometer
+
+    class CroppedSpectrometer(DummySpectrometer):
+        wavelengths = np.arange(400, 1200, 1)
+
+    spectrometer = CroppedSpectrometer()
+    spectrometer.integration_time = 1
+    spectrometer.read_averaged_spectrum(fresh=True)
+    spectrometer.wavelengths = np.arange(500, 600, 1)
+    average = spectrometer.read_averaged_spectrum(fresh=True)
+    assert spectrometer._read_buffer.shape == (100,)
+    assert average.shape == (100,)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the asynchronous move API of Stage.
+"""
+import time
+import threading
+import numpy as np
+import pytest
+
+from nplab.instrument.stage import Stage, DummyStage
+
+
+class SlowStage(Stage):
+    """A stage whose moves take `move_time` seconds, and which can start them without waiting."""
+    move_time = 0.1
+
+    def __init__(self):
+        Stage.__init__(self)
+        self._position = np.zeros(len(self.axis_names))
+        self._arrival_time = 0
+
+    def start_move(self, pos, axis=None, relative=False):
+        self._position = np.array(pos, dtype=float)
+        self._arrival_time = time.time() + self.move_time
+
+    def move(self, pos, axis=None, relative=False):
+        self.start_move(pos, axis, relative)
+        self.wait_until_stopped()
+
+    def is_moving(self, axes=None):
+        return time.time() < self._arrival_time
+
+    def get_position(self, axis=None):
+        return self._position
+
+
+class BlockingStage(Stage):
+    """A stage that can only move by waiting for the move, using the base wait_until_stopped, like most drivers."""
+    move_time = 0.1
+
+    def __init__(self):
+        Stage.__init__(self)
+        self._arrival_times = dict((axis, 0) for axis in self.axis_names)
+
+    def move(self, pos, axis=None, relative=False):
+        for a in (self.axis_names if axis is None else [axis]):
+            self._arrival_times[a] = time.time() + self.move_time
+        self.wait_until_stopped(axis)
+
+    def is_moving(self, axes=None):
+        axes = self.axis_names if axes is None else [axes]
+        return any(time.time() < self._arrival_times[a] for a in axes)
+
+
+def test_move_async_returns_before_move_finishes():
+    stage = SlowStage()
+    start = time.time()
+    future = stage.move_async([1, 2, 3])
+    assert time.time() - start < stage.move_time / 2
+    assert not future.done()
+    future.result(timeout=1)
+    assert time.time() - start >= stage.move_time
+    assert not stage.is_moving()
+
+
+def test_wait_until_stopped():
+    stage = SlowStage()
+    stage.move_async([1, 0, 0])
+    stage.wait_until_stopped(timeout=1)
+    assert not stage.is_moving()
+    start = time.time()
+    stage.move([0, 0, 0])
+    assert time.time() - start >= stage.move_time
+
+
+def test_move_async_without_start_move():
+    stage = DummyStage()
+    future = stage.move_async(1e-6, axis='x1')
+    future.result(timeout=1)
+    assert stage.get_position('x1') == 1e-6
+
+
+def test_move_errors_are_passed_on():
+    class BrokenStage(SlowStage):
+        def move_finished(self, axes=None):
+            raise IOError("The controller reported a fault")
+    future = BrokenStage().move_async([1, 0, 0])
+    with pytest.raises(IOError):
+        future.result(timeout=1)
+
+
+def test_blocking_move_can_wait_for_itself():
+    stage = BlockingStage()
+    start = time.time()
+    stage.move_async(1, axis='x').result(timeout=1)
+    assert time.time() - start >= stage.move_time
+    assert not stage.is_moving()
+
+
+def test_wait_until_stopped_only_waits_for_given_axes():
+    stage = BlockingStage()
+    stage.move_time = 0.5
+    future = stage.move_async(1, axis='x')
+    start = time.time()
+    stage.wait_until_stopped('y', timeout=1)
+    assert time.time() - start < 0.25
+    assert not future.done()
+    stage.wait_until_stopped('x', timeout=1)
+    assert future.done()
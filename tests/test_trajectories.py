@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the scan orders used by GridScan.
+"""
+import numpy as np
+import pytest
+
+from nplab.experiment.scanning_experiment.trajectories import (SCAN_ORDERS, scan_order_indices,
+                                                                 changed_axes, snake_order)
+
+
+@pytest.mark.parametrize("order", sorted(SCAN_ORDERS.keys()))
+@pytest.mark.parametrize("shape", [(5,), (3, 4), (6, 5), (2, 3, 4)])
+def test_orders_visit_every_point_once(order, shape):
+    indices = scan_order_indices(order, shape)
+    assert indices.shape == (np.prod(shape), len(shape))
+    assert len(set(map(tuple, indices))) == np.prod(shape)
+
+
+def test_snake_order_takes_single_steps():
+    indices = snake_order((3, 4, 5))
+    assert np.all(np.sum(np.abs(np.diff(indices, axis=0)), axis=1) == 1)
+    assert indices[:6].tolist() == [[0, 0, 0], [0, 0, 1], [0, 0, 2], [0, 0, 3], [0, 0, 4], [0, 1, 4]]
+
+
+def test_user_supplied_points():
+    points = [[0, 2], [1, 1], [1, 2]]
+    indices = scan_order_indices(points, (2, 3))
+    assert indices.tolist() == points
+    assert changed_axes(indices).tolist() == [[True, True], [True, True], [False, True]]
+    with pytest.raises(ValueError):
+        scan_order_indices([[2, 0]], (2, 3))
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for TTTR event streaming, using the synthetic event source.
+"""
+import numpy as np
+import pytest
+
+import nplab.datafile as df
+from nplab.instrument.electronics.daq_streaming import HDF5StreamWriter
+from nplab.instrument.electronics.tttr import (decode_t3r_records, encode_t3r_records, MicrotimeHistogram,
+                                               EventCorrelator, TTTRAcquisition, SyntheticEventSource)
+
+
+def loop_correlation(times_a, times_b, max_lag, bin_width, exclude_self=False):
+    counts = np.zeros(int(np.ceil(2.0 * max_lag / bin_width)), dtype=np.int64)
+    for i, a in enumerate(times_a):
+        for j, b in enumerate(times_b):
+            if exclude_self and i == j:
+                continue
+            if -max_lag <= b - a < max_lag:
+                counts[(b - a + max_lag) // bin_width] += 1
+    return counts
+
+
+def test_decoding_unwraps_overflows():
+    source = SyntheticEventSource(n_events=20000, count_rate=0.001)
+    assert len(source.records) > 20000  # there should be some overflow records
+    events = []
+    overflows = 0
+    for block in np.array_split(source.records, [1, 5000, 5001, 12345]):
+        decoded, overflows = decode_t3r_records(block, overflows)
+        events.append(decoded)
+    events = np.concatenate(events)
+    assert np.array_equal(events['macrotime'], source.macrotimes)
+    assert np.array_equal(events['microtime'], source.microtimes)
+    assert np.array_equal(events['route'], source.routes)
+
+
+def test_correlation_matches_loop():
+    source = SyntheticEventSource(n_events=600, count_rate=0.05)
+    events, overflows = decode_t3r_records(source.records)
+    times_a = events['macrotime'][events['route'] == 0]
+    times_b = events['macrotime'][events['route'] == 1]
+    for route_b, expected in [(1, loop_correlation(times_a, times_b, 100, 7)),
+                              (0, loop_correlation(times_a, times_a, 100, 7, exclude_self=True))]:
+        correlator = EventCorrelator(route_a=0, route_b=route_b, max_lag=100, bin_width=7)
+        for block in np.array_split(events, [10, 11, 250, 400]):
+            correlator(None, block)
+        assert np.array_equal(correlator.counts, expected)
+
+
+def test_acquisition(tmpdir):
+    f = df.DataFile(str(tmpdir.join("tttr.h5")), mode="w")
+    source = SyntheticEventSource(n_events=50000, n_routes=2, lifetime=100.0, n_bins=1024)
+    histogram = MicrotimeHistogram(n_bins=1024, n_routes=2)
+    correlator = EventCorrelator(max_lag=5000, bin_width=100)
+    writer = HDF5StreamWriter(f, name="tttr_records_%d", dtype=np.uint32, chunks=(1024,))
+    acquisition = TTTRAcquisition(source, consumers=[histogram, correlator, writer], poll_interval=0.001)
+    acquisition.start()
+    assert acquisition.wait(timeout=30)
+    assert np.array_equal(writer.dataset[...], source.records)
+    assert histogram.counts.sum() == 50000
+    assert np.array_equal(histogram.counts[1], np.bincount(source.microtimes[source.routes == 1], minlength=1024))
+    # the synthetic events are uncorrelated
+    assert abs(np.mean(correlator.g2) - 1) < 0.05
+    f.close()
+
+
+def test_encoding_round_trip():
+    records = encode_t3r_records([0, 70000, 70001, 300000], [1, 2, 3, 4], [0, 1, 2, 3])
+    events, overflows = decode_t3r_records(records)
+    assert overflows == 4
+    assert list(events['macrotime']) == [0, 70000, 70001, 300000]
+    assert list(events['route']) == [0, 1, 2, 3]
+
+
+class FailingTimeHarpDLL(object):
+    """Stands in for ThLib.dll, with a FIFO read that always fails."""
+    shut_down = False
+
+    def TH_TTReadData(self, buffer, count):
+        return -1
+
+    def TH_Shutdown(self):
+        self.shut_down = True
+
+    def __getattr__(self, name):
+        return lambda *args: 0
+
+
+def test_timeharp_read_error_stops_the_acquisition():
+    from nplab.instrument.electronics.TimeHarp import TimeHarp, TimeHarpTTTRSource
+
+    class FailingTimeHarp(TimeHarp):
+        TTREADMAX = 16
+
+        def __init__(self):
+            self.TH_dll = FailingTimeHarpDLL()
+            self.messages = []
+
+        def FindError(self, thiserror):
+            return "error %d" % thiserror
+
+        def verbose(self, error, function=''):
+            self.messages.append(error)
+
+    timeharp = FailingTimeHarp()
+    acquisition = TTTRAcquisition(TimeHarpTTTRSource(timeharp), poll_interval=0.001).start()
+    with pytest.raises(IOError):
+        acquisition.wait(timeout=5)
+    assert not acquisition.running
+    assert timeharp.TH_dll.shut_down